@@ -0,0 +1,103 @@
+"""
+Asyncio counterpart of api/fetch.py, on a pooled aiohttp session.
+
+Like api/fetch.py nothing in here touches the database.
+"""
+import asyncio
+import weakref
+from urllib.parse import urlsplit
+
+import aiohttp
+from django.conf import settings
+
+from api.fetch import (
+    CHUNK_SIZE, USER_AGENT, FetchError, FetchResult, HostError, check_length, conditional_headers,
+    get_max_bytes, get_timeout, parse_body,
+)
+from api.metrics import timed_fetch
+
+
+def make_session(concurrency=None, per_host=None, timeout=None):
+    """
+    A ClientSession whose connection pool is capped overall and per host.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=concurrency or getattr(settings, 'FEED_REFRESH_CONCURRENCY', 100),
+        limit_per_host=per_host or getattr(settings, 'FEED_REFRESH_PER_HOST', 4),
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=timeout or get_timeout()),
+        headers={'User-Agent': USER_AGENT},
+    )
+
+
+# One shared session per event loop, for the async views.
+_sessions = weakref.WeakKeyDictionary()
+
+
+def get_shared_session():
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = _sessions[loop] = make_session()
+    return session
+
+
+async def close_shared_session():
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+@timed_fetch
+async def fetch_feed_async(session, url, etag='', last_modified=''):
+    """
+    Download the feed at url, conditionally if given validators. The result
+    is not parsed, see parse_async.
+    """
+    if urlsplit(url).scheme not in ('http', 'https'):
+        raise FetchError('Unsupported URL scheme: %s' % url)
+    headers = conditional_headers(etag, last_modified)
+    try:
+        async with session.get(url, headers=headers) as resp:
+            if resp.status == 304:
+                return FetchResult(url, 304, resp.headers, b'')
+            if resp.status != 200:
+                raise FetchError('HTTP %d fetching %s' % (resp.status, url))
+            return FetchResult(url, resp.status, resp.headers, await read_body(url, resp))
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+        raise HostError('Error fetching %s: %s' % (url, e)) from e
+    except (aiohttp.ClientError, ValueError) as e:
+        raise FetchError('Error fetching %s: %s' % (url, e)) from e
+
+
+async def read_body(url, resp):
+    """
+    Read the response body, raising FetchError once it goes over the size
+    cap. The session's total timeout is the deadline for the whole body.
+    """
+    max_bytes = get_max_bytes()
+    check_length(url, resp.headers, max_bytes)
+    body = bytearray()
+    async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+        body += chunk
+        if len(body) > max_bytes:
+            raise FetchError('Feed at %s is larger than %d bytes' % (url, max_bytes))
+    return bytes(body)
+
+
+def parse_all(body, headers, url):
+    parsed = parse_body(body, headers, url)
+    return {'feed': parsed['feed'], 'entries': list(parsed['entries'])}
+
+
+async def parse_async(result, executor=None):
+    """
+    Parse the result's body off the event loop (feedparser is CPU bound).
+    The entries are parsed there too rather than lazily by whoever ends up
+    iterating over them.
+    """
+    loop = asyncio.get_running_loop()
+    result.parsed = await loop.run_in_executor(executor, parse_all, result.body, result.headers, result.url)
+    return result
@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     name = 'api'
+
+    def ready(self):
+        # Connect the signal receivers.
+        from api import signals  # noqa: F401
+        from api import metrics
+        if metrics.is_active():
+            metrics.install()
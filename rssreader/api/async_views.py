@@ -0,0 +1,209 @@
+"""
+Async (ASGI native) versions of the feeds/add and feeds endpoints.
+
+DRF views are synchronous, so under an ASGI server each request would still
+tie up a thread. These are plain Django async views that do the same job as
+FeedCreate and FeedList with the async ORM and aiohttp, so one process can
+hold thousands of feed adds and list requests open at once. feeds/add keeps
+FeedCreate's contract, the feed is returned pending (202) with its fetch
+queued, but the fetch runs on the event loop (refresh_in_background) rather
+than taking a worker pool thread.
+
+They're routed in place of the DRF views when ASYNC_FEED_VIEWS is on, which
+rssreader/asgi.py does by default. So is events, the server-sent event
+stream (see api/events.py), which needs ASGI: an open stream is an await
+rather than a thread.
+"""
+import asyncio
+import functools
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework import status
+from rest_framework.authentication import get_authorization_header
+from rest_framework.exceptions import APIException, AuthenticationFailed
+
+from api.authentication import CachedTokenAuthentication, get_cached_credentials
+from api.events import Subscription, feed_channel, format_event, get_broker, user_channel
+from api.feedcache import aget_version, cache_key, get_cache, get_cache_timeout, is_not_modified, make_etag
+from api.health import CircuitOpen, HostUnavailable, acheck_host
+from api.models import Feed
+from api.pagination import TitleCursorPagination
+from api.renderers import render_response, select_renderer
+from api.refresh import get_reuse_seconds, refresh_in_background
+from api.serializers import FeedSerializer
+from api.subscriptions import asubscribe
+
+
+def error_response(detail, status_code, headers=None):
+    resp = JsonResponse({'detail': detail}, status=status_code)
+    for name, value in (headers or {}).items():
+        resp[name] = value
+    return resp
+
+
+def not_authenticated(detail='Authentication credentials were not provided.'):
+    return error_response(detail, status.HTTP_401_UNAUTHORIZED, {'WWW-Authenticate': 'Token'})
+
+
+async def authenticate(request):
+    """
+    The requesting user or None. Cache hits are answered without leaving the
+    event loop, anything else goes through CachedTokenAuthentication.
+    """
+    auth = get_authorization_header(request).split()
+    if len(auth) == 2 and auth[0].lower() == b'token':
+        try:
+            cached = get_cached_credentials(auth[1].decode())
+        except UnicodeError:
+            cached = None
+        if cached is not None:
+            return cached[0]
+    result = await sync_to_async(CachedTokenAuthentication().authenticate)(request)
+    return result[0] if result else None
+
+
+def api_view(method):
+    """
+    Method check, authentication and DRF style error responses for the async
+    views below.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            if request.method != method:
+                return error_response('Method "%s" not allowed.' % request.method,
+                                      status.HTTP_405_METHOD_NOT_ALLOWED, {'Allow': method})
+            try:
+                user = await authenticate(request)
+                if user is None:
+                    return not_authenticated()
+                return await view(request, user, *args, **kwargs)
+            except AuthenticationFailed as e:
+                return not_authenticated(e.detail)
+            except APIException as e:
+                wait = getattr(e, 'wait', None)
+                return error_response(e.detail, e.status_code, {'Retry-After': '%d' % wait} if wait else None)
+
+        # Token authenticated like the DRF views, so no CSRF.
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+def parse_body(request):
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body)
+        except ValueError:
+            return None
+    return request.POST
+
+
+@api_view('POST')
+async def feed_create(request, user):
+    data = parse_body(request)
+    if data is None:
+        return error_response('JSON parse error.', status.HTTP_400_BAD_REQUEST)
+    serializer = FeedSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        await acheck_host(serializer.validated_data['url'])
+    except CircuitOpen as e:
+        raise HostUnavailable(e)
+
+    feed = await asubscribe(user.id, serializer.validated_data['url'])
+    data = FeedSerializer(feed).data
+    if feed.status != Feed.STATUS_OK:
+        refresh_in_background(feed, max_age=get_reuse_seconds())
+    return JsonResponse(data, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view('GET')
+async def feed_list(request, user):
+    """
+    Like FeedList, served from the cache under the user's version when
+    possible (see api/feedcache.py).
+    """
+    renderer = select_renderer(request)
+    version = await aget_version(user.id)
+    if version is None:
+        return render_response(renderer, await feed_list_data(request, user))
+
+    key = cache_key(request, user.id, version)
+    etag = make_etag(key, renderer.media_type)
+    if is_not_modified(request, etag):
+        resp = HttpResponseNotModified()
+        patch_vary_headers(resp, ['Accept'])
+    else:
+        cache = get_cache()
+        data = await cache.aget(key) if cache else None
+        if data is None:
+            data = await feed_list_data(request, user)
+            if cache:
+                await cache.aset(key, data, get_cache_timeout())
+        resp = render_response(renderer, data)
+    resp['ETag'] = etag
+    return resp
+
+
+async def feed_list_data(request, user):
+    fields = FeedSerializer.output_fields(request)
+    queryset = FeedSerializer.values_queryset(Feed.objects.filter(users=user.id), fields)
+    paginator = TitleCursorPagination()
+    page = paginator.set_page([row async for row in paginator.page_queryset(queryset, request)])
+    return {'next': paginator.get_next_link(), 'results': FeedSerializer.values_data(page, fields)}
+
+
+@api_view('GET')
+async def events(request, user):
+    """
+    Server-sent events for the user's feeds: "articles" when one of them has
+    new articles, "subscriptions" when the user's list changed. Streams end
+    after EVENTS_STREAM_SECONDS, clients reconnect (EventSource does so by
+    itself).
+    """
+    resp = StreamingHttpResponse(event_stream(user.id), content_type='text/event-stream')
+    resp['Cache-Control'] = 'no-cache'
+    # Don't let nginx buffer the stream.
+    resp['X-Accel-Buffering'] = 'no'
+    return resp
+
+
+async def subscribed_channels(user_id):
+    feed_ids = Feed.users.through.objects.filter(user_id=user_id).values_list('feed_id', flat=True)
+    return {feed_channel(feed_id) async for feed_id in feed_ids}
+
+
+async def event_stream(user_id):
+    heartbeat = getattr(settings, 'EVENTS_HEARTBEAT_SECONDS', 25)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + getattr(settings, 'EVENTS_STREAM_SECONDS', 300)
+    broker = get_broker()
+    subscription = Subscription()
+    # The user's channel first so no subscription change is missed.
+    channels = {user_channel(user_id)}
+    broker.add(subscription, channels)
+    try:
+        feeds = await subscribed_channels(user_id)
+        broker.add(subscription, feeds)
+        channels |= feeds
+        yield 'retry: %d\n\n' % (getattr(settings, 'EVENTS_RETRY_SECONDS', 5) * 1000)
+        while (remaining := deadline - loop.time()) > 0:
+            event = await subscription.get(min(heartbeat, remaining))
+            if event is None:
+                # Keeps proxies from timing out an idle stream.
+                yield ': keepalive\n\n'
+                continue
+            if event['event'] == 'subscriptions':
+                feeds = await subscribed_channels(user_id)
+                broker.remove(subscription, channels - feeds - {user_channel(user_id)})
+                broker.add(subscription, feeds - channels)
+                channels = feeds | {user_channel(user_id)}
+            yield format_event(event)
+    finally:
+        broker.remove(subscription, channels)
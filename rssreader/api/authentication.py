@@ -0,0 +1,86 @@
+"""
+Token authentication with the token -> user lookup cached.
+
+TokenAuthentication runs a Token + User query on every authenticated request,
+which makes it the most frequent query we run. This keeps the result in a
+bounded, TTL'd in-process LRU and, if TOKEN_AUTH_SHARED_CACHE names one of the
+CACHES, in that shared cache as well so processes can warm each other up.
+
+Entries are dropped when a token is deleted or rotated or its user changes
+(see api/signals.py). Other processes' in-process entries can't be reached
+from here, so TOKEN_AUTH_CACHE_TTL bounds how long they can lag behind.
+"""
+import copy
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.authentication import TokenAuthentication
+
+from api.cache import LRUCache
+
+SHARED_KEY_PREFIX = 'authtoken:'
+
+_local_cache = None
+_local_cache_lock = threading.Lock()
+
+
+def get_local_cache():
+    global _local_cache
+    with _local_cache_lock:
+        if _local_cache is None:
+            _local_cache = LRUCache(
+                maxsize=getattr(settings, 'TOKEN_AUTH_CACHE_SIZE', 10000),
+                ttl=getattr(settings, 'TOKEN_AUTH_CACHE_TTL', 60),
+            )
+        return _local_cache
+
+
+def get_shared_cache():
+    alias = getattr(settings, 'TOKEN_AUTH_SHARED_CACHE', None)
+    return caches[alias] if alias else None
+
+
+def invalidate_token(key):
+    """
+    Forget the cached user for a token key.
+    """
+    get_local_cache().delete(key)
+    shared = get_shared_cache()
+    if shared is not None:
+        shared.delete(SHARED_KEY_PREFIX + key)
+
+
+def get_cached_credentials(key):
+    """
+    The (user, token) cached in this process for key, or None. Never touches
+    the database (or the shared cache), so it is safe to call from async code.
+    """
+    cached = get_local_cache().get(key)
+    if cached is None:
+        return None
+    user, token = cached
+    return copy.copy(user), token
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    def authenticate_credentials(self, key):
+        local = get_local_cache()
+        shared = get_shared_cache()
+
+        cached = local.get(key)
+        if cached is None and shared is not None:
+            cached = shared.get(SHARED_KEY_PREFIX + key)
+            if cached is not None:
+                local.set(key, cached)
+
+        if cached is None:
+            # Invalid or inactive credentials raise here and aren't cached.
+            cached = super().authenticate_credentials(key)
+            local.set(key, cached)
+            if shared is not None:
+                shared.set(SHARED_KEY_PREFIX + key, cached, getattr(settings, 'TOKEN_AUTH_CACHE_TTL', 60))
+
+        user, token = cached
+        # Hand each request its own copy so nothing leaks between requests.
+        return copy.copy(user), token
@@ -0,0 +1,277 @@
+"""
+Load generation for the API endpoints (see manage.py benchmark_api).
+
+Seeds users, feeds and subscriptions, serves the feeds from a local fixture
+HTTP server and drives the endpoints from concurrent threads through Django's
+test client. Requests are handled in process so each one's queries can be
+counted too. Results are plain dicts, saved as JSON to compare between
+commits.
+"""
+import itertools
+import math
+import random
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import close_old_connections, connection
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from api.metrics import instrument, track_queries
+from api.models import Feed, SubscriptionVersion
+from api.workers import get_pool
+
+USERNAME_PREFIX = 'bench-'
+PASSWORD = 'bench-Pa$$w0rd'
+ENDPOINTS = ['users/register', 'users/login', 'feeds/add', 'feeds']
+
+
+def percentile(values, pct):
+    """
+    Nearest-rank percentile of values.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(1, math.ceil(pct / 100 * len(ordered))) - 1]
+
+
+def render_feed(name, items=10):
+    entries = ''.join(
+        '<item><title>%s post %d</title><link>https://bench.invalid/%s/%d</link>'
+        '<pubDate>Mon, 05 Oct 2020 10:%02d:00 GMT</pubDate></item>' % (name, i, name, i, i % 60)
+        for i in range(items)
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+        '<title>Feed %s</title><link>https://bench.invalid/%s</link>%s</channel></rss>' % (name, name, entries)
+    ).encode('utf8')
+
+
+class FixtureServer:
+    """
+    Local HTTP server answering /feed/<name> with a generated feed.
+    """
+    def __init__(self, items=10):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if not self.path.startswith('/feed/'):
+                    self.send_error(404)
+                    return
+                body = render_feed(self.path[len('/feed/'):], items)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/rss+xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.httpd.server_port, path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class EndpointStats:
+    """
+    Latencies, query counts and errors of the requests made to one endpoint.
+    """
+    def __init__(self):
+        self.latencies = []
+        self.queries = []
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def record(self, latency, queries, ok):
+        self.latencies.append(latency)
+        self.queries.append(queries)
+        if not ok:
+            self.errors += 1
+
+    def to_dict(self):
+        count = len(self.latencies)
+        return {
+            'requests': count,
+            'errors': self.errors,
+            'seconds': round(self.elapsed, 3),
+            'throughput': round(count / self.elapsed, 1) if self.elapsed else 0.0,
+            'latency_ms': {
+                name: round(percentile(self.latencies, pct) * 1000, 2)
+                for name, pct in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))
+            },
+            'queries': {
+                'mean': round(sum(self.queries) / count, 2) if count else 0.0,
+                'max': max(self.queries, default=0),
+            },
+        }
+
+
+def client_host():
+    # A host the site accepts, with DEBUG and no ALLOWED_HOSTS that's localhost.
+    for host in settings.ALLOWED_HOSTS:
+        if host != '*':
+            return host.lstrip('.')
+    return 'localhost'
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+    """
+    Seed users/feeds/subscriptions, then make requests to each endpoint in
+    turn from concurrency threads. Everything seeded or created is removed
+    afterwards.
+    """
+    def __init__(self, users=100, feeds=500, subscriptions=2000, requests=200, concurrency=8, endpoints=None):
+        self.users = users
+        self.feeds = feeds
+        self.subscriptions = subscriptions
+        self.requests = requests
+        self.concurrency = concurrency
+        self.endpoints = endpoints or ENDPOINTS
+        self.counter = itertools.count()
+
+    def run(self):
+        with FixtureServer() as self.server:
+            try:
+                self.seed()
+                results = {}
+                for endpoint in self.endpoints:
+                    results[endpoint] = self.drive(getattr(self, 'request_' + endpoint.replace('/', '_'))).to_dict()
+            finally:
+                # Let the fetches feeds/add queued finish before removing their feeds.
+                get_pool().join()
+                self.cleanup()
+        return {
+            'commit': git_commit(),
+            'date': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'params': {
+                'users': self.users, 'feeds': self.feeds, 'subscriptions': self.subscriptions,
+                'requests': self.requests, 'concurrency': self.concurrency,
+            },
+            'endpoints': results,
+        }
+
+    def seed(self):
+        self.cleanup()
+        # Hash once, hashing a password per user would dominate the seeding.
+        password = make_password(PASSWORD)
+        User.objects.bulk_create([
+            User(username='%s%d' % (USERNAME_PREFIX, i), password=password) for i in range(self.users)
+        ])
+        users = list(User.objects.filter(username__startswith=USERNAME_PREFIX).order_by('id'))
+        tokens = Token.objects.bulk_create([Token(key=Token.generate_key(), user=user) for user in users])
+        self.accounts = [(token.user.username, token.key) for token in tokens]
+
+        Feed.objects.bulk_create([
+            Feed(url=self.server.url('/feed/%d' % i), title='Feed %d' % i, status=Feed.STATUS_OK)
+            for i in range(self.feeds)
+        ])
+        feed_ids = list(Feed.objects.filter(url__startswith=self.server.url('/feed/')).values_list('id', flat=True))
+        pairs = {(random.choice(users).id, random.choice(feed_ids)) for _ in range(self.subscriptions)}
+        Feed.users.through.objects.bulk_create(
+            [Feed.users.through(user_id=user_id, feed_id=feed_id) for user_id, feed_id in pairs],
+            ignore_conflicts=True,
+        )
+        SubscriptionVersion.objects.bulk_create([SubscriptionVersion(user=user) for user in users])
+
+    def cleanup(self):
+        Feed.objects.filter(url__startswith=self.server.url('/')).delete()
+        User.objects.filter(username__startswith=USERNAME_PREFIX).delete()
+
+    def drive(self, make_request):
+        stats = EndpointStats()
+        remaining = itertools.count()
+        lock = threading.Lock()
+
+        def worker():
+            client = Client(HTTP_HOST=client_host())
+            # Not CaptureQueriesContext, every request resets the query log.
+            instrument(connection)
+            try:
+                while next(remaining) < self.requests:
+                    n = next(self.counter)
+                    started = time.monotonic()
+                    with track_queries() as queries:
+                        resp = make_request(client, n)
+                    latency = time.monotonic() - started
+                    with lock:
+                        stats.record(latency, queries.queries, resp.status_code < 400)
+            finally:
+                close_old_connections()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.concurrency)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats.elapsed = time.monotonic() - started
+        return stats
+
+    def auth(self, n):
+        return {'HTTP_AUTHORIZATION': 'Token ' + self.accounts[n % len(self.accounts)][1]}
+
+    def request_users_register(self, client, n):
+        data = {'username': '%snew-%d' % (USERNAME_PREFIX, n), 'password': PASSWORD}
+        return client.post(reverse('user_register'), data)
+
+    def request_users_login(self, client, n):
+        data = {'username': self.accounts[n % len(self.accounts)][0], 'password': PASSWORD}
+        return client.post(reverse('user_login'), data)
+
+    def request_feeds_add(self, client, n):
+        return client.post(reverse('feeds_add'), {'url': self.server.url('/feed/new-%d' % n)}, **self.auth(n))
+
+    def request_feeds(self, client, n):
+        return client.get(reverse('feeds_list'), **self.auth(n))
+
+
+def compare(previous, current):
+    """
+    Lines describing how each endpoint changed between two result dicts.
+    """
+    def change(old, new):
+        if not old:
+            return ''
+        return ' (%+.1f%%)' % ((new - old) / old * 100)
+
+    lines = []
+    for endpoint, new in current['endpoints'].items():
+        old = previous['endpoints'].get(endpoint)
+        if old is None:
+            continue
+        lines.append('%s: %.1f req/sec%s, p50 %.2fms%s, p99 %.2fms%s, %.2f queries%s' % (
+            endpoint,
+            new['throughput'], change(old['throughput'], new['throughput']),
+            new['latency_ms']['p50'], change(old['latency_ms']['p50'], new['latency_ms']['p50']),
+            new['latency_ms']['p99'], change(old['latency_ms']['p99'], new['latency_ms']['p99']),
+            new['queries']['mean'], change(old['queries']['mean'], new['queries']['mean']),
+        ))
+    return lines
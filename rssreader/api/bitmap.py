@@ -0,0 +1,75 @@
+"""
+Compact set of integer ids, stored as a zlib compressed bitmap.
+
+Used for the read state exceptions. The bits are held in a Python int offset
+from the smallest id so membership and counting are just word operations.
+"""
+import re
+import struct
+import zlib
+
+HEADER = struct.Struct('>Q')
+NONZERO_BYTE = re.compile(rb'[^\x00]')
+
+
+class IdBitmap:
+    def __init__(self, ids=()):
+        self.base = 0
+        self.bits = 0
+        for id in ids:
+            self.add(id)
+
+    @classmethod
+    def from_bytes(cls, data):
+        bitmap = cls()
+        if data:
+            data = bytes(data)
+            (bitmap.base,) = HEADER.unpack_from(data)
+            bitmap.bits = int.from_bytes(zlib.decompress(data[HEADER.size:]), 'little')
+        return bitmap
+
+    def to_bytes(self):
+        if not self.bits:
+            return b''
+        raw = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, 'little')
+        return HEADER.pack(self.base) + zlib.compress(raw)
+
+    def add(self, id):
+        if not self.bits:
+            self.base = id
+        elif id < self.base:
+            self.bits <<= self.base - id
+            self.base = id
+        self.bits |= 1 << (id - self.base)
+
+    def discard(self, id):
+        if id in self:
+            self.bits &= ~(1 << (id - self.base))
+
+    def clear(self):
+        self.base = 0
+        self.bits = 0
+
+    def __contains__(self, id):
+        return id >= self.base and bool(self.bits >> (id - self.base) & 1)
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __iter__(self):
+        # Ids can be millions apart, so only the non-zero bytes are visited
+        # (found by the regex engine) rather than every bit in between.
+        raw = self.bits.to_bytes((self.bits.bit_length() + 7) // 8, 'little')
+        for match in NONZERO_BYTE.finditer(raw):
+            byte, offset = raw[match.start()], self.base + match.start() * 8
+            for bit in range(8):
+                if byte >> bit & 1:
+                    yield offset + bit
+
+    def count_above(self, id):
+        """
+        Number of ids in the set greater than id.
+        """
+        if id < self.base:
+            return len(self)
+        return bin(self.bits >> (id - self.base + 1)).count('1')
@@ -0,0 +1,93 @@
+"""
+Content-addressed, compressed storage for article summaries and contents.
+
+Feeds syndicate the same bodies (and re-publish them under new urls), and
+the html is most of an article's size. Each distinct text is stored once
+as an ArticleBody keyed by its sha256 and zlib compressed, articles point at
+it with summary_body/content_body. Nothing is decompressed until something
+reads Article.summary or Article.content.
+"""
+import hashlib
+import zlib
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef, prefetch_related_objects
+
+from api.models import Article, ArticleBody
+
+COMPRESS_LEVEL = 6
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+
+def compress(text):
+    return zlib.compress(text.encode('utf8'), COMPRESS_LEVEL)
+
+
+def make_body(text):
+    """
+    An unsaved ArticleBody for text (None if it's empty) that already knows
+    its text. store_bodies compresses it, if it isn't stored already.
+    """
+    if not text:
+        return None
+    body = ArticleBody(hash=hash_text(text))
+    # Pre-fill the cached_property, nothing has to be decompressed.
+    body.text = text
+    return body
+
+
+def store_bodies(bodies):
+    """
+    Insert the bodies that aren't stored yet. Which ones are is looked up
+    with one query, so a syndicated duplicate isn't compressed again. One
+    inserted concurrently is ignored by the database.
+
+    Call it in the transaction that inserts the articles: the stored bodies
+    are locked until it commits, so delete_orphan_bodies can't delete them
+    before the articles referring to them exist.
+    """
+    new = {body.hash: body for body in bodies if body is not None}
+    if not new:
+        return
+    stored = ArticleBody.objects.select_for_update().filter(hash__in=new).order_by('hash')
+    for hash in stored.values_list('hash', flat=True):
+        del new[hash]
+    for body in new.values():
+        body.data = compress(body.text)
+        body.size = len(body.text.encode('utf8'))
+    if new:
+        ArticleBody.objects.bulk_create(new.values(), ignore_conflicts=True)
+
+
+def load_bodies(articles, *fields):
+    """
+    Load the given body fields ('summary_body', 'content_body') of articles
+    with one query each.
+    """
+    prefetch_related_objects(articles, *fields)
+
+
+def delete_orphan_bodies(hashes=None):
+    """
+    Delete bodies no article refers to any more, only checking hashes if
+    given, returns how many.
+
+    The orphans are locked before they're deleted and checked again after,
+    so an ingest that found one stored (see store_bodies) either commits its
+    articles first, and the body is kept, or waits and stores it again.
+    """
+    with transaction.atomic(savepoint=False):
+        candidates = ArticleBody.objects.all() if hashes is None else ArticleBody.objects.filter(hash__in=hashes)
+        locked = orphans(candidates).select_for_update().order_by('hash').values_list('hash', flat=True)
+        return orphans(ArticleBody.objects.filter(hash__in=list(locked))).delete()[0]
+
+
+def orphans(bodies):
+    return bodies.exclude(
+        Exists(Article.objects.filter(summary_body=OuterRef('pk')))
+    ).exclude(
+        Exists(Article.objects.filter(content_body=OuterRef('pk')))
+    )
@@ -0,0 +1,192 @@
+"""
+Asyncio based bulk feed refresher.
+
+Refreshing thousands of feeds one feedparser.parse call at a time takes
+hours, almost all of it spent waiting on the network. This engine keeps many
+fetches in flight over a pooled aiohttp session (capped globally and per
+host), parses the raw bodies in an executor so the event loop isn't blocked
+and writes the results back to the Feed table in batches. Requests are
+conditional, feeds that come back unchanged aren't parsed and only have their
+schedule written. Once a host's circuit opens (see api/health.py) the rest of
+its feeds fail straight away instead of each waiting out a timeout.
+"""
+import asyncio
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from api.aiofetch import fetch_feed_async, make_session, parse_async
+from api.feedcache import bump_subscribers
+from api.fetch import FetchError, get_timeout
+from api.health import CircuitOpen, HostBreaker, save_hosts
+from api.ingest import ingest_entries
+from api.models import Feed
+from api.refresh import (
+    STATUS_FIELDS, UPDATE_FIELDS, listing_changed, set_deferred, set_error, set_result, set_unchanged,
+)
+
+
+class RefreshStats:
+    """
+    Counters and fetch latencies collected over a bulk refresh run.
+    """
+    def __init__(self):
+        self.ok = 0
+        self.unchanged = 0
+        self.failed = 0
+        # Not fetched, their host's circuit is open.
+        self.deferred = 0
+        self.latencies = []
+        self.started = time.monotonic()
+        self.finished = None
+
+    @property
+    def total(self):
+        return self.ok + self.unchanged + self.failed + self.deferred
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def feeds_per_sec(self):
+        return self.total / self.elapsed if self.elapsed else 0.0
+
+    def percentile(self, pct):
+        """
+        Nearest-rank percentile of the fetch latencies, in seconds.
+        """
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        rank = max(1, math.ceil(pct / 100 * len(ordered)))
+        return ordered[rank - 1]
+
+    def summary(self):
+        return (
+            'Refreshed %d feeds (%d ok, %d unchanged, %d failed, %d deferred) in %.2fs: %.1f feeds/sec, '
+            'fetch latency p50 %.0fms p99 %.0fms' % (
+                self.total, self.ok, self.unchanged, self.failed, self.deferred, self.elapsed, self.feeds_per_sec,
+                self.percentile(50) * 1000, self.percentile(99) * 1000,
+            )
+        )
+
+
+def write_batch(batch, hosts=()):
+    """
+    Write a batch of (feed, fields, entries) tuples, one bulk_update per
+    distinct set of fields so deferred fields are never touched, then ingest
+    any new entries. hosts are HostHealth records to save along with them.
+    """
+    groups = {}
+    for feed, fields, entries in batch:
+        groups.setdefault(tuple(fields), []).append(feed)
+    with transaction.atomic():
+        save_hosts(hosts)
+        for fields, feeds in groups.items():
+            Feed.objects.bulk_update(feeds, fields)
+        bump_subscribers(listing_changed(feed for feed, fields, entries in batch))
+        for feed, fields, entries in batch:
+            if entries:
+                ingest_entries(feed, entries)
+
+
+class BulkRefresher:
+    """
+    Refresh many feeds concurrently.
+
+    concurrency caps the total number of fetches in flight, per_host caps the
+    fetches in flight against any single host, batch_size is the number of
+    feeds written per UPDATE batch.
+    """
+    def __init__(self, concurrency=None, per_host=None, batch_size=None, timeout=None, parse_workers=None):
+        self.concurrency = concurrency or getattr(settings, 'FEED_REFRESH_CONCURRENCY', 100)
+        self.per_host = per_host or getattr(settings, 'FEED_REFRESH_PER_HOST', 4)
+        self.batch_size = batch_size or getattr(settings, 'FEED_REFRESH_BATCH_SIZE', 100)
+        self.timeout = timeout or get_timeout()
+        self.parse_workers = parse_workers
+
+    def run(self, feeds):
+        """
+        Refresh the given feeds, blocking until done. Returns RefreshStats.
+        """
+        return asyncio.run(self.refresh(list(feeds)))
+
+    async def refresh(self, feeds):
+        stats = RefreshStats()
+        self.breaker = await HostBreaker.afor_urls(feed.url for feed in feeds)
+        jobs = asyncio.Queue()
+        for feed in feeds:
+            jobs.put_nowait(feed)
+        # Bounded so fetchers can't run too far ahead of the database writes.
+        results = asyncio.Queue(maxsize=self.batch_size * 2)
+
+        with ThreadPoolExecutor(self.parse_workers) as executor:
+            async with make_session(self.concurrency, self.per_host, self.timeout) as session:
+                writer = asyncio.ensure_future(self._write(results))
+                fetchers = [
+                    asyncio.ensure_future(self._fetch_worker(session, executor, jobs, results, stats))
+                    for _ in range(min(self.concurrency, len(feeds)))
+                ]
+                fetching = asyncio.gather(*fetchers)
+                try:
+                    # If the writer dies the fetchers would block on the full
+                    # results queue forever, so surface its error right away.
+                    await asyncio.wait([fetching, writer], return_when=asyncio.FIRST_COMPLETED)
+                    if writer.done():
+                        writer.result()
+                    await fetching
+                    await results.put(None)
+                    await writer
+                finally:
+                    for task in fetchers + [writer]:
+                        task.cancel()
+
+        stats.finished = time.monotonic()
+        return stats
+
+    async def _fetch_worker(self, session, executor, jobs, results, stats):
+        while True:
+            try:
+                feed = jobs.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            try:
+                async with self.breaker.aguard(feed):
+                    result = await fetch_feed_async(session, feed.url, feed.etag, feed.last_modified)
+                stats.latencies.append(feed.last_latency)
+                if result.is_unchanged(feed.content_hash):
+                    stats.unchanged += 1
+                    fields, entries = set_unchanged(feed, result), None
+                else:
+                    await parse_async(result, executor)
+                    set_result(feed, result)
+                    stats.ok += 1
+                    fields, entries = UPDATE_FIELDS, result.entries
+            except CircuitOpen as e:
+                stats.deferred += 1
+                fields, entries = set_deferred(feed, e), None
+            except FetchError as e:
+                set_error(feed, e)
+                stats.failed += 1
+                fields, entries = STATUS_FIELDS, None
+            await results.put((feed, fields, entries))
+
+    async def _write(self, results):
+        write = sync_to_async(write_batch)
+        batch = []
+        while True:
+            item = await results.get()
+            if item is None:
+                break
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                await write(batch, self.breaker.pop_changed())
+                batch = []
+        if batch:
+            await write(batch, self.breaker.pop_changed())
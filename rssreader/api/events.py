@@ -0,0 +1,137 @@
+"""
+Pushing new article notifications to clients (GET /events) instead of them
+polling.
+
+Events are published per feed: when ingest_entries stores new articles for
+a feed, an "articles" event goes out on the feed's channel once the
+transaction commits. Subscription changes publish a "subscriptions" event
+on the user's channel. A stream listens on its user's channel and the
+channels of every feed the user follows, picking up feeds added since it
+connected from the subscriptions events.
+
+The broker is pluggable (EVENTS_BACKEND). The default, InProcessBroker, only
+reaches streams held by the same process, so feeds refreshed in another
+process (run_scheduler, another server worker) aren't pushed. A shared
+broker (Redis pub/sub, PostgreSQL LISTEN/NOTIFY) needs the same add, remove
+and publish methods, delivering to Subscription.deliver.
+"""
+import asyncio
+import json
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def feed_channel(feed_id):
+    return 'feed:%d' % feed_id
+
+
+def user_channel(user_id):
+    return 'user:%d' % user_id
+
+
+class Subscription:
+    """
+    A stream's queue of events, fed from any thread. Idle, it's an await on
+    the queue. If the stream falls behind by more than EVENTS_QUEUE_SIZE
+    events the oldest are dropped, every event carries the current state
+    rather than a change so only the newest matters.
+    """
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(getattr(settings, 'EVENTS_QUEUE_SIZE', 100))
+
+    def deliver(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self._put, event)
+        except RuntimeError:
+            # The stream's loop has closed.
+            pass
+
+    def _put(self, event):
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self, timeout):
+        """
+        The next event, None if there was none within timeout seconds.
+        """
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class InProcessBroker:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # channel -> subscriptions
+        self._channels = {}
+
+    def add(self, subscription, channels):
+        with self._lock:
+            for channel in channels:
+                self._channels.setdefault(channel, set()).add(subscription)
+
+    def remove(self, subscription, channels=None):
+        """
+        Stop delivering channels (all of them by default) to subscription.
+        """
+        with self._lock:
+            for channel in list(self._channels) if channels is None else channels:
+                subscriptions = self._channels.get(channel)
+                if subscriptions is None:
+                    continue
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._channels[channel]
+
+    def publish(self, channel, event):
+        with self._lock:
+            subscriptions = list(self._channels.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.deliver(event)
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = import_string(getattr(settings, 'EVENTS_BACKEND', 'api.events.InProcessBroker'))()
+        return _broker
+
+
+def publish(channel, event, on_commit=True):
+    """
+    Publish event on channel once the current transaction commits (listeners
+    react by reading the database), or right away if on_commit is False:
+    async code can't use transaction.on_commit and runs in autocommit.
+    """
+    if on_commit:
+        transaction.on_commit(lambda: get_broker().publish(channel, event))
+    else:
+        get_broker().publish(channel, event)
+
+
+def new_articles(feed):
+    """
+    Tell the feed's subscribers it has new articles.
+    """
+    publish(feed_channel(feed.id), {
+        'event': 'articles',
+        'data': {'feed': feed.id, 'article_count': feed.article_count, 'last_article_id': feed.last_article_id},
+    })
+
+
+def subscriptions_changed(user_id, on_commit=True):
+    publish(user_channel(user_id), {'event': 'subscriptions', 'data': {}}, on_commit)
+
+
+def format_event(event):
+    return 'event: %s\ndata: %s\n\n' % (event['event'], json.dumps(event['data']))
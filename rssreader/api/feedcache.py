@@ -0,0 +1,97 @@
+"""
+Caching of feed list (GET /feeds) responses.
+
+Clients poll the feed list far more often than it changes. Every user has a
+SubscriptionVersion counter that is bumped whenever something their list
+shows changes: subscribing, unsubscribing, or a subscribed feed's title or
+status changing. Responses are cached and ETagged under the version, so a
+poll is one small query for the version and, if the client already has that
+version, a 304.
+
+Cache entries are never invalidated, a bump just means they're never looked
+up again, so a per-process cache is as correct as a shared one.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import F
+from django.utils.http import parse_etags
+
+from api.models import Feed, SubscriptionVersion
+
+FeedUser = Feed.users.through
+
+
+def get_cache():
+    alias = getattr(settings, 'FEED_LIST_CACHE', 'default')
+    return caches[alias] if alias else None
+
+
+def get_cache_timeout():
+    return getattr(settings, 'FEED_LIST_CACHE_TIMEOUT', 300)
+
+
+def get_version(user_id):
+    """
+    The user's current version, None if they don't have one yet (nothing
+    is cached for them until they do).
+    """
+    return SubscriptionVersion.objects.filter(user_id=user_id).values_list('version', flat=True).first()
+
+
+async def aget_version(user_id):
+    return await SubscriptionVersion.objects.filter(user_id=user_id).values_list('version', flat=True).afirst()
+
+
+def bump_version(user_id):
+    if not SubscriptionVersion.objects.filter(user_id=user_id).update(version=F('version') + 1):
+        # First change for this user. Incrementing after the insert (rather
+        # than inserting at 1) means a racing bump can't be lost.
+        SubscriptionVersion.objects.bulk_create([SubscriptionVersion(user_id=user_id)], ignore_conflicts=True)
+        SubscriptionVersion.objects.filter(user_id=user_id).update(version=F('version') + 1)
+
+
+async def abump_version(user_id):
+    if not await SubscriptionVersion.objects.filter(user_id=user_id).aupdate(version=F('version') + 1):
+        await SubscriptionVersion.objects.abulk_create([SubscriptionVersion(user_id=user_id)], ignore_conflicts=True)
+        await SubscriptionVersion.objects.filter(user_id=user_id).aupdate(version=F('version') + 1)
+
+
+def subscribers_of(feed_ids):
+    return SubscriptionVersion.objects.filter(
+        user_id__in=FeedUser.objects.filter(feed_id__in=feed_ids).values('user_id'),
+    )
+
+
+def bump_subscribers(feed_ids):
+    """
+    Bump the version of every user subscribed to any of the feeds, in one
+    UPDATE.
+    """
+    if feed_ids:
+        subscribers_of(feed_ids).update(version=F('version') + 1)
+
+
+async def abump_subscribers(feed_ids):
+    if feed_ids:
+        await subscribers_of(feed_ids).aupdate(version=F('version') + 1)
+
+
+def cache_key(request, user_id, version):
+    # The full url, the cached next link includes the host.
+    digest = hashlib.sha1(request.build_absolute_uri().encode('utf8')).hexdigest()
+    return 'feeds:%d:%d:%s' % (user_id, version, digest)
+
+
+def make_etag(key, media_type):
+    # The data is cached once, each format it's rendered in (see
+    # api/renderers.py) is a representation of its own.
+    return '"%s"' % hashlib.sha1(('%s %s' % (key, media_type)).encode('utf8')).hexdigest()
+
+
+def is_not_modified(request, etag):
+    """
+    Whether the request's If-None-Match already names etag.
+    """
+    return etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', ''))
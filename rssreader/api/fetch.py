@@ -0,0 +1,234 @@
+"""
+Fetching and parsing of remote RSS/Atom documents.
+
+Nothing in here touches the database, callers decide what to do with the
+FetchResult that comes back.
+
+Bodies are read in chunks against a size cap and an overall deadline, so a
+huge or endlessly trickling response can't tie up a worker or its memory.
+Well-formed documents are parsed incrementally (see api/streamparse.py).
+"""
+import hashlib
+import time
+import urllib.error
+import urllib.request
+from urllib.parse import urlsplit
+from xml.etree import ElementTree
+
+import feedparser
+from django.conf import settings
+
+from api.metrics import timed_fetch
+from api.streamparse import iter_document
+
+USER_AGENT = 'simple-rss-reader/0.1 (+https://github.com/rgroves/simple-rss-reader)'
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchError(Exception):
+    """
+    Raised when a feed could not be downloaded or parsed.
+    """
+
+
+class HostError(FetchError):
+    """
+    Raised when the feed's host couldn't be reached or didn't answer in time,
+    as opposed to answering with an error or something that isn't a feed.
+    """
+
+
+class FetchResult:
+    """
+    Outcome of a single feed fetch: the HTTP status, headers, raw body and
+    the parsed feed built from that body, a dict holding the feed metadata
+    under 'feed' and an iterable of feedparser entries under 'entries'.
+
+    parsed is None when the feed turned out to be unchanged (a 304 or a body
+    identical to the last one), there's nothing new to parse in that case.
+    """
+    def __init__(self, url, status, headers, body, parsed=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.parsed = parsed
+
+    @property
+    def etag(self):
+        return self.headers.get('ETag', '')
+
+    @property
+    def last_modified(self):
+        return self.headers.get('Last-Modified', '')
+
+    @property
+    def content_hash(self):
+        return hash_body(self.body)
+
+    def is_unchanged(self, content_hash=''):
+        """
+        True if the server said 304 or the body hashes to content_hash.
+        """
+        if self.status == 304:
+            return True
+        return bool(content_hash) and self.content_hash == content_hash
+
+    @property
+    def feed(self):
+        return self.parsed['feed']
+
+    @property
+    def entries(self):
+        return self.parsed['entries']
+
+
+def hash_body(body):
+    return hashlib.sha256(body).hexdigest()
+
+
+def conditional_headers(etag='', last_modified=''):
+    """
+    Request headers for a conditional GET against the validators we stored
+    from the previous fetch.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def get_timeout():
+    return getattr(settings, 'FEED_FETCH_TIMEOUT', 30)
+
+
+def get_max_bytes():
+    return getattr(settings, 'FEED_FETCH_MAX_BYTES', 10 * 1024 * 1024)
+
+
+def check_length(url, headers, max_bytes):
+    """
+    Fail fast when the server announces a body bigger than we'll read.
+    """
+    try:
+        length = int(headers.get('Content-Length') or 0)
+    except ValueError:
+        return
+    if length > max_bytes:
+        raise FetchError('Feed at %s is larger than %d bytes' % (url, max_bytes))
+
+
+def iter_body(url, resp, deadline, max_bytes=None):
+    """
+    Yield the response body in chunks, raising FetchError once it goes over
+    max_bytes or is still arriving after the deadline (a time.monotonic()
+    value). The socket timeout only bounds each read, not the whole body.
+    """
+    max_bytes = max_bytes or get_max_bytes()
+    check_length(url, resp.headers, max_bytes)
+    size = 0
+    while True:
+        if time.monotonic() > deadline:
+            raise HostError('Timed out reading %s' % url)
+        chunk = resp.read1(CHUNK_SIZE)
+        if not chunk:
+            return
+        size += len(chunk)
+        if size > max_bytes:
+            raise FetchError('Feed at %s is larger than %d bytes' % (url, max_bytes))
+        yield chunk
+
+
+def response_headers(headers, url):
+    headers = dict(headers or {})
+    if url:
+        # feedparser resolves relative links against it.
+        headers['content-location'] = url
+    return headers
+
+
+def parse_lenient(body, headers=None, url=''):
+    """
+    Parse the whole document with feedparser, which copes with broken XML.
+    """
+    parsed = feedparser.parse(body, response_headers=response_headers(headers, url))
+    if parsed.get('bozo') and not parsed['feed'] and not parsed['entries']:
+        raise FetchError('Not a valid feed: %s' % parsed.get('bozo_exception'))
+    return parsed
+
+
+def iter_chunks(body):
+    """
+    The body in CHUNK_SIZE slices, for the pull parser to work through as it
+    goes rather than building the whole tree before its first event.
+    """
+    for start in range(0, len(body), CHUNK_SIZE):
+        yield body[start:start + CHUNK_SIZE]
+
+
+def iter_body_entries(document, body, headers=None, url=''):
+    count = 0
+    try:
+        for entry in document:
+            count += 1
+            yield entry
+    except ElementTree.ParseError:
+        # Broken further down than the header, hand the rest to feedparser.
+        yield from feedparser.parse(body, response_headers=response_headers(headers, url))['entries'][count:]
+
+
+def parse_body(body, headers=None, url=''):
+    """
+    Parse a raw feed document fetched from url, raising FetchError if it
+    isn't a feed at all.
+
+    The metadata is read straight away, the entries are parsed lazily as
+    they are iterated over, in the same pass over the document.
+    """
+    document = iter_document(iter_chunks(body), url)
+    try:
+        info = next(document)
+    except ElementTree.ParseError:
+        info = None
+    if info is None:
+        return parse_lenient(body, headers, url)
+    return {'feed': info, 'entries': iter_body_entries(document, body, headers, url)}
+
+
+def open_feed(url, timeout, etag='', last_modified=''):
+    if urlsplit(url).scheme not in ('http', 'https'):
+        raise FetchError('Unsupported URL scheme: %s' % url)
+    headers = {'User-Agent': USER_AGENT}
+    headers.update(conditional_headers(etag, last_modified))
+    request = urllib.request.Request(url, headers=headers)
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+@timed_fetch
+def fetch_feed(url, timeout=None, etag='', last_modified='', content_hash=''):
+    """
+    Download the feed at url and parse it.
+
+    Pass the validators stored from the last fetch to make it a conditional
+    request, if the feed is unchanged the body isn't parsed at all.
+    """
+    timeout = timeout or get_timeout()
+    deadline = time.monotonic() + timeout
+    try:
+        with open_feed(url, timeout, etag, last_modified) as resp:
+            body = b''.join(iter_body(url, resp, deadline))
+            result = FetchResult(url, resp.status, resp.headers, body)
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return FetchResult(url, 304, e.headers, b'')
+        raise FetchError('HTTP %d fetching %s' % (e.code, url)) from e
+    except (urllib.error.URLError, OSError) as e:
+        raise HostError('Error fetching %s: %s' % (url, e)) from e
+    except ValueError as e:
+        raise FetchError('Error fetching %s: %s' % (url, e)) from e
+
+    if not result.is_unchanged(content_hash):
+        result.parsed = parse_body(result.body, result.headers, url)
+    return result
@@ -0,0 +1,300 @@
+"""
+Circuit breaking for feed fetches, per host and per feed.
+
+A host that's down costs every fetch against it a full connect timeout, and
+one host can serve hundreds of feeds. Each host's record (HostHealth) has
+its consecutive failures, last fetch latency and a circuit state:
+
+- closed: fetches go ahead. HOST_CIRCUIT_FAILURES consecutive fetches that
+  couldn't reach the host (HostError: connection errors and timeouts, not
+  HTTP errors, a host answering 404 is up) open the circuit.
+- open: fetches fail straight away with CircuitOpen, and subscribing to a
+  url on the host is refused, for HOST_CIRCUIT_COOLDOWN seconds.
+- half open: after the cooldown one fetch goes ahead as a probe while the
+  rest keep failing fast. It closes the circuit if it reaches the host and
+  opens it for another cooldown if it doesn't.
+
+Feeds have a breaker of their own in the schedule's error backoff: a feed
+that failed FEED_CIRCUIT_FAILURES times in a row isn't fetched on demand
+until its next scheduled fetch, which is the probe.
+
+HostBreaker loads the records for a refresh or a bulk refresh run, and many
+run at once (an OPML import refreshes its feeds on a thread pool), so every
+transition is a single UPDATE conditional on the state it moves from:
+failures are counted with F('failures') + 1, the circuit opens if the count
+in the row reached the threshold, and the probe is claimed by moving the
+state and opened_at it was loaded with to half open, only one fetch gets to.
+A success on a host already closed only changes its latency, that's kept in
+memory and written with the run's other writes.
+"""
+import contextlib
+import time
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from api.fetch import FetchError, HostError
+from api.models import HostHealth
+
+# Hosts loaded per query.
+LOAD_BATCH_SIZE = 500
+
+
+def get_failure_threshold():
+    return getattr(settings, 'HOST_CIRCUIT_FAILURES', 5)
+
+
+def get_cooldown():
+    return getattr(settings, 'HOST_CIRCUIT_COOLDOWN', 300)
+
+
+def host_of(url):
+    parts = urlsplit(url)
+    host = parts.hostname or ''
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    return '%s:%d' % (host, port) if port else host
+
+
+class CircuitOpen(FetchError):
+    def __init__(self, host, retry_after):
+        super().__init__('Not fetching from %s, it has been failing (retrying in %ds)' % (host, retry_after))
+        self.host = host
+        self.retry_after = retry_after
+
+
+class HostUnavailable(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_code = 'host_unavailable'
+
+    def __init__(self, error):
+        super().__init__('%s is not responding, try again later.' % error.host)
+        # DRF sends this as Retry-After.
+        self.wait = error.retry_after
+
+
+def retry_after(health, now):
+    """
+    Seconds until an open circuit lets a probe through, 0 if it would now.
+    """
+    remaining = (health.opened_at + timedelta(seconds=get_cooldown()) - now).total_seconds()
+    return max(0, int(remaining + 0.999))
+
+
+def is_healthy(health):
+    return health.state == HostHealth.STATE_CLOSED and not health.failures
+
+
+class HostBreaker:
+    """
+    Circuit state of the hosts a run of fetches touches. Not thread safe,
+    use one per refresh (or bulk refresh run, on its event loop).
+    """
+    def __init__(self, records=()):
+        self.hosts = {health.host: health for health in records}
+        # Latencies of successes not written yet, by host.
+        self.latencies = {}
+
+    @classmethod
+    def for_urls(cls, urls):
+        hosts = list({host_of(url) for url in urls})
+        records = []
+        for start in range(0, len(hosts), LOAD_BATCH_SIZE):
+            records.extend(HostHealth.objects.filter(host__in=hosts[start:start + LOAD_BATCH_SIZE]))
+        return cls(records)
+
+    @classmethod
+    async def afor_urls(cls, urls):
+        hosts = list({host_of(url) for url in urls})
+        records = []
+        for start in range(0, len(hosts), LOAD_BATCH_SIZE):
+            records.extend([health async for health in HostHealth.objects.filter(
+                host__in=hosts[start:start + LOAD_BATCH_SIZE])])
+        return cls(records)
+
+    def get(self, host):
+        health = self.hosts.get(host)
+        if health is None:
+            health = self.hosts[host] = HostHealth(host=host)
+        return health
+
+    def allow(self, url, now=None):
+        """
+        Raise CircuitOpen unless a fetch from url's host can go ahead.
+        """
+        health = self.get(host_of(url))
+        if health.state == HostHealth.STATE_CLOSED:
+            return
+        now = now or timezone.now()
+        wait = retry_after(health, now)
+        if wait:
+            raise CircuitOpen(health.host, wait)
+        # This fetch is the probe, if no one else has claimed it since the
+        # record was loaded. A half open circuit whose probe never reported
+        # back (the process died) gets a new one the same way.
+        claimed = HostHealth.objects.filter(
+            host=health.host, state=health.state, opened_at=health.opened_at,
+        ).update(state=HostHealth.STATE_HALF_OPEN, opened_at=now)
+        health.state = HostHealth.STATE_HALF_OPEN
+        health.opened_at = now
+        if claimed != 1:
+            raise CircuitOpen(health.host, retry_after(health, now))
+
+    async def aallow(self, url, now=None):
+        if self.get(host_of(url)).state != HostHealth.STATE_CLOSED:
+            await sync_to_async(self.allow)(url, now)
+
+    def record(self, url, latency, error=None):
+        """
+        Record a fetch from url's host that took latency seconds and raised
+        error (a FetchError) or not.
+        """
+        health = self.get(host_of(url))
+        health.last_latency = latency
+        if not isinstance(error, HostError):
+            # The host answered.
+            if is_healthy(health):
+                self.latencies[health.host] = latency
+                return
+            HostHealth.objects.filter(host=health.host).update(
+                state=HostHealth.STATE_CLOSED, failures=0, last_error='', opened_at=None, last_latency=latency,
+            )
+            health.state = HostHealth.STATE_CLOSED
+            health.failures = 0
+            health.last_error = ''
+            health.opened_at = None
+            return
+
+        failure = {'failures': F('failures') + 1, 'last_error': str(error), 'last_latency': latency}
+        if not HostHealth.objects.filter(host=health.host).update(**failure):
+            HostHealth.objects.bulk_create([HostHealth(host=health.host)], ignore_conflicts=True)
+            HostHealth.objects.filter(host=health.host).update(**failure)
+        HostHealth.objects.filter(
+            Q(state=HostHealth.STATE_HALF_OPEN) | Q(state=HostHealth.STATE_CLOSED, failures__gte=get_failure_threshold()),
+            host=health.host,
+        ).update(state=HostHealth.STATE_OPEN, opened_at=timezone.now())
+        health.refresh_from_db()
+
+    async def arecord(self, url, latency, error=None):
+        if not isinstance(error, HostError) and is_healthy(self.get(host_of(url))):
+            self.record(url, latency, error)
+        else:
+            await sync_to_async(self.record)(url, latency, error)
+
+    @contextlib.contextmanager
+    def guard(self, feed):
+        """
+        Wrap a fetch of feed: fail fast if its host's circuit is open,
+        otherwise record how the fetch went on the host and the feed's
+        last_latency (unsaved). FetchErrors are re-raised.
+        """
+        self.allow(feed.url)
+        started = time.monotonic()
+        try:
+            yield
+        except FetchError as e:
+            feed.last_latency = time.monotonic() - started
+            self.record(feed.url, feed.last_latency, e)
+            raise
+        feed.last_latency = time.monotonic() - started
+        self.record(feed.url, feed.last_latency)
+
+    @contextlib.asynccontextmanager
+    async def aguard(self, feed):
+        await self.aallow(feed.url)
+        started = time.monotonic()
+        try:
+            yield
+        except FetchError as e:
+            feed.last_latency = time.monotonic() - started
+            await self.arecord(feed.url, feed.last_latency, e)
+            raise
+        feed.last_latency = time.monotonic() - started
+        await self.arecord(feed.url, feed.last_latency)
+
+    def pop_changed(self):
+        """
+        The latencies recorded since the last call as HostHealth records,
+        for save_hosts.
+        """
+        records = [HostHealth(host=host, last_latency=latency) for host, latency in self.latencies.items()]
+        self.latencies.clear()
+        return records
+
+    def save(self):
+        save_hosts(self.pop_changed())
+
+    async def asave(self):
+        await HostHealth.objects.abulk_create(
+            self.pop_changed(), update_conflicts=True, unique_fields=['host'], update_fields=['last_latency'],
+        )
+
+
+def save_hosts(records):
+    """
+    Write the latencies of pop_changed's records, adding the hosts not
+    stored yet.
+    """
+    HostHealth.objects.bulk_create(
+        records, update_conflicts=True, unique_fields=['host'], update_fields=['last_latency'],
+    )
+
+
+def open_circuits(hosts):
+    return HostHealth.objects.filter(host__in=hosts).exclude(state=HostHealth.STATE_CLOSED)
+
+
+def open_circuit(url):
+    return open_circuits([host_of(url)])
+
+
+def raise_if_open(health):
+    if health is not None:
+        wait = retry_after(health, timezone.now())
+        if wait:
+            raise CircuitOpen(health.host, wait)
+
+
+def check_host(url):
+    """
+    Raise CircuitOpen if url's host circuit is open, for refusing
+    subscriptions up front. Doesn't start a probe.
+    """
+    raise_if_open(open_circuit(url).first())
+
+
+async def acheck_host(url):
+    raise_if_open(await open_circuit(url).afirst())
+
+
+def open_hosts(urls):
+    """
+    CircuitOpen errors for the hosts of urls whose circuit is open, by host,
+    check_host for many urls at once.
+    """
+    hosts = list({host_of(url) for url in urls})
+    now = timezone.now()
+    errors = {}
+    for start in range(0, len(hosts), LOAD_BATCH_SIZE):
+        for health in open_circuits(hosts[start:start + LOAD_BATCH_SIZE]):
+            wait = retry_after(health, now)
+            if wait:
+                errors[health.host] = CircuitOpen(health.host, wait)
+    return errors
+
+
+def feed_circuit_open(feed, now=None):
+    """
+    Whether the feed has failed FEED_CIRCUIT_FAILURES times in a row and
+    its backoff hasn't run out yet.
+    """
+    return (feed.error_count >= getattr(settings, 'FEED_CIRCUIT_FAILURES', 3)
+            and feed.next_fetch_at is not None and feed.next_fetch_at > (now or timezone.now()))
@@ -0,0 +1,153 @@
+"""
+Turning parsed feed entries into Article rows.
+
+Entries are deduplicated by guid and url against the keys the feed already
+has, using one query to load them into a set, and whatever is new goes in
+with chunked bulk inserts instead of one INSERT per entry. Their summaries
+and contents go into the shared, compressed body table (see api/bodies.py)
+and the new articles are then added to the search index (see api/search.py).
+The feed's subscribers are notified once it's all committed (see
+api/events.py).
+"""
+import calendar
+import itertools
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+
+from api.bodies import make_body, store_bodies
+from api.events import new_articles
+from api.models import Article, Feed
+from api.search import index_articles
+
+
+def get_chunk_size():
+    return getattr(settings, 'ARTICLE_INGEST_CHUNK_SIZE', 200)
+
+
+def truncate(value, field_name):
+    max_length = Article._meta.get_field(field_name).max_length
+    return (value or '')[:max_length]
+
+
+def entry_date(entry):
+    """
+    The entry's published (or failing that updated) date as an aware datetime.
+    """
+    parsed = entry.get('published_parsed') or entry.get('updated_parsed')
+    if not parsed:
+        return None
+    return datetime.fromtimestamp(calendar.timegm(parsed), tz=timezone.utc)
+
+
+def entry_content(entry):
+    content = entry.get('content')
+    if not content:
+        return ''
+    return content[0].get('value', '')
+
+
+def existing_keys(feed):
+    """
+    Set of every guid and url already stored for the feed.
+    """
+    keys = set()
+    for guid, url in Article.objects.filter(feed=feed).values_list('guid', 'url'):
+        keys.add(guid)
+        keys.add(url)
+    return keys
+
+
+def build_articles(feed, entries, keys):
+    """
+    Article instances for the entries whose guid/url isn't in keys. Entries
+    without a link are skipped, keys is updated as entries are accepted so
+    duplicates within the same document are dropped too.
+    """
+    loaded_at = datetime.now(timezone.utc)
+    articles = []
+    for entry in entries:
+        url = entry.get('link')
+        if not url or len(url) > Article._meta.get_field('url').max_length:
+            continue
+        guid = truncate(entry.get('id') or url, 'guid')
+        if guid in keys or url in keys:
+            continue
+        keys.add(guid)
+        keys.add(url)
+        articles.append(Article(
+            feed=feed,
+            url=url,
+            guid=guid,
+            title=truncate(entry.get('title'), 'title'),
+            summary_body=make_body(entry.get('summary', '')),
+            content_body=make_body(entry_content(entry)),
+            published_at=entry_date(entry) or loaded_at,
+        ))
+    return articles
+
+
+def inserted_articles(feed, articles):
+    """
+    The articles that bulk_create(ignore_conflicts=True) actually stored,
+    with their ids set. It doesn't set ids, so they're looked up by guid;
+    any that lost a conflict (to another feed's article with the same url,
+    say) aren't found.
+    """
+    ids = dict(Article.objects.filter(feed=feed, guid__in=[a.guid for a in articles]).values_list('guid', 'id'))
+    stored = []
+    for article in articles:
+        if article.guid in ids:
+            article.id = ids[article.guid]
+            stored.append(article)
+    return stored
+
+
+def ingest_entries(feed, entries, chunk_size=None):
+    """
+    Store the new entries of a feed, returns the Article instances that were
+    inserted.
+
+    Conflicts with rows inserted concurrently (or articles another feed
+    already owns) are ignored by the database rather than raising. Those
+    entries aren't returned, counted or published, but their keys stay in
+    the set so later duplicates in the same document are skipped too.
+
+    entries can be a generator, it is consumed a chunk at a time so the
+    parsed entries of a huge feed aren't all held at once.
+    """
+    chunk_size = chunk_size or get_chunk_size()
+    keys = existing_keys(feed)
+    entries = iter(entries)
+    articles = []
+    while True:
+        chunk = list(itertools.islice(entries, chunk_size))
+        if not chunk:
+            break
+        new = build_articles(feed, chunk, keys)
+        if new:
+            # store_bodies' locks have to last until the articles are in.
+            with transaction.atomic(savepoint=False):
+                store_bodies(body for article in new for body in (article.summary_body, article.content_body))
+                Article.objects.bulk_create(new, ignore_conflicts=True)
+            articles.extend(inserted_articles(feed, new))
+    if articles:
+        update_article_count(feed)
+        index_articles(articles)
+        new_articles(feed)
+    return articles
+
+
+def update_article_count(feed):
+    """
+    Recount the feed's articles, ignored conflicts mean we can't just add
+    the number we tried to insert.
+    """
+    totals = feed.articles.aggregate(count=Count('id'), last=Max('id'))
+    feed.article_count = totals['count']
+    feed.last_article_id = totals['last'] or 0
+    Feed.objects.filter(pk=feed.pk).update(
+        article_count=feed.article_count, last_article_id=feed.last_article_id,
+    )
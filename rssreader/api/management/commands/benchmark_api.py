@@ -0,0 +1,52 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.benchmark import ENDPOINTS, Benchmark, compare
+
+
+class Command(BaseCommand):
+    help = (
+        'Load test the API endpoints in process: seeds users, feeds and subscriptions, drives the endpoints '
+        'concurrently and reports throughput, latency percentiles and query counts for each.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100, help='Users to seed.')
+        parser.add_argument('--feeds', type=int, default=500, help='Feeds to seed.')
+        parser.add_argument('--subscriptions', type=int, default=2000,
+                            help='Subscriptions to seed, spread randomly over the users and feeds.')
+        parser.add_argument('--requests', type=int, default=200, help='Requests made to each endpoint.')
+        parser.add_argument('--concurrency', type=int, default=8, help='Threads making requests.')
+        parser.add_argument('--endpoint', action='append', choices=ENDPOINTS, dest='endpoints',
+                            help='Only benchmark this endpoint (can be repeated).')
+        parser.add_argument('--output', help='Save the results to this JSON file.')
+        parser.add_argument('--compare', help='Compare with the results saved in this JSON file.')
+
+    def handle(self, *args, **options):
+        results = Benchmark(
+            users=options['users'],
+            feeds=options['feeds'],
+            subscriptions=options['subscriptions'],
+            requests=options['requests'],
+            concurrency=options['concurrency'],
+            endpoints=options['endpoints'],
+        ).run()
+
+        for endpoint, stats in results['endpoints'].items():
+            self.stdout.write(
+                '%-15s %6.1f req/sec  p50 %7.2fms  p90 %7.2fms  p99 %7.2fms  %5.2f queries  %d errors' % (
+                    endpoint, stats['throughput'], stats['latency_ms']['p50'], stats['latency_ms']['p90'],
+                    stats['latency_ms']['p99'], stats['queries']['mean'], stats['errors'],
+                )
+            )
+        if options['compare']:
+            with open(options['compare']) as f:
+                previous = json.load(f)
+            self.stdout.write('Compared with %s:' % (previous.get('commit') or options['compare']))
+            for line in compare(previous, results):
+                self.stdout.write('  ' + line)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write('Saved results to %s' % options['output'])
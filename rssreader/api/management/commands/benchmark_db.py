@@ -0,0 +1,108 @@
+import itertools
+import random
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection, transaction
+from django.utils import timezone
+
+from api.benchmark import percentile
+from api.models import Article, Feed
+
+BENCH_PREFIX = 'https://bench.invalid/'
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure concurrent read (feed list) and write (refresh) throughput against the configured '
+        'database. Seeds its own rows and removes them afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=8, help='Threads listing feeds.')
+        parser.add_argument('--writers', type=int, default=2, help='Threads writing refresh results.')
+        parser.add_argument('--seconds', type=float, default=10, help='How long to run for.')
+        parser.add_argument('--feeds', type=int, default=200, help='Feeds to seed.')
+
+    def handle(self, *args, **options):
+        user, feed_ids = self.seed(options['feeds'])
+        self.user_id = user.id
+        self.feed_ids = feed_ids
+        self.counter = itertools.count()
+        try:
+            results = self.run(options['readers'], options['writers'], options['seconds'])
+        finally:
+            Feed.objects.filter(url__startswith=BENCH_PREFIX).delete()
+            user.delete()
+
+        settings = connection.settings_dict
+        self.stdout.write('%s %s, %s' % (connection.vendor, settings['NAME'], self.describe()))
+        for kind, (latencies, errors) in results.items():
+            self.stdout.write('%s: %d ops (%.1f/sec) p50 %.1fms p99 %.1fms, %d errors' % (
+                kind, len(latencies), len(latencies) / options['seconds'],
+                percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, errors,
+            ))
+
+    def describe(self):
+        if connection.vendor != 'sqlite':
+            return 'CONN_MAX_AGE %s' % connection.settings_dict['CONN_MAX_AGE']
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            journal_mode = cursor.fetchone()[0]
+            cursor.execute('PRAGMA synchronous')
+            synchronous = cursor.fetchone()[0]
+        # synchronous comes back as a number: 0 OFF, 1 NORMAL, 2 FULL, 3 EXTRA.
+        return 'journal_mode=%s synchronous=%s' % (journal_mode, synchronous)
+
+    def seed(self, count):
+        Feed.objects.filter(url__startswith=BENCH_PREFIX).delete()
+        User.objects.filter(username='benchmark-db').delete()
+        user = User.objects.create_user('benchmark-db')
+        Feed.objects.bulk_create([
+            Feed(url='%sfeed/%d' % (BENCH_PREFIX, i), title='Feed %d' % i, status=Feed.STATUS_OK)
+            for i in range(count)
+        ])
+        feeds = list(Feed.objects.filter(url__startswith=BENCH_PREFIX).values_list('id', flat=True))
+        Feed.users.through.objects.bulk_create([Feed.users.through(feed_id=id, user_id=user.id) for id in feeds])
+        return user, feeds
+
+    def read(self):
+        list(Feed.objects.filter(users=self.user_id).order_by('title', 'id').values_list('id', 'title')[:100])
+
+    def write(self):
+        # Roughly what storing a refresh does: update the feed and add an article.
+        feed_id = random.choice(self.feed_ids)
+        n = next(self.counter)
+        with transaction.atomic():
+            Feed.objects.filter(pk=feed_id).update(fetched_at=timezone.now())
+            Article.objects.create(feed_id=feed_id, url='%sarticle/%d' % (BENCH_PREFIX, n), guid=str(n))
+
+    def run(self, readers, writers, seconds):
+        results = {'reads': ([], []), 'writes': ([], [])}
+        deadline = time.monotonic() + seconds
+
+        def worker(op, latencies, errors):
+            try:
+                while time.monotonic() < deadline:
+                    started = time.monotonic()
+                    try:
+                        op()
+                    except OperationalError:
+                        errors.append(started)
+                        continue
+                    latencies.append(time.monotonic() - started)
+            finally:
+                connection.close()
+
+        threads = [
+            threading.Thread(target=worker, args=(self.read,) + results['reads']) for _ in range(readers)
+        ] + [
+            threading.Thread(target=worker, args=(self.write,) + results['writes']) for _ in range(writers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return {kind: (latencies, len(errors)) for kind, (latencies, errors) in results.items()}
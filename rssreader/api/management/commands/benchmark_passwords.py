@@ -0,0 +1,67 @@
+import os
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import get_hasher
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from api.benchmark import PASSWORD
+from api.passwords import make_pool
+
+
+def verify(hasher_path, encoded):
+    return import_string(hasher_path)().verify(PASSWORD, encoded)
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure logins/sec (password verifications) per core for each configured hasher, and optionally '
+        'through a process pool.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--logins', type=int, default=20, help='Verifications per hasher.')
+        parser.add_argument('--workers', type=int, default=0,
+                            help='Also run them through a pool of this many processes.')
+        parser.add_argument('--hasher', action='append', choices=list(settings.PASSWORD_HASHER_CLASSES),
+                            dest='hashers', help='Only benchmark this hasher (can be repeated).')
+
+    def handle(self, *args, **options):
+        pool = None
+        if options['workers']:
+            pool = make_pool(options['workers'])
+        self.stdout.write('%d cores, preferred hasher %s (%s)' % (
+            os.cpu_count(), settings.PASSWORD_HASHER, get_hasher().algorithm,
+        ))
+        try:
+            for name in options['hashers'] or settings.PASSWORD_HASHER_CLASSES:
+                self.run(name, options['logins'], pool, options['workers'])
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def run(self, name, logins, pool, workers):
+        path = settings.PASSWORD_HASHER_CLASSES[name]
+        hasher = import_string(path)()
+        try:
+            encoded = hasher.encode(PASSWORD, hasher.salt())
+        except ValueError as e:
+            # The hasher's library isn't installed.
+            self.stdout.write('%-7s skipped: %s' % (name, e))
+            return
+
+        started = time.monotonic()
+        for _ in range(logins):
+            hasher.verify(PASSWORD, encoded)
+        elapsed = time.monotonic() - started
+        line = '%-7s %8.1fms/login  %6.1f logins/sec/core' % (name, elapsed / logins * 1000, logins / elapsed)
+
+        if pool is not None:
+            # Start the workers before timing.
+            list(pool.map(verify, [path] * workers, [encoded] * workers))
+            started = time.monotonic()
+            list(pool.map(verify, [path] * logins, [encoded] * logins))
+            elapsed = time.monotonic() - started
+            line += '  %6.1f logins/sec with %d workers' % (logins / elapsed, workers)
+        self.stdout.write(line)
@@ -0,0 +1,79 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from api.models import Feed
+from api.renderers import MessagePackRenderer, ORJSONRenderer, msgpack
+from api.serializers import FeedSerializer
+
+BENCH_PREFIX = 'https://bench.invalid/render/'
+
+
+def best_of(repeat, fn):
+    """
+    fn's result and its fastest time out of repeat runs.
+    """
+    times = []
+    for _ in range(repeat):
+        started = time.monotonic()
+        result = fn()
+        times.append(time.monotonic() - started)
+    return result, min(times)
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare the feed list serialization and rendering paths: ModelSerializer over model instances '
+        'against values_list() rows, and json against orjson (and MessagePack). Seeds its own feeds and '
+        'removes them afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--feeds', type=int, default=10000, help='Feeds the user follows.')
+        parser.add_argument('--repeat', type=int, default=5, help='Runs of each, the fastest is reported.')
+
+    def handle(self, *args, **options):
+        self.cleanup()
+        try:
+            user = self.seed(options['feeds'])
+            queryset = Feed.objects.filter(users=user.id).order_by('title', 'id')
+            fields = list(FeedSerializer.Meta.fields)
+            repeat = options['repeat']
+
+            instances, seconds = best_of(repeat, lambda: FeedSerializer(list(queryset), many=True).data)
+            self.report('ModelSerializer', len(instances), seconds)
+            rows, seconds = best_of(repeat, lambda: FeedSerializer.values_data(
+                FeedSerializer.values_queryset(queryset, fields), fields,
+            ))
+            self.report('values_list rows', len(rows), seconds)
+
+            renderers = [('json', JSONRenderer()), ('orjson', ORJSONRenderer())]
+            if msgpack is not None:
+                renderers.append(('msgpack', MessagePackRenderer()))
+            data = {'next': None, 'results': rows}
+            for name, renderer in renderers:
+                body, seconds = best_of(repeat, lambda: renderer.render(data))
+                self.stdout.write('%-16s %8.1fms  %7d bytes' % ('render ' + name, seconds * 1000, len(body)))
+        finally:
+            self.cleanup()
+
+    def report(self, name, count, seconds):
+        self.stdout.write('%-16s %8.1fms  %7.0f feeds/sec' % (name, seconds * 1000, count / seconds))
+
+    def cleanup(self):
+        Feed.objects.filter(url__startswith=BENCH_PREFIX).delete()
+        User.objects.filter(username='benchmark-render').delete()
+
+    def seed(self, feeds):
+        user = User.objects.create_user('benchmark-render')
+        Feed.objects.bulk_create([
+            Feed(url='%sfeed/%d' % (BENCH_PREFIX, i), title='Feed %d' % i, status=Feed.STATUS_OK)
+            for i in range(feeds)
+        ])
+        feed_ids = Feed.objects.filter(url__startswith=BENCH_PREFIX).values_list('id', flat=True)
+        Feed.users.through.objects.bulk_create([
+            Feed.users.through(feed_id=id, user_id=user.id) for id in feed_ids
+        ])
+        return user
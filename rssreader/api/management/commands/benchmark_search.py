@@ -0,0 +1,100 @@
+import itertools
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from api.benchmark import percentile
+from api.models import Article, Feed
+from api.bodies import delete_orphan_bodies, make_body, store_bodies
+from api.search import add_documents, search_articles
+
+BENCH_PREFIX = 'https://bench.invalid/search/'
+BATCH_SIZE = 5000
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure search latency over a generated article corpus. Seeds its own rows (word frequencies '
+        'roughly Zipfian) and removes them afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--articles', type=int, default=100000, help='Articles to seed.')
+        parser.add_argument('--feeds', type=int, default=1000, help='Feeds to spread them over.')
+        parser.add_argument('--subscriptions', type=int, default=200, help='Feeds the searching user follows.')
+        parser.add_argument('--vocabulary', type=int, default=50000, help='Distinct words.')
+        parser.add_argument('--queries', type=int, default=50, help='Searches per kind of query.')
+
+    def handle(self, *args, **options):
+        random.seed(0)
+        self.words = ['w%d' % i for i in range(options['vocabulary'])]
+        self.cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(self.words))))
+        self.cleanup()
+        try:
+            started = time.monotonic()
+            user = self.seed(options['articles'], options['feeds'], options['subscriptions'])
+            self.stdout.write('Seeded %d articles in %.1fs' % (options['articles'], time.monotonic() - started))
+            words = self.words
+            # Common terms are matched by most articles, see api/search.py.
+            kinds = {
+                'common word': lambda: words[random.randrange(10)],
+                'mid word': lambda: words[random.randrange(100, 1000)],
+                'rare word': lambda: words[random.randrange(10000, len(words))],
+                'two words': lambda: '%s %s' % (words[random.randrange(50)], words[random.randrange(50, 500)]),
+                'common + rare': lambda: '%s %s' % (words[random.randrange(10)], words[random.randrange(10000, len(words))]),
+            }
+            for kind, make_query in kinds.items():
+                latencies = []
+                for _ in range(options['queries']):
+                    query = make_query()
+                    started = time.monotonic()
+                    search_articles(user, query, 20)
+                    latencies.append(time.monotonic() - started)
+                self.stdout.write('%s: p50 %.1fms p99 %.1fms' % (
+                    kind, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+                ))
+        finally:
+            self.cleanup()
+
+    def cleanup(self):
+        Feed.objects.filter(url__startswith=BENCH_PREFIX).delete()
+        User.objects.filter(username='benchmark-search').delete()
+        delete_orphan_bodies()
+
+    def text(self, count):
+        return ' '.join(random.choices(self.words, cum_weights=self.cum_weights, k=count))
+
+    def seed(self, articles, feeds, subscriptions):
+        user = User.objects.create_user('benchmark-search')
+        Feed.objects.bulk_create([
+            Feed(url='%sfeed/%d' % (BENCH_PREFIX, i), title='Feed %d' % i, status=Feed.STATUS_OK)
+            for i in range(feeds)
+        ])
+        feed_ids = list(Feed.objects.filter(url__startswith=BENCH_PREFIX).values_list('id', flat=True))
+        Feed.users.through.objects.bulk_create([
+            Feed.users.through(feed_id=id, user_id=user.id) for id in random.sample(feed_ids, subscriptions)
+        ])
+        now = timezone.now()
+        last_id = 0
+        for start in range(0, articles, BATCH_SIZE):
+            batch = [
+                Article(
+                    feed_id=random.choice(feed_ids), url='%sarticle/%d' % (BENCH_PREFIX, n), guid=str(n),
+                    title=self.text(6), summary_body=make_body(self.text(60)), published_at=now,
+                )
+                for n in range(start, min(start + BATCH_SIZE, articles))
+            ]
+            with transaction.atomic():
+                store_bodies(article.summary_body for article in batch)
+                Article.objects.bulk_create(batch)
+                ids = dict(Article.objects.filter(id__gt=last_id, url__startswith=BENCH_PREFIX).values_list('guid', 'id'))
+                add_documents([(ids[a.guid], a.title, a.summary, a.content) for a in batch])
+                last_id = max(ids.values())
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+        return user
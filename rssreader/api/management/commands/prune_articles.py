@@ -0,0 +1,60 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from api.models import Feed
+from api.retention import Archive, Pruner
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete articles past their feed's retention policy (the newest N or the last D days are kept) in "
+        'batches, never ones a subscriber hasn\'t read, and report rows/sec.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('feed_ids', nargs='*', type=int,
+                            help='Only prune these feeds (default: all feeds).')
+        parser.add_argument('--keep', type=int,
+                            help="Newest articles kept per feed, for feeds without their own (default: "
+                                 "ARTICLE_RETENTION_COUNT).")
+        parser.add_argument('--days', type=int,
+                            help="Days of articles kept per feed, for feeds without their own (default: "
+                                 "ARTICLE_RETENTION_DAYS).")
+        parser.add_argument('--batch-size', type=int,
+                            help='Articles deleted per transaction.')
+        parser.add_argument('--archive',
+                            help='Write the pruned articles to a gzipped JSON lines file in this directory.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be pruned.')
+
+    def handle(self, *args, **options):
+        feeds = Feed.objects.all()
+        if options['feed_ids']:
+            feeds = feeds.filter(pk__in=options['feed_ids'])
+
+        archive = None
+        if options['archive'] and not options['dry_run']:
+            if not os.path.isdir(options['archive']):
+                raise CommandError('%s is not a directory' % options['archive'])
+            name = 'articles-%s.jsonl.gz' % timezone.now().strftime('%Y%m%dT%H%M%S')
+            archive = Archive(os.path.join(options['archive'], name))
+
+        pruner = Pruner(
+            count=options['keep'],
+            days=options['days'],
+            batch_size=options['batch_size'],
+            archive=archive,
+            dry_run=options['dry_run'],
+        )
+        try:
+            stats = pruner.run(feeds)
+        finally:
+            if archive is not None:
+                archive.close()
+        if options['dry_run']:
+            self.stdout.write('Dry run, nothing deleted.')
+        self.stdout.write(stats.summary())
+        if archive is not None:
+            self.stdout.write('Archived to %s' % archive.path)
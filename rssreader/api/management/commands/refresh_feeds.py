@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from api.bulk_refresh import BulkRefresher
+from api.models import Feed
+from api.refresh import REFRESH_LOAD_FIELDS
+
+
+class Command(BaseCommand):
+    help = 'Refresh feeds concurrently and report throughput and fetch latency.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('feed_ids', nargs='*', type=int,
+                            help='Only refresh these feeds (default: all feeds).')
+        parser.add_argument('--concurrency', type=int,
+                            help='Max fetches in flight overall.')
+        parser.add_argument('--per-host', type=int,
+                            help='Max fetches in flight against a single host.')
+        parser.add_argument('--batch-size', type=int,
+                            help='Number of feeds written back per batch.')
+        parser.add_argument('--timeout', type=float,
+                            help='Seconds before a single fetch is abandoned.')
+
+    def handle(self, *args, **options):
+        feeds = Feed.objects.only(*REFRESH_LOAD_FIELDS)
+        if options['feed_ids']:
+            feeds = feeds.filter(pk__in=options['feed_ids'])
+
+        refresher = BulkRefresher(
+            concurrency=options['concurrency'],
+            per_host=options['per_host'],
+            batch_size=options['batch_size'],
+            timeout=options['timeout'],
+        )
+        stats = refresher.run(feeds)
+        self.stdout.write(stats.summary())
@@ -0,0 +1,31 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from api.scheduler import FeedScheduler
+
+
+class Command(BaseCommand):
+    help = 'Keep refreshing feeds as they come due, based on how often each one changes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Refresh whatever is due now and exit.')
+        parser.add_argument('--max-batch', type=int, default=1000,
+                            help='Max feeds refreshed per tick.')
+        parser.add_argument('--reload-every', type=int, default=60,
+                            help='Seconds between reloads of the due feeds from the database.')
+
+    def handle(self, *args, **options):
+        scheduler = FeedScheduler(
+            max_batch=options['max_batch'],
+            reload_every=timedelta(seconds=options['reload_every']),
+        )
+        if options['once']:
+            self.report(scheduler.tick())
+            return
+        scheduler.run(on_tick=self.report)
+
+    def report(self, feeds):
+        if feeds:
+            self.stdout.write('Refreshed %d due feeds' % len(feeds))
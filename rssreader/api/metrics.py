@@ -0,0 +1,283 @@
+"""
+Request and feed fetch instrumentation, exposed in the Prometheus text format
+at /metrics.
+
+MetricsMiddleware records each request's latency, number of queries and time
+spent in the database, labelled by url name. Queries are counted by a
+database execute wrapper that reports to whichever request is current in
+the context, so it covers the async views' sync_to_async calls too. Feed
+fetch times come from the timed_fetch decorator on the fetch functions.
+
+Everything is off unless METRICS_ENABLED is set (or a slow request threshold
+is), in which case the middleware removes itself from the stack. The
+numbers are per process.
+"""
+import bisect
+import contextlib
+import contextvars
+import functools
+import logging
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+
+def is_enabled():
+    return getattr(settings, 'METRICS_ENABLED', False)
+
+
+def is_active():
+    """
+    Whether requests need instrumenting at all, for metrics or slow request
+    logging.
+    """
+    return (is_enabled() or getattr(settings, 'METRICS_SLOW_REQUEST_SECONDS', None) is not None
+            or getattr(settings, 'METRICS_SLOW_REQUEST_QUERIES', None) is not None)
+
+
+def format_labels(names, values):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join('%s="%s"' % (name, escape(value)) for name, value in zip(names, values))
+
+
+class Counter:
+    def __init__(self, name, help, labelnames):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s counter' % self.name]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append('%s{%s} %d' % (self.name, format_labels(self.labelnames, labels), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames, buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # labels -> [count per bucket (the last is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [0] * (len(self.buckets) + 1) + [0]
+            entry[bisect.bisect_left(self.buckets, value)] += 1
+            entry[-1] += value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self._lock:
+            for labels, entry in sorted(self._values.items()):
+                prefix = format_labels(self.labelnames, labels)
+                cumulative = 0
+                for le, count in zip(self.buckets + ('+Inf',), entry[:-1]):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, prefix, le, cumulative))
+                lines.append('%s_sum{%s} %s' % (self.name, prefix, repr(float(entry[-1]))))
+                lines.append('%s_count{%s} %d' % (self.name, prefix, cumulative))
+        return lines
+
+
+requests_total = Counter(
+    'rssreader_requests_total', 'Requests by url name, method and status.', ('view', 'method', 'status'))
+request_seconds = Histogram(
+    'rssreader_request_duration_seconds', 'Request latency by url name.', ('view', 'method'))
+request_queries = Histogram(
+    'rssreader_request_db_queries', 'Database queries per request by url name.', ('view', 'method'),
+    buckets=QUERY_BUCKETS)
+request_db_seconds = Histogram(
+    'rssreader_request_db_duration_seconds', 'Time per request spent in the database by url name.',
+    ('view', 'method'))
+fetch_seconds = Histogram(
+    'rssreader_feed_fetch_duration_seconds', 'Outbound feed fetch time by outcome.', ('outcome',))
+
+METRICS = [requests_total, request_seconds, request_queries, request_db_seconds, fetch_seconds]
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def clear():
+    for metric in METRICS:
+        metric.clear()
+
+
+class RequestStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    stats = current_request.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.queries += 1
+        stats.db_seconds += time.perf_counter() - started
+
+
+def instrument(connection, **kwargs):
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+def install():
+    """
+    Count the queries of every connection opened from now on, including the
+    ones sync_to_async threads open. Called on startup when is_active().
+    """
+    connection_created.connect(instrument, dispatch_uid='api.metrics.instrument')
+
+
+@contextlib.contextmanager
+def track_queries():
+    """
+    Count the queries made in this context on instrumented connections. A
+    nested context's queries count towards the outer one as well.
+    """
+    parent = current_request.get()
+    stats = RequestStats()
+    token = current_request.set(stats)
+    try:
+        yield stats
+    finally:
+        current_request.reset(token)
+        if parent is not None:
+            parent.queries += stats.queries
+            parent.db_seconds += stats.db_seconds
+
+
+class MetricsMiddleware:
+    """
+    Records request metrics and logs slow or chatty requests. Put it first
+    in MIDDLEWARE so it times the whole stack.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.slow_seconds = getattr(settings, 'METRICS_SLOW_REQUEST_SECONDS', None)
+        self.slow_queries = getattr(settings, 'METRICS_SLOW_REQUEST_QUERIES', None)
+        if not is_active():
+            raise MiddlewareNotUsed
+        self.enabled = is_enabled()
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        install()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        # In case this thread connected before install().
+        for connection in connections.all(initialized_only=True):
+            instrument(connection)
+        with track_queries() as stats:
+            response = self.get_response(request)
+        self.record(request, response, stats)
+        return response
+
+    async def __acall__(self, request):
+        with track_queries() as stats:
+            response = await self.get_response(request)
+        self.record(request, response, stats)
+        return response
+
+    def record(self, request, response, stats):
+        elapsed = time.perf_counter() - stats.started
+        match = getattr(request, 'resolver_match', None)
+        view = (match.view_name if match else None) or 'unresolved'
+        if self.enabled:
+            requests_total.inc(view, request.method, response.status_code)
+            request_seconds.observe(elapsed, view, request.method)
+            request_queries.observe(stats.queries, view, request.method)
+            request_db_seconds.observe(stats.db_seconds, view, request.method)
+        if ((self.slow_seconds is not None and elapsed > self.slow_seconds)
+                or (self.slow_queries is not None and stats.queries > self.slow_queries)):
+            logger.warning('Slow request %s %s (%s): %.3fs, %d queries (%.3fs in the database)',
+                           request.method, request.get_full_path(), view, elapsed, stats.queries, stats.db_seconds)
+
+
+def fetch_outcome(result):
+    return 'not_modified' if getattr(result, 'status', None) == 304 else 'ok'
+
+
+def timed_fetch(fetch):
+    """
+    Decorator recording how long a (sync or async) fetch function takes.
+    """
+    if iscoroutinefunction(fetch):
+        @functools.wraps(fetch)
+        async def wrapper(*args, **kwargs):
+            if not is_enabled():
+                return await fetch(*args, **kwargs)
+            started = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = await fetch(*args, **kwargs)
+                outcome = fetch_outcome(result)
+                return result
+            finally:
+                fetch_seconds.observe(time.perf_counter() - started, outcome)
+        return wrapper
+
+    @functools.wraps(fetch)
+    def wrapper(*args, **kwargs):
+        if not is_enabled():
+            return fetch(*args, **kwargs)
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = fetch(*args, **kwargs)
+            outcome = fetch_outcome(result)
+            return result
+        finally:
+            fetch_seconds.observe(time.perf_counter() - started, outcome)
+    return wrapper
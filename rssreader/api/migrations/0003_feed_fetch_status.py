@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:38
+
+from django.db import migrations, models
+
+
+def mark_existing_feeds_ok(apps, schema_editor):
+    # Feeds added before the fetch workers existed were fetched inline.
+    Feed = apps.get_model('api', 'Feed')
+    Feed.objects.all().update(status='ok')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_auto_20201006_0237'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='description',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='fetched_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='last_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='link',
+            field=models.CharField(blank=True, max_length=1000),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('ok', 'OK'), ('error', 'Error')], default='pending', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='feed',
+            name='title',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+        migrations.RunPython(mark_existing_feeds_ok, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_feed_conditional_get'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Article',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.CharField(max_length=1000, unique=True)),
+                ('guid', models.CharField(max_length=1000)),
+                ('title', models.CharField(blank=True, max_length=1000)),
+                ('summary', models.TextField(blank=True)),
+                ('content', models.TextField(blank=True)),
+                ('published_at', models.DateTimeField(blank=True, null=True)),
+                ('loaded_at', models.DateTimeField(auto_now_add=True)),
+                ('feed', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='articles', to='api.feed')),
+            ],
+            options={
+                'ordering': ['-published_at', '-id'],
+                'constraints': [models.UniqueConstraint(fields=('feed', 'guid'), name='unique_article_guid_per_feed')],
+            },
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def count_articles(apps, schema_editor):
+    Feed = apps.get_model('api', 'Feed')
+    for feed in Feed.objects.annotate(count=models.Count('articles'), last=models.Max('articles__id')):
+        if feed.count:
+            Feed.objects.filter(pk=feed.pk).update(article_count=feed.count, last_article_id=feed.last)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_article'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='feed',
+            name='article_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='last_article_id',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ReadState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('read_up_to', models.PositiveIntegerField(default=0)),
+                ('exceptions', models.BinaryField(default=b'')),
+                ('read_count', models.PositiveIntegerField(default=0)),
+                ('feed', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='api.feed')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'feed'), name='unique_read_state_per_user_feed')],
+            },
+        ),
+        migrations.RunPython(count_articles, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_read_state'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='feed',
+            options={'ordering': ['title', 'id']},
+        ),
+        migrations.AddIndex(
+            model_name='feed',
+            index=models.Index(fields=['title', 'id'], name='feed_title_id_idx'),
+        ),
+    ]
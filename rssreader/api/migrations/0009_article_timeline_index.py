@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:06
+
+from django.db import migrations, models
+
+
+def date_undated_articles(apps, schema_editor):
+    # The timeline pages on published_at, so it can't be null.
+    Article = apps.get_model('api', 'Article')
+    Article.objects.filter(published_at__isnull=True).update(published_at=models.F('loaded_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_feed_schedule'),
+    ]
+
+    operations = [
+        migrations.RunPython(date_undated_articles, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['feed', '-published_at', '-id'], name='article_feed_timeline_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:10
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def create_versions(apps, schema_editor):
+    # Feed lists are only cached for users with a version row, every
+    # subscription made from now on creates one.
+    Feed = apps.get_model('api', 'Feed')
+    SubscriptionVersion = apps.get_model('api', 'SubscriptionVersion')
+    user_ids = Feed.users.through.objects.values_list('user_id', flat=True).distinct()
+    SubscriptionVersion.objects.bulk_create(
+        [SubscriptionVersion(user_id=user_id) for user_id in user_ids], ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_article_timeline_index'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubscriptionVersion',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('version', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_versions, migrations.RunPython.noop),
+    ]
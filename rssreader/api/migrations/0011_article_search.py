@@ -0,0 +1,90 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:02
+
+from django.conf import settings
+from django.db import migrations
+from django.utils.html import strip_tags
+
+BATCH_SIZE = 1000
+
+# Frozen copies of api/search.py's DDL as of this migration, later changes to
+# the index don't change what it creates.
+SQLITE_CREATE = [
+    "CREATE VIRTUAL TABLE api_article_search USING fts5(title, body, "
+    "tokenize='porter unicode61 remove_diacritics 2')",
+    'CREATE TRIGGER IF NOT EXISTS api_article_search_delete AFTER DELETE ON api_article BEGIN '
+    'DELETE FROM api_article_search WHERE rowid = old.id; END',
+]
+SQLITE_DROP = [
+    'DROP TRIGGER IF EXISTS api_article_search_delete',
+    'DROP TABLE IF EXISTS api_article_search',
+]
+SQLITE_INSERT = 'INSERT OR REPLACE INTO api_article_search (rowid, title, body) VALUES (%s, %s, %s)'
+
+POSTGRESQL_CREATE = [
+    'CREATE TABLE api_article_search (article_id integer PRIMARY KEY REFERENCES api_article (id) '
+    'ON DELETE CASCADE, document tsvector NOT NULL)',
+    'CREATE INDEX api_article_search_document ON api_article_search USING gin (document)',
+]
+POSTGRESQL_DROP = ['DROP TABLE IF EXISTS api_article_search']
+POSTGRESQL_INSERT = (
+    'INSERT INTO api_article_search (article_id, document) VALUES (%s, '
+    "setweight(to_tsvector(%s::regconfig, %s), 'A') || setweight(to_tsvector(%s::regconfig, %s), 'B')) "
+    'ON CONFLICT (article_id) DO NOTHING'
+)
+
+
+def execute_all(connection, statements):
+    with connection.cursor() as cursor:
+        for sql in statements:
+            cursor.execute(sql)
+
+
+def add_documents(connection, rows):
+    rows = [(id, title, strip_tags('%s %s' % (summary, content))) for id, title, summary, content in rows]
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.executemany(SQLITE_INSERT, rows)
+        else:
+            config = getattr(settings, 'SEARCH_CONFIG', 'english')
+            cursor.executemany(POSTGRESQL_INSERT, [(id, config, title, config, body) for id, title, body in rows])
+
+
+def create_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        execute_all(connection, SQLITE_CREATE)
+    elif connection.vendor == 'postgresql':
+        execute_all(connection, POSTGRESQL_CREATE)
+    else:
+        # No full-text index, search falls back to icontains.
+        return
+    Article = apps.get_model('api', 'Article')
+    last_id = 0
+    while True:
+        rows = list(
+            Article.objects.filter(id__gt=last_id).order_by('id')
+            .values_list('id', 'title', 'summary', 'content')[:BATCH_SIZE]
+        )
+        if not rows:
+            break
+        add_documents(connection, rows)
+        last_id = rows[-1][0]
+
+
+def drop_search_index(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        execute_all(connection, SQLITE_DROP)
+    elif connection.vendor == 'postgresql':
+        execute_all(connection, POSTGRESQL_DROP)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_subscription_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,115 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:31
+
+import hashlib
+import zlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+# Frozen copies of api/bodies.py's hashing and compression and 0011's search
+# trigger as of this migration.
+COMPRESS_LEVEL = 6
+SQLITE_SEARCH_TRIGGER = (
+    'CREATE TRIGGER IF NOT EXISTS api_article_search_delete AFTER DELETE ON api_article BEGIN '
+    'DELETE FROM api_article_search WHERE rowid = old.id; END'
+)
+
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf8')).hexdigest()
+
+
+def compress(text):
+    return zlib.compress(text.encode('utf8'), COMPRESS_LEVEL)
+
+
+def move_bodies(apps, schema_editor):
+    # Summaries and contents move to ArticleBody, one row per distinct text.
+    Article = apps.get_model('api', 'Article')
+    ArticleBody = apps.get_model('api', 'ArticleBody')
+    last_id = 0
+    while True:
+        articles = list(
+            Article.objects.filter(id__gt=last_id).order_by('id').only('id', 'summary', 'content')[:BATCH_SIZE]
+        )
+        if not articles:
+            break
+        bodies = {}
+        for article in articles:
+            for field in ('summary', 'content'):
+                text = getattr(article, field)
+                key = hash_text(text) if text else None
+                if key and key not in bodies:
+                    bodies[key] = ArticleBody(hash=key, data=compress(text), size=len(text.encode('utf8')))
+                setattr(article, field + '_body_id', key)
+        ArticleBody.objects.bulk_create(bodies.values(), ignore_conflicts=True)
+        Article.objects.bulk_update(articles, ['summary_body', 'content_body'])
+        last_id = articles[-1].id
+
+
+def restore_bodies(apps, schema_editor):
+    Article = apps.get_model('api', 'Article')
+    last_id = 0
+    while True:
+        articles = list(
+            Article.objects.filter(id__gt=last_id).order_by('id').select_related('summary_body', 'content_body')
+            [:BATCH_SIZE]
+        )
+        if not articles:
+            break
+        for article in articles:
+            for field in ('summary', 'content'):
+                body = getattr(article, field + '_body')
+                setattr(article, field, zlib.decompress(body.data).decode('utf8') if body else '')
+        Article.objects.bulk_update(articles, ['summary', 'content'])
+        last_id = articles[-1].id
+
+
+def recreate_search_trigger(apps, schema_editor):
+    # Rebuilding api_article on SQLite drops the search index's trigger.
+    # PostgreSQL's index is a foreign key, which survives.
+    connection = schema_editor.connection
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute(SQLITE_SEARCH_TRIGGER)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_article_search'),
+    ]
+
+    operations = [
+        # Reverse runs last, after api_article has been rebuilt back.
+        migrations.RunPython(migrations.RunPython.noop, recreate_search_trigger),
+        migrations.CreateModel(
+            name='ArticleBody',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('data', models.BinaryField()),
+                ('size', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='content_body',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='content_of', to='api.articlebody'),
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='summary_body',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='summary_of', to='api.articlebody'),
+        ),
+        migrations.RunPython(move_bodies, restore_bodies),
+        migrations.RemoveField(
+            model_name='article',
+            name='content',
+        ),
+        migrations.RemoveField(
+            model_name='article',
+            name='summary',
+        ),
+        migrations.RunPython(recreate_search_trigger, migrations.RunPython.noop),
+    ]
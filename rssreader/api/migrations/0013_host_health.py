@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_article_bodies'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HostHealth',
+            fields=[
+                ('host', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('state', models.CharField(choices=[('closed', 'Closed'), ('open', 'Open'), ('half_open', 'Half open')], default='closed', max_length=10)),
+                ('failures', models.PositiveIntegerField(default=0)),
+                ('last_latency', models.FloatField(blank=True, null=True)),
+                ('last_error', models.TextField(blank=True)),
+                ('opened_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='feed',
+            name='last_latency',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
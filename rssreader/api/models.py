@@ -1,13 +1,178 @@
+import zlib
+from functools import cached_property
+
 from django.contrib.auth.models import User
 from django.db import models
 
 class Feed(models.Model):
+    STATUS_PENDING = 'pending'
+    STATUS_OK = 'ok'
+    STATUS_ERROR = 'error'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_OK, 'OK'),
+        (STATUS_ERROR, 'Error'),
+    ]
+
     url = models.CharField(max_length=1000, unique=True)
-    title = models.CharField(max_length=100)
+    title = models.CharField(max_length=100, blank=True)
     users = models.ManyToManyField(User)
+    # Filled in by the background fetch workers.
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    link = models.CharField(max_length=1000, blank=True)
+    description = models.TextField(blank=True)
+    last_error = models.TextField(blank=True)
+    fetched_at = models.DateTimeField(null=True, blank=True)
+    # Validators from the last successful fetch, used for conditional GETs.
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    content_hash = models.CharField(max_length=64, blank=True)
+    # Kept up to date by article ingestion so unread counts don't have to
+    # count articles.
+    article_count = models.PositiveIntegerField(default=0)
+    last_article_id = models.PositiveIntegerField(default=0)
+    # Refresh scheduling (see api/schedule.py). A null next_fetch_at means
+    # due right away.
+    next_fetch_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    fetch_interval = models.PositiveIntegerField(default=60 * 60)
+    changed_at = models.DateTimeField(null=True, blank=True)
+    error_count = models.PositiveIntegerField(default=0)
+    # Seconds the last fetch took, successful or not.
+    last_latency = models.FloatField(null=True, blank=True)
+    # Retention (see api/retention.py): articles kept whatever their age, and
+    # days they're kept whatever their number. Null uses the settings.
+    retention_count = models.PositiveIntegerField(null=True, blank=True)
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
 
     class Meta:
-        ordering = ['title']
+        ordering = ['title', 'id']
+        indexes = [
+            # Keyset pagination of the feed list (see api/pagination.py).
+            models.Index(fields=['title', 'id'], name='feed_title_id_idx'),
+        ]
+
+    def __str__(self):
+        return self.title or self.url
+
+class HostHealth(models.Model):
+    """
+    How fetches from a feed host have been going, and its circuit breaker
+    state (see api/health.py).
+    """
+    STATE_CLOSED = 'closed'
+    STATE_OPEN = 'open'
+    STATE_HALF_OPEN = 'half_open'
+    STATE_CHOICES = [
+        (STATE_CLOSED, 'Closed'),
+        (STATE_OPEN, 'Open'),
+        (STATE_HALF_OPEN, 'Half open'),
+    ]
+
+    # Hostname, with the port if the urls give one.
+    host = models.CharField(max_length=255, primary_key=True)
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default=STATE_CLOSED)
+    # Consecutive fetches that couldn't reach the host.
+    failures = models.PositiveIntegerField(default=0)
+    last_latency = models.FloatField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    # When the circuit last opened, or went half open for a probe.
+    opened_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return '%s: %s' % (self.host, self.state)
+
+
+class ArticleBody(models.Model):
+    """
+    An article summary or content, stored once however many articles share
+    it (see api/bodies.py). Keyed by the sha256 of the text, zlib compressed.
+    """
+    hash = models.CharField(max_length=64, primary_key=True)
+    data = models.BinaryField()
+    # Uncompressed size in bytes.
+    size = models.PositiveIntegerField()
+
+    @cached_property
+    def text(self):
+        return zlib.decompress(self.data).decode('utf8')
+
+    def __str__(self):
+        return self.hash
+
+
+class Article(models.Model):
+    url = models.CharField(max_length=1000, unique=True)
+    # The entry's id/guid from the feed, falls back to the url.
+    guid = models.CharField(max_length=1000)
+    feed = models.ForeignKey(Feed, on_delete=models.CASCADE, related_name='articles')
+    title = models.CharField(max_length=1000, blank=True)
+    # Null when empty.
+    summary_body = models.ForeignKey(
+        ArticleBody, null=True, blank=True, on_delete=models.PROTECT, related_name='summary_of',
+    )
+    content_body = models.ForeignKey(
+        ArticleBody, null=True, blank=True, on_delete=models.PROTECT, related_name='content_of',
+    )
+    # Entries without a date get the time they were loaded.
+    published_at = models.DateTimeField(null=True, blank=True)
+    loaded_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-published_at', '-id']
+        constraints = [
+            models.UniqueConstraint(fields=['feed', 'guid'], name='unique_article_guid_per_feed'),
+        ]
+        indexes = [
+            # Newest first range scans per feed for the timeline (see api/timeline.py).
+            models.Index(fields=['feed', '-published_at', '-id'], name='article_feed_timeline_idx'),
+        ]
+
+    def __str__(self):
+        return self.title or self.url
+
+    # Each of these is a query unless the body was loaded with
+    # select_related/prefetch_related (see api.bodies.load_bodies).
+    @property
+    def summary(self):
+        return self.summary_body.text if self.summary_body_id else ''
+
+    @property
+    def content(self):
+        return self.content_body.text if self.content_body_id else ''
+
+
+class ReadState(models.Model):
+    """
+    A user's read state for one feed.
+
+    Rather than a row per user per article, every article with an id up to
+    read_up_to counts as read and everything newer as unread. The ids that
+    break that rule (unread at or below the mark, read above it) are kept in
+    exceptions, a compressed bitmap (see api/bitmap.py). read_count tracks how
+    many of the feed's articles are read so unread counts are a subtraction.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    feed = models.ForeignKey(Feed, on_delete=models.CASCADE, related_name='read_states')
+    read_up_to = models.PositiveIntegerField(default=0)
+    exceptions = models.BinaryField(default=b'')
+    read_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'feed'], name='unique_read_state_per_user_feed'),
+        ]
+
+    def __str__(self):
+        return '%s: %s' % (self.user, self.feed)
+
+
+class SubscriptionVersion(models.Model):
+    """
+    Counter bumped whenever something a user's feed list shows changes, the
+    cached feed list responses are keyed on it (see api/feedcache.py).
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    version = models.PositiveIntegerField(default=0)
 
     def __str__(self):
-        return self.title
+        return '%s: %d' % (self.user, self.version)
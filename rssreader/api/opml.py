@@ -0,0 +1,26 @@
+"""
+Reading feed urls out of OPML subscription exports.
+"""
+from xml.etree import ElementTree
+
+
+class OPMLError(ValueError):
+    pass
+
+
+def parse_opml(data):
+    """
+    Return the xmlUrl of every outline in the document, in document order.
+    Folders are just nested outlines so they're flattened out.
+    """
+    try:
+        root = ElementTree.fromstring(data)
+    except ElementTree.ParseError as e:
+        raise OPMLError('Invalid OPML: %s' % e)
+    if root.tag != 'opml':
+        raise OPMLError('Invalid OPML: root element is <%s>' % root.tag)
+    return [
+        outline.get('xmlUrl').strip()
+        for outline in root.iter('outline')
+        if outline.get('xmlUrl')
+    ]
@@ -0,0 +1,89 @@
+"""
+Keyset (cursor) pagination for the feed list (and the timeline, see
+api/timeline.py).
+
+DRF's CursorPagination positions on a single field and falls back to offsets
+for ties, which doesn't suit titles (lots of feeds share one). Here the cursor
+is the (title, id) of the last feed on the page, so every page is an index
+range scan on (title, id) no matter how deep into the list it is.
+"""
+import base64
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def encode_cursor(title, id):
+    data = json.dumps([title, id]).encode('utf8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        title, id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if not isinstance(title, str) or not isinstance(id, int):
+            raise ValueError
+    except (TypeError, ValueError, UnicodeError):
+        raise NotFound('Invalid cursor')
+    return title, id
+
+
+class TitleCursorPagination(BasePagination):
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'limit'
+    # (setting name, default) pairs.
+    page_size_setting = ('FEED_LIST_PAGE_SIZE', 100)
+    max_page_size_setting = ('FEED_LIST_MAX_PAGE_SIZE', 1000)
+
+    def get_page_size(self, request):
+        default = getattr(settings, *self.page_size_setting)
+        maximum = getattr(settings, *self.max_page_size_setting)
+        try:
+            # request.GET rather than query_params so plain Django requests
+            # (the async views) work too.
+            page_size = int(request.GET[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return default
+        return min(max(page_size, 1), maximum)
+
+    def page_queryset(self, queryset, request):
+        """
+        The (unevaluated) queryset for the requested page, with one extra row
+        to find out if there's a next page. Pass the rows to set_page.
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+
+        queryset = queryset.order_by('title', 'id')
+        cursor = request.GET.get(self.cursor_query_param)
+        if cursor:
+            title, id = decode_cursor(cursor)
+            queryset = queryset.filter(Q(title__gt=title) | Q(title=title, id__gt=id))
+        return queryset[:self.page_size + 1]
+
+    def set_page(self, rows):
+        self.has_next = len(rows) > self.page_size
+        page = rows[:self.page_size]
+        self.last = page[-1] if page else None
+        return page
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.set_page(list(self.page_queryset(queryset, request)))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.cursor_for(self.last))
+
+    def cursor_for(self, row):
+        return encode_cursor(row.title, row.id)
+
+    def get_paginated_response(self, data):
+        return Response({'next': self.get_next_link(), 'results': data})
+
@@ -0,0 +1,25 @@
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+from api.opml import OPMLError, parse_opml
+
+
+class OPMLParser(BaseParser):
+    """
+    Parses an OPML request body into the list of feed urls it contains.
+    """
+    media_type = 'text/x-opml'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return parse_opml(stream.read())
+        except OPMLError as e:
+            raise ParseError(str(e))
+
+
+class XMLOPMLParser(OPMLParser):
+    media_type = 'application/xml'
+
+
+class TextXMLOPMLParser(OPMLParser):
+    media_type = 'text/xml'
@@ -0,0 +1,130 @@
+"""
+Password hashing for registration and login.
+
+The hasher new passwords get is picked with PASSWORD_HASHER (see settings):
+argon2, bcrypt or PBKDF2, each with its cost parameters in settings rather
+than Django's built in defaults. Hashes made by any of the others (or with
+other parameters) still verify and are replaced with the preferred hasher's
+on the user's next successful login.
+
+Hashing is the whole cost of users/register and users/login. With
+PASSWORD_HASH_WORKERS set it runs in a pool of that many processes instead
+of the request thread, so it can use every core whatever the GIL is doing
+and at most that many hashes run at once, a burst of logins queues up
+instead of starving every other request of CPU.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model, hashers
+from django.contrib.auth.backends import ModelBackend
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class Argon2PasswordHasher(hashers.Argon2PasswordHasher):
+    @property
+    def time_cost(self):
+        return getattr(settings, 'PASSWORD_ARGON2_TIME_COST', 2)
+
+    @property
+    def memory_cost(self):
+        return getattr(settings, 'PASSWORD_ARGON2_MEMORY_COST', 19 * 1024)
+
+    @property
+    def parallelism(self):
+        return getattr(settings, 'PASSWORD_ARGON2_PARALLELISM', 1)
+
+
+class BCryptSHA256PasswordHasher(hashers.BCryptSHA256PasswordHasher):
+    @property
+    def rounds(self):
+        return getattr(settings, 'PASSWORD_BCRYPT_ROUNDS', 12)
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    @property
+    def iterations(self):
+        return getattr(settings, 'PASSWORD_PBKDF2_ITERATIONS', None) or hashers.PBKDF2PasswordHasher.iterations
+
+
+def make_pool(workers):
+    # Spawned rather than forked, the parent's threads and database
+    # connections don't survive a fork. The workers inherit
+    # DJANGO_SETTINGS_MODULE and set Django up before anything else.
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'), initializer=django.setup)
+
+
+def get_pool():
+    """
+    The hashing process pool, None to hash in the calling thread.
+    """
+    global _pool
+    with _pool_lock:
+        workers = getattr(settings, 'PASSWORD_HASH_WORKERS', 0)
+        if _pool is None and workers:
+            _pool = make_pool(workers)
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def run(fn, *args):
+    pool = get_pool()
+    if pool is None:
+        return fn(*args)
+    return pool.submit(fn, *args).result()
+
+
+def make_password(password):
+    """
+    Hash password with the preferred hasher.
+    """
+    return run(hashers.make_password, password)
+
+
+def check_password(user, password):
+    """
+    Whether password is the user's, rehashing and saving it if the user's
+    hash isn't the preferred hasher's with the current parameters.
+    """
+    is_correct, must_update = run(hashers.verify_password, password, user.password)
+    if is_correct and must_update:
+        user.password = make_password(password)
+        user.save(update_fields=['password'])
+    return is_correct
+
+
+class PasswordBackend(ModelBackend):
+    """
+    ModelBackend hashing through make_password/check_password above.
+    """
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = UserModel._default_manager.get_by_natural_key(username)
+        except UserModel.DoesNotExist:
+            # Hash anyway so unknown usernames take as long as known ones.
+            make_password(password)
+            return None
+        if check_password(user, password) and self.user_can_authenticate(user):
+            return user
+        return None
+
+    async def aauthenticate(self, request, username=None, password=None, **kwargs):
+        return await sync_to_async(self.authenticate)(request, username, password, **kwargs)
@@ -0,0 +1,72 @@
+"""
+Per-user read state, stored compactly per (user, feed). See ReadState.
+"""
+from django.db import transaction
+
+from api.bitmap import IdBitmap
+from api.models import Feed, ReadState
+
+
+def is_read(state, article_id):
+    """
+    Whether the article is read under state (which may be None).
+    """
+    if state is None:
+        return False
+    exceptions = IdBitmap.from_bytes(state.exceptions)
+    return (article_id <= state.read_up_to) != (article_id in exceptions)
+
+
+def set_read(user, article, read=True):
+    """
+    Mark a single article read (or unread) for the user, returns the state.
+    """
+    with transaction.atomic():
+        state, created = ReadState.objects.select_for_update().get_or_create(user=user, feed_id=article.feed_id)
+        exceptions = IdBitmap.from_bytes(state.exceptions)
+        currently_read = (article.id <= state.read_up_to) != (article.id in exceptions)
+        if currently_read == read:
+            return state
+
+        # Flipping an article's state either adds it to or removes it from
+        # the exceptions, depending on which side of the mark it is.
+        if article.id in exceptions:
+            exceptions.discard(article.id)
+        else:
+            exceptions.add(article.id)
+        state.exceptions = exceptions.to_bytes()
+        state.read_count += 1 if read else -1
+        state.save()
+    return state
+
+
+def mark_all_read(user, feed):
+    """
+    Mark every article currently in the feed read with a single write.
+    """
+    totals = Feed.objects.filter(pk=feed.pk).values('article_count', 'last_article_id').get()
+    state, created = ReadState.objects.update_or_create(
+        user=user, feed=feed,
+        defaults={
+            'read_up_to': totals['last_article_id'],
+            'exceptions': b'',
+            'read_count': totals['article_count'],
+        },
+    )
+    return state
+
+
+def unread_count(state, feed):
+    read_count = state.read_count if state else 0
+    return max(feed.article_count - read_count, 0)
+
+
+def unread_counts(user):
+    """
+    Unread counts for every feed the user is subscribed to, by feed id.
+    """
+    read_counts = dict(ReadState.objects.filter(user=user).values_list('feed_id', 'read_count'))
+    return {
+        feed_id: max(article_count - read_counts.get(feed_id, 0), 0)
+        for feed_id, article_count in Feed.objects.filter(users=user).values_list('id', 'article_count')
+    }
@@ -0,0 +1,300 @@
+"""
+Applying fetch results to Feed rows.
+
+Shared by the background fetch workers and anything else that refreshes feeds
+so every fetch path updates the database the same way.
+
+A popular feed can be asked for by many subscribers at once. refresh_feed
+and refresh_feed_async fetch each url once at a time per process: a refresh
+of a feed that's already being refreshed waits for that one and reloads the
+feed it stored. Subscribing paths also pass max_age so a feed that was
+just fetched (by any process) isn't fetched again, what it stored stands.
+
+Fetches go through the circuit breakers in api/health.py: nothing is fetched
+from a host that keeps failing, or on demand for a feed that does.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from api.aiofetch import fetch_feed_async, get_shared_session, parse_async
+from api.feedcache import abump_subscribers, bump_subscribers
+from api.fetch import FetchError, fetch_feed
+from api.health import CircuitOpen, HostBreaker, feed_circuit_open
+from api.ingest import ingest_entries
+from api.models import Feed
+from api.schedule import schedule_changed, schedule_error, schedule_unchanged
+from api.singleflight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+def truncate(value, field_name):
+    max_length = Feed._meta.get_field(field_name).max_length
+    return (value or '')[:max_length]
+
+
+# The fields set_result changes and the subsets set_error/set_unchanged
+# change (plus the latency HostBreaker.guard records), for save/bulk_update.
+SCHEDULE_FIELDS = ['next_fetch_at', 'fetch_interval', 'changed_at', 'error_count', 'last_latency']
+STATUS_FIELDS = ['status', 'last_error', 'fetched_at'] + SCHEDULE_FIELDS
+VALIDATOR_FIELDS = ['etag', 'last_modified']
+DEFERRED_FIELDS = ['next_fetch_at']
+UPDATE_FIELDS = ['title', 'link', 'description', 'content_hash'] + VALIDATOR_FIELDS + STATUS_FIELDS
+# Everything a refresh reads, for loading feeds with only().
+REFRESH_LOAD_FIELDS = ['id', 'url', 'title', 'status', 'etag', 'last_modified', 'content_hash'] + SCHEDULE_FIELDS
+
+
+# The set_* functions below flag feed.listing_changed when something the feed
+# list shows (title, status) changed, so subscribers' cached lists can be
+# invalidated once the feed is saved.
+def listing_changed(feeds):
+    return [feed.id for feed in feeds if getattr(feed, 'listing_changed', False)]
+
+
+def set_result(feed, result):
+    """
+    Copy feed level metadata from a successful fetch onto the feed (unsaved).
+    """
+    info = result.feed
+    title = truncate(info.get('title'), 'title')
+    feed.listing_changed = feed.title != title or feed.status != Feed.STATUS_OK
+    feed.title = title
+    feed.link = truncate(info.get('link'), 'link')
+    feed.description = info.get('subtitle', '')
+    feed.status = Feed.STATUS_OK
+    feed.last_error = ''
+    feed.fetched_at = timezone.now()
+    schedule_changed(feed, feed.fetched_at)
+    # Validators for the next conditional fetch.
+    feed.etag = truncate(result.etag, 'etag')
+    feed.last_modified = truncate(result.last_modified, 'last_modified')
+    feed.content_hash = result.content_hash
+
+
+def set_validators(feed, result):
+    """
+    Copy the response's validators onto the feed, returns whether they
+    changed. A 304 without them leaves the ones we have.
+    """
+    etag = truncate(result.etag, 'etag')
+    last_modified = truncate(result.last_modified, 'last_modified')
+    if result.status == 304:
+        etag = etag or feed.etag
+        last_modified = last_modified or feed.last_modified
+    changed = (etag, last_modified) != (feed.etag, feed.last_modified)
+    feed.etag = etag
+    feed.last_modified = last_modified
+    return changed
+
+
+def set_unchanged(feed, result):
+    """
+    Handle a fetch that found the feed unchanged. Returns the fields that
+    need saving: just the schedule unless it is recovering from an error or
+    the server sent new validators (a 200 with the same body can).
+    """
+    now = timezone.now()
+    schedule_unchanged(feed, now)
+    fields = VALIDATOR_FIELDS if set_validators(feed, result) else []
+    feed.listing_changed = feed.status != Feed.STATUS_OK
+    if not feed.listing_changed:
+        return SCHEDULE_FIELDS + fields
+    feed.status = Feed.STATUS_OK
+    feed.last_error = ''
+    feed.fetched_at = now
+    return STATUS_FIELDS + fields
+
+
+def set_deferred(feed, error):
+    """
+    Handle a fetch that wasn't tried, its host's circuit is open (error is
+    the CircuitOpen). The feed's status and error count stay as they are, it
+    is due again when the circuit lets a probe through. Returns the fields
+    that need saving.
+    """
+    feed.next_fetch_at = timezone.now() + timedelta(seconds=error.retry_after)
+    return DEFERRED_FIELDS
+
+
+def set_error(feed, error):
+    feed.listing_changed = feed.status != Feed.STATUS_ERROR
+    feed.status = Feed.STATUS_ERROR
+    feed.last_error = str(error)
+    feed.fetched_at = timezone.now()
+    schedule_error(feed, feed.fetched_at)
+
+
+def apply_result(feed, result):
+    set_result(feed, result)
+    # Parsed before the transaction, not while holding the write lock.
+    entries = list(result.entries)
+    with transaction.atomic():
+        feed.save(update_fields=UPDATE_FIELDS)
+        bump_subscribers(listing_changed([feed]))
+        ingest_entries(feed, entries)
+
+
+def apply_error(feed, error):
+    set_error(feed, error)
+    feed.save(update_fields=STATUS_FIELDS)
+    bump_subscribers(listing_changed([feed]))
+
+
+def apply_unchanged(feed, result):
+    feed.save(update_fields=set_unchanged(feed, result))
+    bump_subscribers(listing_changed([feed]))
+
+
+# Refreshes running in this process, keyed by feed url.
+in_flight = SingleFlight()
+
+
+def get_reuse_seconds():
+    return getattr(settings, 'FEED_RESULT_REUSE_SECONDS', 60)
+
+
+def fetched_recently(feed, max_age):
+    return bool(max_age) and feed.fetched_at is not None and (
+        timezone.now() - feed.fetched_at < timedelta(seconds=max_age)
+    )
+
+
+def refresh_feed(feed, max_age=None):
+    """
+    Fetch a single feed and store the outcome, returns True on success.
+
+    Skipped if the feed was fetched less than max_age seconds ago or its
+    circuit is open, shared with a refresh of the same feed that's already
+    running.
+    """
+    if fetched_recently(feed, max_age) or feed_circuit_open(feed):
+        return feed.status == Feed.STATUS_OK
+    ok, shared = in_flight.do(feed.url, lambda: _refresh_feed(feed))
+    if shared:
+        feed.refresh_from_db()
+    return ok
+
+
+def _refresh_feed(feed):
+    breaker = HostBreaker.for_urls([feed.url])
+    try:
+        with breaker.guard(feed):
+            result = fetch_feed(
+                feed.url, etag=feed.etag, last_modified=feed.last_modified, content_hash=feed.content_hash,
+            )
+    except CircuitOpen as e:
+        logger.info('Not fetching feed %s: %s', feed.id, e)
+        feed.save(update_fields=set_deferred(feed, e))
+        return feed.status == Feed.STATUS_OK
+    except FetchError as e:
+        logger.info('Fetch failed for feed %s: %s', feed.id, e)
+        apply_error(feed, e)
+        return False
+    finally:
+        breaker.save()
+
+    if result.parsed is None:
+        # Unchanged, nothing to parse and only the schedule (and any new
+        # validators) to write.
+        apply_unchanged(feed, result)
+        return True
+
+    apply_result(feed, result)
+    return True
+
+
+async def refresh_feed_async(feed, session=None, max_age=None):
+    """
+    Async version of refresh_feed, the fetch doesn't hold a thread while it
+    waits on the remote host.
+    """
+    if fetched_recently(feed, max_age) or feed_circuit_open(feed):
+        return feed.status == Feed.STATUS_OK
+    ok, shared = await in_flight.ado(feed.url, lambda: _refresh_feed_async(feed, session))
+    if shared:
+        await feed.arefresh_from_db()
+    return ok
+
+
+async def _refresh_feed_async(feed, session):
+    breaker = await HostBreaker.afor_urls([feed.url])
+    try:
+        async with breaker.aguard(feed):
+            result = await fetch_feed_async(
+                session or get_shared_session(), feed.url, feed.etag, feed.last_modified,
+            )
+        await breaker.asave()
+        if result.is_unchanged(feed.content_hash):
+            await feed.asave(update_fields=set_unchanged(feed, result))
+            await abump_subscribers(listing_changed([feed]))
+            return True
+        await parse_async(result)
+    except CircuitOpen as e:
+        await breaker.asave()
+        logger.info('Not fetching feed %s: %s', feed.id, e)
+        await feed.asave(update_fields=set_deferred(feed, e))
+        return feed.status == Feed.STATUS_OK
+    except FetchError as e:
+        await breaker.asave()
+        logger.info('Fetch failed for feed %s: %s', feed.id, e)
+        set_error(feed, e)
+        await feed.asave(update_fields=STATUS_FIELDS)
+        await abump_subscribers(listing_changed([feed]))
+        return False
+
+    # Saving and ingesting happen in one transaction, which needs sync code.
+    await sync_to_async(apply_result)(feed, result)
+    return True
+
+
+# Refreshes started by refresh_in_background, held so they aren't garbage
+# collected while they run.
+background_refreshes = set()
+
+
+async def _refresh_logged(feed, max_age):
+    try:
+        await refresh_feed_async(feed, max_age=max_age)
+    except Exception:
+        logger.exception('Fetch failed for feed %s', feed.id)
+
+
+def refresh_in_background(feed, max_age=None):
+    """
+    Start refresh_feed_async on the running event loop without waiting for
+    it, the async views' counterpart of queueing on the worker pool.
+    """
+    task = asyncio.get_running_loop().create_task(_refresh_logged(feed, max_age))
+    background_refreshes.add(task)
+    task.add_done_callback(background_refreshes.discard)
+    return task
+
+
+async def cancel_background_refreshes():
+    """
+    Cancel the running loop's background refreshes, on shutdown. Their feeds
+    stay pending, which the scheduler picks up.
+    """
+    loop = asyncio.get_running_loop()
+    tasks = [task for task in background_refreshes if task.get_loop() is loop]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def refresh_feed_by_id(feed_id):
+    """
+    The worker pool job, queued for new subscriptions.
+    """
+    try:
+        feed = Feed.objects.get(pk=feed_id)
+    except Feed.DoesNotExist:
+        # Feed was removed while the job was queued.
+        return False
+    return refresh_feed(feed, max_age=get_reuse_seconds())
@@ -0,0 +1,225 @@
+"""
+Pruning old articles (manage.py prune_articles).
+
+Stored articles otherwise grow without limit, and every index over them with
+them. A feed's retention policy keeps its newest retention_count articles
+and everything it published in the last retention_days
+(ARTICLE_RETENTION_COUNT and ARTICLE_RETENTION_DAYS unless the feed sets its
+own), anything older is pruned except:
+
+- articles one of the feed's subscribers hasn't read. A subscriber without
+  a read state for the feed hasn't read anything, so nothing is pruned from
+  it. There's no starring yet, starred articles would be kept the same way.
+- the feed's newest article. Read marks are compared against its id
+  (last_article_id), and SQLite hands the largest id out again if that row
+  is deleted.
+
+Each feed is pruned in batches of ARTICLE_PRUNE_BATCH_SIZE candidates, each
+in a transaction of its own, so the feed's read states (locked like set_read
+locks them) are only held for one batch. A batch takes what it deletes out
+of the feed's article_count and every read state's read_count and
+exceptions, unread counts stay right, and deletes the bodies (see
+api/bodies.py) only those articles referred to. Search index rows go with
+their articles (see api/search.py).
+"""
+import gzip
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from api.bitmap import IdBitmap
+from api.bodies import delete_orphan_bodies
+from api.ingest import update_article_count
+from api.models import Article, Feed, ReadState
+
+FeedUser = Feed.users.through
+FEED_FIELDS = ('id', 'last_article_id', 'retention_count', 'retention_days')
+
+
+def get_batch_size():
+    return getattr(settings, 'ARTICLE_PRUNE_BATCH_SIZE', 1000)
+
+
+def is_read(state, exceptions, article_id):
+    # api.readstate.is_read without decoding the bitmap per article.
+    return (article_id <= state.read_up_to) != (article_id in exceptions)
+
+
+def prunable_articles(feed, count, days, now):
+    """
+    The feed's articles neither kept as one of its newest count nor as
+    published in the last days (None for no such rule), None if it keeps
+    all of them.
+    """
+    if count is None and days is None:
+        return None
+    articles = Article.objects.filter(feed_id=feed.id, published_at__isnull=False).exclude(id=feed.last_article_id)
+    if days is not None:
+        articles = articles.filter(published_at__lt=now - timedelta(days=days))
+    if count:
+        newest = Article.objects.filter(feed_id=feed.id, published_at__isnull=False).order_by('-published_at', '-id')
+        oldest_kept = list(newest.values_list('published_at', 'id')[count - 1:count])
+        if not oldest_kept:
+            return None
+        published_at, id = oldest_kept[0]
+        articles = articles.filter(Q(published_at__lt=published_at) | Q(published_at=published_at, id__lt=id))
+    return articles
+
+
+def archive_record(article):
+    return {
+        'id': article.id,
+        'feed': article.feed_id,
+        'guid': article.guid,
+        'url': article.url,
+        'title': article.title,
+        'summary': article.summary,
+        'content': article.content,
+        'published_at': article.published_at,
+        'loaded_at': article.loaded_at,
+    }
+
+
+class Archive:
+    """
+    Pruned articles as JSON lines in a gzip file, written before they're
+    deleted.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wt', encoding='utf8')
+
+    def write(self, articles):
+        for article in articles:
+            self.file.write(json.dumps(archive_record(article), cls=DjangoJSONEncoder) + '\n')
+        # Each batch is on disk before its transaction deletes it.
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class PruneStats:
+    def __init__(self):
+        self.feeds = 0
+        self.articles = 0
+        self.kept_unread = 0
+        self.bodies = 0
+        self.elapsed = 0.0
+
+    @property
+    def rows_per_sec(self):
+        return self.articles / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        return 'Pruned %d articles from %d feeds in %.2fs: %.0f rows/sec, %d kept unread, %d bodies deleted' % (
+            self.articles, self.feeds, self.elapsed, self.rows_per_sec, self.kept_unread, self.bodies,
+        )
+
+
+class Pruner:
+    """
+    Prune feeds' articles per their retention policy. count and days
+    replace the settings' defaults for feeds without their own, archive is
+    an Archive to write the pruned articles to. With dry_run nothing is
+    deleted, the stats say what would have been.
+    """
+    def __init__(self, count=None, days=None, batch_size=None, archive=None, dry_run=False):
+        self.count = count if count is not None else getattr(settings, 'ARTICLE_RETENTION_COUNT', None)
+        self.days = days if days is not None else getattr(settings, 'ARTICLE_RETENTION_DAYS', None)
+        self.batch_size = batch_size or get_batch_size()
+        self.archive = archive
+        self.dry_run = dry_run
+
+    def policy(self, feed):
+        count = feed.retention_count if feed.retention_count is not None else self.count
+        days = feed.retention_days if feed.retention_days is not None else self.days
+        return count, days
+
+    def run(self, feeds):
+        stats = PruneStats()
+        started = time.monotonic()
+        now = timezone.now()
+        # Loaded up front, the batches write to the feed table.
+        for feed in list(feeds.only(*FEED_FIELDS).order_by('id')):
+            if self.prune_feed(feed, now, stats):
+                stats.feeds += 1
+        stats.elapsed = time.monotonic() - started
+        return stats
+
+    def prune_feed(self, feed, now, stats):
+        """
+        Prune one feed a batch at a time, returns whether anything was.
+        """
+        articles = prunable_articles(feed, *self.policy(feed), now)
+        if articles is None:
+            return False
+        if self.archive is None:
+            articles = articles.only('id', 'summary_body_id', 'content_body_id')
+        else:
+            articles = articles.select_related('summary_body', 'content_body')
+
+        pruned = 0
+        after = 0
+        while True:
+            with transaction.atomic():
+                states = {
+                    state.user_id: state for state in ReadState.objects.select_for_update().filter(feed_id=feed.id)
+                }
+                subscribers = set(FeedUser.objects.filter(feed_id=feed.id).values_list('user_id', flat=True))
+                if subscribers - set(states):
+                    # Someone hasn't read any of it.
+                    return bool(pruned)
+                batch = list(articles.filter(id__gt=after).order_by('id')[:self.batch_size])
+                if not batch:
+                    return bool(pruned)
+                after = batch[-1].id
+
+                exceptions = {user_id: IdBitmap.from_bytes(state.exceptions) for user_id, state in states.items()}
+                read = [
+                    article for article in batch
+                    if all(is_read(states[user_id], exceptions[user_id], article.id) for user_id in subscribers)
+                ]
+                stats.kept_unread += len(batch) - len(read)
+                if read and not self.dry_run:
+                    stats.bodies += self.delete(feed, read, states, exceptions)
+                stats.articles += len(read)
+                pruned += len(read)
+
+    def delete(self, feed, articles, states, exceptions):
+        """
+        Delete articles (all read) and their bodies no other article uses,
+        returns the number of bodies deleted.
+        """
+        if self.archive is not None:
+            self.archive.write(articles)
+        ids = [article.id for article in articles]
+        Article.objects.filter(id__in=ids).delete()
+        update_article_count(feed)
+        bodies = delete_orphan_bodies({
+            hash for article in articles for hash in (article.summary_body_id, article.content_body_id) if hash
+        })
+
+        # Users no longer subscribed still have states, which may count
+        # some of these as read too.
+        changed = []
+        for user_id, state in states.items():
+            bitmap = exceptions[user_id]
+            read = sum(1 for id in ids if is_read(state, bitmap, id))
+            in_exceptions = [id for id in ids if id in bitmap]
+            if not read and not in_exceptions:
+                continue
+            for id in in_exceptions:
+                bitmap.discard(id)
+            state.exceptions = bitmap.to_bytes()
+            state.read_count = max(state.read_count - read, 0)
+            changed.append(state)
+        if changed:
+            ReadState.objects.bulk_update(changed, ['exceptions', 'read_count'])
+        return bodies
@@ -0,0 +1,60 @@
+"""
+Adaptive refresh intervals.
+
+Each feed's fetch_interval tracks how often it actually changes: an
+exponentially weighted average of the time between changes, stretched a
+little every time a fetch finds nothing new. Failures back off
+exponentially on top of that. The outcome is stored as next_fetch_at, which
+the scheduler (api/scheduler.py) works from.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+
+# How much weight the latest observed change interval gets.
+SMOOTHING = 0.3
+# Interval growth when a fetch finds the feed unchanged.
+UNCHANGED_GROWTH = 1.25
+
+
+def get_setting(name, default):
+    return getattr(settings, name, default)
+
+
+def clamp_interval(seconds):
+    low = get_setting('FEED_SCHEDULE_MIN_INTERVAL', 15 * 60)
+    high = get_setting('FEED_SCHEDULE_MAX_INTERVAL', 24 * 60 * 60)
+    return int(min(max(seconds, low), high))
+
+
+def schedule_changed(feed, now):
+    """
+    The fetch found new content.
+    """
+    if feed.changed_at:
+        observed = (now - feed.changed_at).total_seconds()
+        feed.fetch_interval = clamp_interval(SMOOTHING * observed + (1 - SMOOTHING) * feed.fetch_interval)
+    feed.changed_at = now
+    feed.error_count = 0
+    feed.next_fetch_at = now + timedelta(seconds=feed.fetch_interval)
+
+
+def schedule_unchanged(feed, now):
+    """
+    The fetch found nothing new, check back a bit less often.
+    """
+    feed.fetch_interval = clamp_interval(feed.fetch_interval * UNCHANGED_GROWTH)
+    feed.error_count = 0
+    feed.next_fetch_at = now + timedelta(seconds=feed.fetch_interval)
+
+
+def schedule_error(feed, now):
+    """
+    The fetch failed, back off exponentially (up to a limit).
+    """
+    feed.error_count += 1
+    delay = min(
+        feed.fetch_interval * 2 ** (feed.error_count - 1),
+        get_setting('FEED_SCHEDULE_MAX_BACKOFF', 24 * 60 * 60),
+    )
+    feed.next_fetch_at = now + timedelta(seconds=delay)
@@ -0,0 +1,115 @@
+"""
+Long-running refresh scheduler.
+
+Feeds due within the next `window` are held in a heap ordered by
+next_fetch_at, loaded with a range query on the next_fetch_at index and
+reloaded every `reload_every` to pick up new and rescheduled feeds. Each tick
+only pops and refreshes the feeds that are actually due, then sleeps until
+the next one is.
+
+A tick that fails (a batch write that failed, the database locked past the
+busy timeout) is logged and doesn't stop run(). The heap is dropped and
+reloaded `retry_delay` later, the feeds that weren't written are still due
+in the database and come back with it.
+"""
+import heapq
+import logging
+import time
+from datetime import timedelta
+
+from django.db.models import Q
+from django.utils import timezone
+
+from api.bulk_refresh import BulkRefresher
+from api.models import Feed
+from api.refresh import REFRESH_LOAD_FIELDS
+
+logger = logging.getLogger(__name__)
+
+
+def due_filter(now):
+    return Q(next_fetch_at__isnull=True) | Q(next_fetch_at__lte=now)
+
+
+class FeedScheduler:
+    """
+    refresh is called with the list of due feeds and is expected to update
+    their next_fetch_at (every api.refresh path does). clock returns the
+    current (aware) datetime, both are there so tests can swap them out.
+    """
+    def __init__(self, refresh=None, clock=timezone.now, window=timedelta(minutes=10),
+                 reload_every=timedelta(minutes=1), max_batch=1000, retry_delay=timedelta(seconds=30)):
+        self.refresh = refresh or self.bulk_refresh
+        self.clock = clock
+        self.window = window
+        self.reload_every = reload_every
+        self.max_batch = max_batch
+        self.retry_delay = retry_delay
+        self.heap = []
+        self.loaded_at = None
+        self.loaded_until = None
+
+    def bulk_refresh(self, feeds):
+        BulkRefresher().run(feeds)
+
+    def load(self, now):
+        until = now + self.window
+        rows = Feed.objects.filter(due_filter(until)).values_list('next_fetch_at', 'id')
+        self.heap = [(next_fetch_at or now, id) for next_fetch_at, id in rows]
+        heapq.heapify(self.heap)
+        self.loaded_at = now
+        self.loaded_until = until
+
+    def pop_due(self, now):
+        ids = []
+        while self.heap and self.heap[0][0] <= now and len(ids) < self.max_batch:
+            ids.append(heapq.heappop(self.heap)[1])
+        return ids
+
+    def tick(self):
+        """
+        Refresh whatever is due, returns the feeds that were refreshed.
+        """
+        now = self.clock()
+        if self.loaded_at is None or now - self.loaded_at >= self.reload_every:
+            self.load(now)
+
+        ids = self.pop_due(now)
+        if not ids:
+            return []
+
+        # Something else (e.g. the fetch workers) may have refreshed a feed
+        # since it was loaded, only take the ones that are still due.
+        feeds = list(Feed.objects.filter(due_filter(now), pk__in=ids).only(*REFRESH_LOAD_FIELDS))
+        if feeds:
+            self.refresh(feeds)
+        for feed in feeds:
+            if feed.next_fetch_at and feed.next_fetch_at < self.loaded_until:
+                heapq.heappush(self.heap, (feed.next_fetch_at, feed.id))
+        return feeds
+
+    def retry_later(self):
+        """
+        Drop the heap and reload it from the database retry_delay from now.
+        """
+        self.heap = []
+        self.loaded_at = self.clock() - self.reload_every + self.retry_delay
+
+    def seconds_until_next(self):
+        now = self.clock()
+        wake_at = self.loaded_at + self.reload_every
+        if self.heap:
+            wake_at = min(wake_at, self.heap[0][0])
+        return max((wake_at - now).total_seconds(), 0)
+
+    def run(self, sleep=time.sleep, on_tick=None):
+        while True:
+            try:
+                feeds = self.tick()
+            except Exception:
+                logger.exception('Scheduler tick failed, retrying in %s', self.retry_delay)
+                self.retry_later()
+                feeds = []
+            if on_tick:
+                on_tick(feeds)
+            sleep(self.seconds_until_next())
@@ -0,0 +1,240 @@
+"""
+Full-text search over a user's feeds and articles.
+
+Articles are indexed in api_article_search, a table the ORM doesn't manage:
+an FTS5 table on SQLite, a tsvector column with a GIN index on PostgreSQL.
+Rows are keyed by article id, added by ingest_entries as each chunk of new
+articles is stored and removed along with their article (a trigger on
+SQLite, ON DELETE CASCADE on PostgreSQL). Matches are ranked (bm25 /
+ts_rank, titles weighted over bodies) and limited to the user's feeds.
+
+Feeds are only matched on title/url with icontains, scoped to the user's
+subscriptions that's at most a few thousand rows.
+"""
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import strip_tags
+
+from api.models import Article, Feed
+
+TABLE = 'api_article_search'
+# Terms past this are ignored.
+MAX_TERMS = 16
+# Articles indexed per id lookup/insert, keeps the guid IN (...) list short.
+INDEX_BATCH_SIZE = 500
+# Queries are ranked by relevance over at most this many matches, past that
+# the newest matches are returned (see the indexes' search methods).
+MAX_RANKED_MATCHES = 5000
+
+
+def get_page_size(request):
+    default = getattr(settings, 'SEARCH_PAGE_SIZE', 20)
+    maximum = getattr(settings, 'SEARCH_MAX_PAGE_SIZE', 100)
+    try:
+        limit = int(request.GET['limit'])
+    except (KeyError, ValueError):
+        return default
+    return min(max(limit, 1), maximum)
+
+
+def terms(query):
+    return re.findall(r'\w+', query.lower())[:MAX_TERMS]
+
+
+def document(title, summary, content):
+    """
+    The (title, body) text indexed for an article.
+    """
+    return title, strip_tags('%s %s' % (summary, content))
+
+
+class SQLiteIndex:
+    def create(self, cursor):
+        cursor.execute(
+            "CREATE VIRTUAL TABLE %s USING fts5(title, body, tokenize='porter unicode61 remove_diacritics 2')"
+            % TABLE
+        )
+        self.create_triggers(cursor)
+
+    def create_triggers(self, cursor):
+        # SQLite drops a table's triggers when Django rebuilds it to alter it,
+        # migrations that alter Article have to call create_triggers after.
+        cursor.execute(
+            'CREATE TRIGGER IF NOT EXISTS %s_delete AFTER DELETE ON api_article BEGIN '
+            'DELETE FROM %s WHERE rowid = old.id; END' % (TABLE, TABLE)
+        )
+
+    def drop(self, cursor):
+        cursor.execute('DROP TRIGGER IF EXISTS %s_delete' % TABLE)
+        cursor.execute('DROP TABLE IF EXISTS %s' % TABLE)
+
+    def add(self, cursor, rows):
+        cursor.executemany('INSERT OR REPLACE INTO %s (rowid, title, body) VALUES (%%s, %%s, %%s)' % TABLE, rows)
+
+    def matches(self, cursor, match, user_id, limit, order):
+        cursor.execute(
+            'SELECT s.rowid FROM {table} s JOIN api_article a ON a.id = s.rowid '
+            'WHERE {table} MATCH %s AND a.feed_id IN (SELECT feed_id FROM {users} WHERE user_id = %s) '
+            'ORDER BY {order} LIMIT %s'.format(
+                table=TABLE, users=Feed.users.through._meta.db_table, order=order,
+            ),
+            [match, user_id, limit],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def is_common(self, cursor, phrase):
+        cursor.execute(
+            'SELECT count(*) FROM (SELECT rowid FROM {table} WHERE {table} MATCH %s LIMIT %s)'.format(table=TABLE),
+            [phrase, MAX_RANKED_MATCHES],
+        )
+        return cursor.fetchone()[0] >= MAX_RANKED_MATCHES
+
+    def search(self, cursor, user_id, words, limit):
+        # Every term has to match, quoted so nothing in them is FTS5 syntax.
+        phrases = ['"%s"' % word for word in words]
+        match = ' '.join(phrases)
+        if not any(self.is_common(cursor, phrase) for phrase in phrases):
+            return self.matches(cursor, match, user_id, limit, 'bm25(%s, 5.0, 1.0)' % TABLE)
+        # bm25 counts every article containing each term to weigh them, for a
+        # term in most articles that's most of the index. Instead: the newest
+        # matches, title matches first.
+        ids = self.matches(cursor, '{title} : (%s)' % match, user_id, limit, 's.rowid DESC')
+        if len(ids) < limit:
+            seen = set(ids)
+            ids += [id for id in self.matches(cursor, match, user_id, limit, 's.rowid DESC') if id not in seen]
+        return ids[:limit]
+
+
+class PostgreSQLIndex:
+    def get_config(self):
+        return getattr(settings, 'SEARCH_CONFIG', 'english')
+
+    def create(self, cursor):
+        cursor.execute(
+            'CREATE TABLE %s (article_id integer PRIMARY KEY REFERENCES api_article (id) '
+            'ON DELETE CASCADE, document tsvector NOT NULL)' % TABLE
+        )
+        cursor.execute('CREATE INDEX %s_document ON %s USING gin (document)' % (TABLE, TABLE))
+
+    def create_triggers(self, cursor):
+        pass
+
+    def drop(self, cursor):
+        cursor.execute('DROP TABLE IF EXISTS %s' % TABLE)
+
+    def add(self, cursor, rows):
+        cursor.executemany(
+            'INSERT INTO %s (article_id, document) VALUES (%%s, '
+            "setweight(to_tsvector(%%s::regconfig, %%s), 'A') || setweight(to_tsvector(%%s::regconfig, %%s), 'B')) "
+            'ON CONFLICT (article_id) DO NOTHING' % TABLE,
+            [(id, self.get_config(), title, self.get_config(), body) for id, title, body in rows],
+        )
+
+    def search(self, cursor, user_id, words, limit):
+        # ts_rank has to read each match's tsvector, so only the newest
+        # MAX_RANKED_MATCHES are ranked.
+        cursor.execute(
+            'SELECT article_id FROM ('
+            'SELECT s.article_id, ts_rank(s.document, query) AS score FROM {table} s '
+            'JOIN api_article a ON a.id = s.article_id, plainto_tsquery(%s::regconfig, %s) query '
+            'WHERE s.document @@ query AND a.feed_id IN (SELECT feed_id FROM {users} WHERE user_id = %s) '
+            'ORDER BY s.article_id DESC LIMIT %s'
+            ') candidates ORDER BY score DESC, article_id DESC LIMIT %s'.format(
+                table=TABLE, users=Feed.users.through._meta.db_table,
+            ),
+            [self.get_config(), ' '.join(words), user_id, MAX_RANKED_MATCHES, limit],
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+INDEXES = {'sqlite': SQLiteIndex(), 'postgresql': PostgreSQLIndex()}
+
+
+def get_index(conn=None):
+    """
+    The index for the connection's database, None if it has no full-text
+    support here (articles are then searched by title with icontains).
+    """
+    return INDEXES.get((conn or connection).vendor)
+
+
+def create_index(conn):
+    index = get_index(conn)
+    if index:
+        with conn.cursor() as cursor:
+            index.create(cursor)
+
+
+def create_triggers(conn):
+    index = get_index(conn)
+    if index:
+        with conn.cursor() as cursor:
+            index.create_triggers(cursor)
+
+
+def drop_index(conn):
+    index = get_index(conn)
+    if index:
+        with conn.cursor() as cursor:
+            index.drop(cursor)
+
+
+def add_documents(rows, conn=None):
+    """
+    Index (article id, title, summary, content) rows.
+    """
+    conn = conn or connection
+    index = get_index(conn)
+    if index and rows:
+        with conn.cursor() as cursor:
+            index.add(cursor, [(id,) + document(title, summary, content) for id, title, summary, content in rows])
+
+
+def index_articles(articles):
+    """
+    Index articles just inserted, which must have their ids set
+    (see api/ingest.py:inserted_articles).
+    """
+    if get_index() is None:
+        return
+    for start in range(0, len(articles), INDEX_BATCH_SIZE):
+        batch = articles[start:start + INDEX_BATCH_SIZE]
+        add_documents([(a.id, a.title, a.summary, a.content) for a in batch])
+
+
+def search_articles(user, query, limit):
+    """
+    The user's articles matching every term in query, best match first.
+    """
+    words = terms(query)
+    if not words:
+        return []
+    articles = Article.objects.select_related('summary_body').only(
+        'id', 'feed', 'title', 'url', 'summary_body', 'published_at',
+    )
+    index = get_index()
+    if index is None:
+        q = Q()
+        for word in words:
+            q &= Q(title__icontains=word)
+        return list(articles.filter(q, feed__users=user).order_by('-published_at', '-id')[:limit])
+    with connection.cursor() as cursor:
+        ids = index.search(cursor, user.id, words, limit)
+    found = articles.in_bulk(ids)
+    return [found[id] for id in ids if id in found]
+
+
+def search_feeds(user, query, limit):
+    """
+    The user's feeds whose title or url contains query.
+    """
+    query = query.strip()
+    if not query:
+        return []
+    return list(
+        Feed.objects.filter(Q(title__icontains=query) | Q(url__icontains=query), users=user)
+        .order_by('title', 'id')[:limit]
+    )
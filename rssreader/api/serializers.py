@@ -1,8 +1,9 @@
 from django.contrib.auth.models import User
-from django.core.exceptions import ObjectDoesNotExist
 from rest_framework import serializers
 
-from api.models import Feed
+from api.models import Article, Feed
+from api.passwords import make_password
+from api.subscriptions import subscribe
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -15,14 +16,64 @@ class UserSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         password = validated_data.pop('password')
         user = User(**validated_data)
-        user.set_password(password)
+        # Hashed in the password pool if there is one (see api/passwords.py).
+        user.password = make_password(password)
         user.save()
         return user
 
 class FeedSerializer(serializers.ModelSerializer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Drop any fields not asked for with ?fields=id,title
+        requested = self.requested_fields(self.context.get('request'))
+        if requested is not None:
+            for name in set(self.fields) - requested:
+                self.fields.pop(name)
+
+    @classmethod
+    def requested_fields(cls, request):
+        """
+        The set of known fields named in the request's ?fields= parameter, or
+        None if it didn't ask for a projection (or named no known fields).
+        """
+        if request is None or request.method != 'GET':
+            return None
+        fields = request.GET.get('fields')
+        if not fields:
+            return None
+        return set(fields.split(',')) & set(cls.Meta.fields) or None
+
+    @classmethod
+    def output_fields(cls, request):
+        """
+        The fields in a response to request, in Meta.fields order.
+        """
+        requested = cls.requested_fields(request)
+        return [name for name in cls.Meta.fields if requested is None or name in requested]
+
+    @classmethod
+    def values_queryset(cls, queryset, fields):
+        """
+        queryset as named values_list() rows of fields and the pagination
+        keys (id, title), for values_data. No model instances or serializer
+        fields get built per row.
+        """
+        keys = [name for name in ('id', 'title') if name not in fields]
+        return queryset.values_list(*fields, *keys, named=True)
+
+    @staticmethod
+    def values_data(rows, fields):
+        """
+        The serialized form of rows from values_queryset. Every field is a
+        plain column whose value is already what the serializer outputs.
+        """
+        return [dict(zip(fields, row)) for row in rows]
+
     class Meta:
         model = Feed
-        fields = ('id', 'title', 'url')
+        fields = ('id', 'title', 'url', 'status')
+        # The title and status are filled in by the fetch workers.
+        read_only_fields = ('title', 'status')
         # Removing the url unique validator, handled with special
         # logic in create
         extra_kwargs = {
@@ -31,16 +82,22 @@ class FeedSerializer(serializers.ModelSerializer):
 
     def create(self, validated_data):
         user_id = self.context['user_id']
-        feed_title = self.context['feed_title']
 
-        try:
-            feed = Feed.objects.get(**validated_data)
-        except ObjectDoesNotExist:
-            feed = Feed.objects.create(**validated_data)
-            feed.title = feed_title
-            feed.save()
+        # Creates the feed (pending until a fetch worker gets to it) if it's
+        # new and adds the requesting user regardless.
+        return subscribe(user_id, validated_data['url'])
 
-        # Add the user requesting the feed regardless if it already exists.
-        feed.users.add(user_id)
 
-        return feed
+class ArticleSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Article
+        # The timeline doesn't load the (potentially large) content.
+        fields = ('id', 'feed', 'title', 'url', 'summary', 'published_at')
+        read_only_fields = fields
+
+
+class ArticleDetailSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Article
+        fields = ('id', 'feed', 'title', 'url', 'summary', 'content', 'published_at')
+        read_only_fields = fields
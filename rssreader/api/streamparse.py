@@ -0,0 +1,170 @@
+"""
+Incremental parsing of RSS/Atom documents.
+
+feedparser only parses whole documents, building every entry before handing
+anything back. Here an XMLPullParser walks the document as it arrives and
+items are handed to feedparser ENTRY_BATCH_SIZE at a time as their closing
+tags are seen, then dropped from the tree, so the parsed entries are never
+all held at once. The feed level metadata comes from the channel header,
+which ends at the first item, so it is ready before any entry is parsed and
+the same pass goes on to the entries. Chunks are fed to the parser as they
+come, feeding it a whole body at once would build the whole tree before the
+first event.
+
+An item parsed on its own has lost the xml:base and xml:lang of the elements
+around it, so each item (and the channel) is given the ones in effect where
+it was, starting from the document's url. Relative links resolve as they
+would in the whole document.
+
+The pull parser is strict XML, callers should fall back to feedparser's
+lenient parsing of the whole document on ElementTree.ParseError.
+"""
+from urllib.parse import urljoin
+from xml.etree import ElementTree
+
+import feedparser
+
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+XML_BASE = '{http://www.w3.org/XML/1998/namespace}base'
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+CHANNEL_TAGS = {'channel', 'feed'}
+ENTRY_TAGS = {'item', 'entry'}
+# Entries per document handed to feedparser, each parse has a fixed cost.
+ENTRY_BATCH_SIZE = 100
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def iter_events(chunks):
+    """
+    Yield (event, element) pairs from an iterable of byte chunks.
+    """
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+
+def wrap(elems):
+    """
+    A standalone document around a channel element or item elements for
+    feedparser, so its normalisation of dates, links and content is used
+    unchanged.
+    """
+    xml = b''.join(ElementTree.tostring(elem) for elem in elems)
+    tag = elems[0].tag
+    if tag.startswith(ATOM_NS):
+        if local_name(tag) == 'feed':
+            return xml
+        return b'<feed xmlns="http://www.w3.org/2005/Atom">' + xml + b'</feed>'
+    if local_name(tag) == 'channel':
+        return b'<rss version="2.0">' + xml + b'</rss>'
+    return b'<rss version="2.0"><channel>' + xml + b'</channel></rss>'
+
+
+def scope(elem, parent):
+    """
+    The (xml:base, xml:lang) in effect inside elem, given its parent's.
+    """
+    base, lang = parent
+    if XML_BASE in elem.attrib:
+        base = urljoin(base, elem.attrib[XML_BASE])
+    return base, elem.attrib.get(XML_LANG, lang)
+
+
+def set_scope(elem, scope):
+    """
+    Put the xml:base and xml:lang elem had in the document on it, for
+    parsing it on its own.
+    """
+    base, lang = scope
+    if base:
+        elem.set(XML_BASE, base)
+    if lang:
+        elem.set(XML_LANG, lang)
+
+
+def parse_channel(channel, scope):
+    """
+    The feed level metadata from the channel read so far, None if there's
+    no channel.
+    """
+    if channel is None:
+        return None
+    # A copy without the entries, one may only be partly read.
+    header = ElementTree.Element(channel.tag, channel.attrib)
+    header.extend(child for child in channel if local_name(child.tag) not in ENTRY_TAGS)
+    set_scope(header, scope)
+    return feedparser.parse(wrap([header]))['feed']
+
+
+def iter_document(chunks, base=''):
+    """
+    Read the document in one pass: yield its feed level metadata (title,
+    link, subtitle, ...) as feedparser would report it, as soon as the first
+    entry starts, then its entries as feedparser entries, parsed a batch at
+    a time. The metadata is None if there's no channel/feed element before
+    the first entry. Relative links are resolved against base, the
+    document's url.
+    """
+    parents = []
+    scopes = [(base, '')]
+    channel = channel_scope = None
+    header = False
+    batch = []
+    for event, elem in iter_events(chunks):
+        if event == 'start':
+            parents.append(elem)
+            scopes.append(scope(elem, scopes[-1]))
+            if header:
+                continue
+            tag = local_name(elem.tag)
+            if tag in CHANNEL_TAGS and channel is None:
+                channel, channel_scope = elem, scopes[-1]
+            elif tag in ENTRY_TAGS:
+                header = True
+                yield parse_channel(channel, channel_scope)
+            continue
+        parents.pop()
+        elem_scope = scopes.pop()
+        if elem is channel and not header:
+            header = True
+            yield parse_channel(channel, channel_scope)
+        if local_name(elem.tag) not in ENTRY_TAGS:
+            continue
+        if batch and batch[0].tag.startswith(ATOM_NS) != elem.tag.startswith(ATOM_NS):
+            yield from feedparser.parse(wrap(batch))['entries']
+            batch = []
+        set_scope(elem, elem_scope)
+        batch.append(elem)
+        # Done with it, don't let the tree grow with the document.
+        if parents:
+            parents[-1].remove(elem)
+        if len(batch) >= ENTRY_BATCH_SIZE:
+            yield from feedparser.parse(wrap(batch))['entries']
+            batch = []
+    if not header:
+        yield parse_channel(channel, channel_scope)
+    if batch:
+        yield from feedparser.parse(wrap(batch))['entries']
+
+
+def parse_header(chunks, base=''):
+    """
+    Just the feed level metadata of iter_document, reading no further than
+    the first entry.
+    """
+    return next(iter_document(chunks, base))
+
+
+def iter_entries(chunks, base=''):
+    """
+    Just the entries of iter_document.
+    """
+    document = iter_document(chunks, base)
+    next(document)
+    yield from document
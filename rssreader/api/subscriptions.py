@@ -0,0 +1,81 @@
+"""
+Subscribing users to feeds.
+
+Feed rows are shared between users, so two users (or one double-clicking
+user) can race to add the same url. Both the feed row and the user link are
+written with INSERT ... ON CONFLICT DO NOTHING (bulk_create with
+ignore_conflicts) so whoever loses the race just picks up the winner's row
+instead of hitting the unique constraint.
+
+Every change bumps the user's feed list version (see api/feedcache.py) and
+tells their event streams to follow the new set of feeds (see
+api/events.py).
+"""
+from api.events import subscriptions_changed
+from api.feedcache import abump_version, bump_version
+from api.models import Feed
+
+FeedUser = Feed.users.through
+
+
+def subscribe(user_id, url):
+    """
+    Subscribe the user to the feed at url, creating the feed (pending) if
+    it's new. Always four queries, whether or not the feed existed.
+    """
+    Feed.objects.bulk_create([Feed(url=url)], ignore_conflicts=True)
+    feed = Feed.objects.get(url=url)
+    FeedUser.objects.bulk_create([FeedUser(feed_id=feed.id, user_id=user_id)], ignore_conflicts=True)
+    bump_version(user_id)
+    subscriptions_changed(user_id)
+    return feed
+
+
+async def asubscribe(user_id, url):
+    """
+    Async version of subscribe, for the async views.
+    """
+    await Feed.objects.abulk_create([Feed(url=url)], ignore_conflicts=True)
+    feed = await Feed.objects.aget(url=url)
+    await FeedUser.objects.abulk_create([FeedUser(feed_id=feed.id, user_id=user_id)], ignore_conflicts=True)
+    await abump_version(user_id)
+    subscriptions_changed(user_id, on_commit=False)
+    return feed
+
+
+def subscribe_many(user_id, urls):
+    """
+    Subscribe the user to every url, in a fixed handful of queries however
+    many urls there are. Returns the feeds in the order of urls (duplicates
+    dropped).
+    """
+    urls = list(dict.fromkeys(urls))
+    feeds = {feed.url: feed for feed in Feed.objects.filter(url__in=urls)}
+
+    missing = [Feed(url=url) for url in urls if url not in feeds]
+    if missing:
+        Feed.objects.bulk_create(missing, ignore_conflicts=True)
+        # ignore_conflicts means we don't get ids back, load the new rows.
+        feeds.update((feed.url, feed) for feed in Feed.objects.filter(url__in=[f.url for f in missing]))
+
+    FeedUser.objects.bulk_create(
+        [FeedUser(feed_id=feed.id, user_id=user_id) for feed in feeds.values()],
+        ignore_conflicts=True,
+    )
+    if feeds:
+        bump_version(user_id)
+        subscriptions_changed(user_id)
+    return [feeds[url] for url in urls]
+
+
+def unsubscribe(user_id, feed_id):
+    """
+    Unsubscribe the user from the feed, returns False if they weren't
+    subscribed. The feed itself stays for its other subscribers.
+    """
+    deleted, _ = FeedUser.objects.filter(feed_id=feed_id, user_id=user_id).delete()
+    if not deleted:
+        return False
+    bump_version(user_id)
+    subscriptions_changed(user_id)
+    return True
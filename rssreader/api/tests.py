@@ -1,10 +1,142 @@
+import asyncio
+import gzip
 import json
-from django.test import TestCase, Client
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from unittest import mock, skipUnless
+from urllib.parse import parse_qs, urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.hashers import MD5PasswordHasher
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, close_old_connections, connection
+from django.test import AsyncRequestFactory, TestCase, TransactionTestCase, Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.http import HttpResponse
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+
+from api.bulk_refresh import BulkRefresher, RefreshStats
+from api import async_views, metrics, passwords
+from api.aiofetch import close_shared_session, get_shared_session
+from api.authentication import get_local_cache
+from api.bitmap import IdBitmap
+from api.bodies import compress, delete_orphan_bodies
+from api.cache import LRUCache
+from api.events import InProcessBroker, Subscription, get_broker
+from api.feedcache import get_cache, get_version
+from api.fetch import FetchError, FetchResult, HostError, fetch_feed, iter_body, parse_body
+from api.health import CircuitOpen, HostBreaker, host_of
+from api.ingest import ingest_entries
+from api.models import Article, ArticleBody, Feed, HostHealth, ReadState, SubscriptionVersion
+from api.pagination import encode_cursor
+from api.passwords import PBKDF2PasswordHasher
+from api.readstate import is_read, mark_all_read, set_read, unread_counts
+from api.retention import Pruner
+from api import refresh
+from api.refresh import apply_result, refresh_feed, refresh_feed_async
+from api.renderers import ORJSONRenderer, msgpack
+from api.search import TABLE as SEARCH_TABLE
+from api.schedule import schedule_changed, schedule_error, schedule_unchanged
+from api.scheduler import FeedScheduler
+from api.singleflight import SingleFlight
+from api.streamparse import iter_entries, parse_header
+from api.serializers import FeedSerializer, UserSerializer
+from api.subscriptions import asubscribe, subscribe, subscribe_many, unsubscribe
+from api.workers import FetchWorkerPool
+
+SAMPLE_RSS = '''<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0">
+  <channel>
+    <title>Sample Feed</title>
+    <link>https://example.com/</link>
+    <description>A feed for testing</description>
+    <item>
+      <title>First Post</title>
+      <link>https://example.com/posts/1</link>
+      <guid>https://example.com/posts/1</guid>
+      <description>The first post.</description>
+      <pubDate>Mon, 05 Oct 2020 10:00:00 GMT</pubDate>
+    </item>
+    <item>
+      <title>Second Post</title>
+      <link>https://example.com/posts/2</link>
+      <guid>https://example.com/posts/2</guid>
+      <description>The second post.</description>
+      <pubDate>Tue, 06 Oct 2020 10:00:00 GMT</pubDate>
+    </item>
+  </channel>
+</rss>
+'''
+
+
+class FeedServer:
+    """
+    Local HTTP stand-in for remote feed hosts.
+
+    Documents are registered by path, anything else is a 404. Paths given an
+    ETag answer matching conditional requests with a 304. Every request path
+    and its headers are recorded so tests can check what was fetched. Set
+    gate to an Event to hold responses until it's set.
+    """
+    def __init__(self):
+        self.documents = {}
+        self.etags = {}
+        self.requests = []
+        self.request_headers = []
+        self.gate = None
+        server = self
 
-from api.serializers import UserSerializer
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(self.path)
+                server.request_headers.append(self.headers)
+                if server.gate is not None:
+                    server.gate.wait(5)
+                body = server.documents.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                etag = server.etags.get(self.path)
+                if etag and self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = body.encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/rss+xml; charset=utf-8')
+                if etag:
+                    self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.httpd.server_port, path)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
 
 class UserRegisterTest(TestCase):
     """
@@ -237,3 +369,2392 @@ class UserLoginTest(TestCase):
         str_content = str(resp.content, encoding='utf8')
         self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
         self.assertJSONEqual(str_content, json.dumps(expected_content))
+
+
+class PasswordHashingTest(TestCase):
+    """
+    Tests for the configurable password hashing (api/passwords.py).
+    """
+    client = Client()
+    password = 'myTe$tPw#'
+
+    def login(self, password=None):
+        return self.client.post(reverse('user_login'), {'username': 'test', 'password': password or self.password})
+
+    def make_user(self, encoded):
+        user = User.objects.create(username='test', password=encoded)
+        Token.objects.create(user=user)
+        return user
+
+    @override_settings(PASSWORD_HASHERS=['api.passwords.PBKDF2PasswordHasher'], PASSWORD_PBKDF2_ITERATIONS=1000)
+    def test_register_uses_preferred_hasher(self):
+        """
+        Test that registering hashes with the preferred hasher's parameters.
+        """
+        resp = self.client.post(reverse('user_register'), {'username': 'test', 'password': self.password})
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(User.objects.get(username='test').password.startswith('pbkdf2_sha256$1000$'))
+        self.assertEqual(self.login().status_code, status.HTTP_200_OK)
+
+    @override_settings(
+        PASSWORD_HASHERS=['api.passwords.PBKDF2PasswordHasher', 'django.contrib.auth.hashers.MD5PasswordHasher'],
+        PASSWORD_PBKDF2_ITERATIONS=1000,
+    )
+    def test_login_rehashes_other_hasher(self):
+        """
+        Test that logging in replaces a hash made by another hasher.
+        """
+        user = self.make_user(MD5PasswordHasher().encode(self.password, 'salt'))
+        resp = self.login()
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$1000$'))
+        self.assertEqual(self.login().status_code, status.HTTP_200_OK)
+
+    @override_settings(PASSWORD_HASHERS=['api.passwords.PBKDF2PasswordHasher'], PASSWORD_PBKDF2_ITERATIONS=2000)
+    def test_login_rehashes_changed_parameters(self):
+        """
+        Test that logging in replaces a hash made with other parameters, and
+        only when the password is right.
+        """
+        encoded = PBKDF2PasswordHasher().encode(self.password, 'salt', iterations=1000)
+        user = self.make_user(encoded)
+        self.assertEqual(self.login('wrong').status_code, status.HTTP_400_BAD_REQUEST)
+        user.refresh_from_db()
+        self.assertEqual(user.password, encoded)
+        self.assertEqual(self.login().status_code, status.HTTP_200_OK)
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$2000$'))
+
+    @override_settings(PASSWORD_HASHERS=['api.passwords.PBKDF2PasswordHasher'], PASSWORD_PBKDF2_ITERATIONS=1000)
+    def test_unknown_user(self):
+        """
+        Test that logging in as a user that doesn't exist fails.
+        """
+        self.assertEqual(self.login().status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(PASSWORD_HASH_WORKERS=1)
+    def test_process_pool(self):
+        """
+        Test that with PASSWORD_HASH_WORKERS hashing runs in the pool.
+        """
+        try:
+            self.assertIsNotNone(passwords.get_pool())
+            encoded = passwords.make_password(self.password)
+            user = User(username='test', password=encoded)
+            self.assertTrue(passwords.check_password(user, self.password))
+            self.assertFalse(passwords.check_password(user, 'wrong'))
+            self.assertEqual(user.password, encoded)
+        finally:
+            passwords.shutdown_pool()
+
+
+class FeedCreateTest(TestCase):
+    """
+    Tests for feeds/add endpoint.
+    """
+    client = Client()
+    endpoint = reverse('feeds_add')
+
+    def setUp(self):
+        self.user = User.objects.create_user('test', password='myTe$tPw#')
+        token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': 'Token ' + token.key}
+
+    def test_feed_add_is_accepted_and_pending(self):
+        """
+        Test that adding a feed returns straight away with the feed pending.
+        """
+        resp = self.client.post(self.endpoint, {'url': 'http://127.0.0.1:1/rss'}, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        feed = Feed.objects.get(url='http://127.0.0.1:1/rss')
+        self.assertEqual(feed.status, Feed.STATUS_PENDING)
+        self.assertEqual(feed.title, '')
+        self.assertEqual(list(feed.users.all()), [self.user])
+        self.assertEqual(json.loads(resp.content)['status'], Feed.STATUS_PENDING)
+
+    def test_feed_add_attaches_existing_feed(self):
+        """
+        Test that adding an already known feed subscribes the user to it.
+        """
+        feed = Feed.objects.create(url='https://example.com/rss', title='Known', status=Feed.STATUS_OK)
+        resp = self.client.post(self.endpoint, {'url': feed.url}, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(json.loads(resp.content)['title'], 'Known')
+        self.assertEqual(Feed.objects.count(), 1)
+        self.assertEqual(list(feed.users.all()), [self.user])
+
+    def test_subscribe_query_count(self):
+        """
+        Test that subscribing is the same four queries for new and known feeds
+        (the last bumps the user's feed list version).
+        """
+        subscribe(self.user.id, 'https://example.com/other')
+        with self.assertNumQueries(4):
+            feed = subscribe(self.user.id, 'https://example.com/rss')
+        with self.assertNumQueries(4):
+            self.assertEqual(subscribe(self.user.id, 'https://example.com/rss'), feed)
+        self.assertEqual(list(feed.users.all()), [self.user])
+
+    def test_feed_add_must_provide_url(self):
+        """
+        Test to ensure bad request if no url is provided in the post data.
+        """
+        resp = self.client.post(self.endpoint, {}, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_feed_add_requires_auth(self):
+        """
+        Test to ensure anonymous users can't add feeds.
+        """
+        resp = self.client.post(self.endpoint, {'url': 'https://example.com/rss'})
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class FetchWorkerPoolTest(TransactionTestCase):
+    """
+    Tests for the background fetch workers against a local feed server.
+    """
+    def setUp(self):
+        self.server = FeedServer().__enter__()
+        self.server.documents['/rss'] = SAMPLE_RSS
+        self.pool = FetchWorkerPool(workers=2, queue_size=10)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        self.server.__exit__()
+
+    def test_worker_fills_in_feed_metadata(self):
+        """
+        Test that a queued feed gets its title and metadata from the server.
+        """
+        feed = Feed.objects.create(url=self.server.url('/rss'))
+        self.assertTrue(self.pool.submit(feed.id))
+        self.pool.join()
+        feed.refresh_from_db()
+        self.assertEqual(feed.status, Feed.STATUS_OK)
+        self.assertEqual(feed.title, 'Sample Feed')
+        self.assertEqual(feed.link, 'https://example.com/')
+        self.assertEqual(feed.description, 'A feed for testing')
+        self.assertIsNotNone(feed.fetched_at)
+        self.assertEqual(
+            list(feed.articles.values_list('url', flat=True)),
+            ['https://example.com/posts/2', 'https://example.com/posts/1'],
+        )
+
+    def test_worker_records_fetch_errors(self):
+        """
+        Test that a feed that can't be fetched is marked as errored.
+        """
+        feed = Feed.objects.create(url=self.server.url('/missing'))
+        self.pool.submit(feed.id)
+        self.pool.join()
+        feed.refresh_from_db()
+        self.assertEqual(feed.status, Feed.STATUS_ERROR)
+        self.assertIn('404', feed.last_error)
+
+    def test_feed_add_queues_fetch(self):
+        """
+        Test that the feeds/add endpoint hands the new feed to the workers.
+        """
+        user = User.objects.create_user('test', password='myTe$tPw#')
+        token = Token.objects.create(user=user)
+        with self.settings(FEED_FETCH_WORKERS=0):
+            from api import workers
+            workers._pool = None
+            try:
+                resp = self.client.post(reverse('feeds_add'), {'url': self.server.url('/rss')},
+                                        HTTP_AUTHORIZATION='Token ' + token.key)
+            finally:
+                workers._pool = None
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        feed = Feed.objects.get(url=self.server.url('/rss'))
+        self.assertEqual(feed.title, 'Sample Feed')
+
+
+class BulkRefreshTest(TransactionTestCase):
+    """
+    Tests for the asyncio bulk refresher and the refresh_feeds command.
+    """
+    def setUp(self):
+        self.server = FeedServer().__enter__()
+        self.server.documents['/rss'] = SAMPLE_RSS
+
+    def tearDown(self):
+        self.server.__exit__()
+
+    def test_bulk_refresh_updates_feeds_in_batches(self):
+        """
+        Test that every feed is refreshed, including failures, across several batches.
+        """
+        for i in range(5):
+            self.server.documents['/rss/%d' % i] = SAMPLE_RSS
+            Feed.objects.create(url=self.server.url('/rss/%d' % i))
+        Feed.objects.create(url=self.server.url('/missing'))
+
+        stats = BulkRefresher(concurrency=3, per_host=2, batch_size=2).run(Feed.objects.all())
+
+        self.assertEqual(stats.ok, 5)
+        self.assertEqual(stats.failed, 1)
+        self.assertEqual(Feed.objects.filter(status=Feed.STATUS_OK, title='Sample Feed').count(), 5)
+        # Every feed serves the same article urls, only the first feed to be
+        # written gets them.
+        self.assertEqual(Article.objects.count(), 2)
+        self.assertEqual(Feed.objects.get(url=self.server.url('/missing')).status, Feed.STATUS_ERROR)
+
+    def test_refresh_feeds_command_reports_stats(self):
+        """
+        Test that the command refreshes the requested feeds and reports throughput.
+        """
+        feed = Feed.objects.create(url=self.server.url('/rss'))
+        other = Feed.objects.create(url=self.server.url('/rss?other'))
+        out = StringIO()
+        call_command('refresh_feeds', str(feed.id), stdout=out)
+        self.assertIn('Refreshed 1 feeds (1 ok, 0 unchanged, 0 failed, 0 deferred)', out.getvalue())
+        self.assertIn('feeds/sec', out.getvalue())
+        self.assertIn('p99', out.getvalue())
+        feed.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(feed.title, 'Sample Feed')
+        self.assertEqual(other.status, Feed.STATUS_PENDING)
+
+    def test_run_scheduler_once(self):
+        """
+        Test that the scheduler command refreshes due feeds and schedules the next fetch.
+        """
+        feed = Feed.objects.create(url=self.server.url('/rss'))
+        out = StringIO()
+        call_command('run_scheduler', '--once', stdout=out)
+        self.assertIn('Refreshed 1 due feeds', out.getvalue())
+        feed.refresh_from_db()
+        self.assertEqual(feed.title, 'Sample Feed')
+        self.assertEqual(feed.next_fetch_at, feed.changed_at + timedelta(seconds=feed.fetch_interval))
+
+    def test_stats_percentiles(self):
+        """
+        Test the nearest-rank latency percentiles.
+        """
+        stats = RefreshStats()
+        stats.latencies = [i / 100 for i in range(1, 101)]
+        self.assertEqual(stats.percentile(50), 0.5)
+        self.assertEqual(stats.percentile(99), 0.99)
+        self.assertEqual(RefreshStats().percentile(50), 0.0)
+
+
+class ConditionalFetchTest(TransactionTestCase):
+    """
+    Tests for conditional GETs and content hashing on the fetch paths.
+    """
+    def setUp(self):
+        self.server = FeedServer().__enter__()
+        self.server.documents['/rss'] = SAMPLE_RSS
+        self.feed = Feed.objects.create(url=self.server.url('/rss'))
+
+    def tearDown(self):
+        self.server.__exit__()
+
+    def assert_schedule_only(self, queries):
+        # The host's health is saved whatever the response, in a transaction
+        # of its own.
+        queries = [
+            query for query in queries
+            if '"api_hosthealth"' not in query['sql'] and not query['sql'].startswith(('BEGIN', 'COMMIT'))
+        ]
+        self.assertEqual(len(queries), 1)
+        sql = queries[0]['sql']
+        self.assertTrue(sql.startswith('UPDATE "api_feed" SET "next_fetch_at"'), sql)
+        self.assertNotIn('"title"', sql)
+
+    def test_not_modified_skips_parse_and_write(self):
+        """
+        Test that a 304 costs no database writes beyond the schedule update.
+        """
+        self.server.etags['/rss'] = '"v1"'
+        self.assertTrue(refresh_feed(self.feed))
+        self.assertEqual(self.feed.etag, '"v1"')
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(refresh_feed(self.feed))
+        self.assert_schedule_only(queries)
+        self.assertEqual(self.server.request_headers[-1]['If-None-Match'], '"v1"')
+
+    def test_identical_body_skips_parse_and_write(self):
+        """
+        Test that a body identical to the last fetch costs no database writes
+        beyond the schedule update.
+        """
+        refresh_feed(self.feed)
+        self.assertEqual(len(self.feed.content_hash), 64)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(refresh_feed(self.feed))
+        self.assert_schedule_only(queries)
+
+    def test_identical_body_updates_validators(self):
+        """
+        Test that a 200 with the same body stores the response's new ETag, so
+        the next fetch can get a 304.
+        """
+        self.server.etags['/rss'] = '"v1"'
+        refresh_feed(self.feed)
+        self.server.etags['/rss'] = '"v2"'
+        self.assertTrue(refresh_feed(self.feed))
+        self.feed.refresh_from_db()
+        self.assertEqual(self.feed.etag, '"v2"')
+        self.assertTrue(refresh_feed(self.feed))
+        self.assertEqual(self.server.request_headers[-1]['If-None-Match'], '"v2"')
+
+        # The bulk refresher too.
+        self.server.etags['/rss'] = '"v3"'
+        stats = BulkRefresher().run(Feed.objects.all())
+        self.assertEqual(stats.unchanged, 1)
+        self.feed.refresh_from_db()
+        self.assertEqual(self.feed.etag, '"v3"')
+
+    def test_changed_body_is_stored(self):
+        """
+        Test that a changed body is parsed and stored again.
+        """
+        refresh_feed(self.feed)
+        old_hash = self.feed.content_hash
+        self.server.documents['/rss'] = SAMPLE_RSS.replace('Sample Feed', 'Renamed Feed')
+        refresh_feed(self.feed)
+        self.feed.refresh_from_db()
+        self.assertEqual(self.feed.title, 'Renamed Feed')
+        self.assertNotEqual(self.feed.content_hash, old_hash)
+
+    def test_unchanged_feed_recovers_from_error(self):
+        """
+        Test that an errored feed whose content is unchanged goes back to ok.
+        """
+        refresh_feed(self.feed)
+        Feed.objects.filter(pk=self.feed.pk).update(status=Feed.STATUS_ERROR, last_error='timeout')
+        self.feed.refresh_from_db()
+        refresh_feed(self.feed)
+        self.feed.refresh_from_db()
+        self.assertEqual(self.feed.status, Feed.STATUS_OK)
+        self.assertEqual(self.feed.last_error, '')
+
+    def test_bulk_refresh_counts_unchanged(self):
+        """
+        Test that the bulk refresher sends conditional requests and skips unchanged feeds.
+        """
+        self.server.etags['/rss'] = '"v1"'
+        BulkRefresher().run(Feed.objects.all())
+        stats = BulkRefresher().run(Feed.objects.all())
+        self.assertEqual((stats.ok, stats.unchanged, stats.failed), (0, 1, 0))
+        self.assertEqual(self.server.request_headers[-1]['If-None-Match'], '"v1"')
+
+
+# Nothing listens on port 1, connecting is refused straight away.
+DEAD_HOST = 'http://127.0.0.1:1'
+
+
+@override_settings(HOST_CIRCUIT_FAILURES=2, HOST_CIRCUIT_COOLDOWN=60, FEED_CIRCUIT_FAILURES=100)
+class CircuitBreakerTest(TransactionTestCase):
+    """
+    Tests for the per host and per feed circuit breakers.
+    """
+    def setUp(self):
+        get_local_cache().clear()
+        self.server = FeedServer().__enter__()
+        self.server.documents['/rss'] = SAMPLE_RSS
+
+    def tearDown(self):
+        self.server.__exit__()
+
+    def open_host(self, url, opened_at=None):
+        return HostHealth.objects.create(
+            host=host_of(url), state=HostHealth.STATE_OPEN, failures=2, opened_at=opened_at or datetime.now(timezone.utc),
+        )
+
+    def test_host_circuit_opens_after_failures(self):
+        """
+        Test that a host that can't be reached is no longer fetched from once
+        its circuit opens.
+        """
+        feeds = [Feed.objects.create(url='%s/rss/%d' % (DEAD_HOST, i)) for i in range(3)]
+        self.assertFalse(refresh_feed(feeds[0]))
+        self.assertEqual(HostHealth.objects.get(host='127.0.0.1:1').state, HostHealth.STATE_CLOSED)
+        self.assertFalse(refresh_feed(feeds[1]))
+        health = HostHealth.objects.get(host='127.0.0.1:1')
+        self.assertEqual((health.state, health.failures), (HostHealth.STATE_OPEN, 2))
+        self.assertIn('Error fetching', health.last_error)
+
+        with mock.patch('api.refresh.fetch_feed') as fetch:
+            self.assertFalse(refresh_feed(feeds[2]))
+        fetch.assert_not_called()
+        # Not tried, so not a failure of the feed's own.
+        feeds[2].refresh_from_db()
+        self.assertEqual((feeds[2].status, feeds[2].error_count, feeds[2].last_error), (Feed.STATUS_PENDING, 0, ''))
+        wait = (feeds[2].next_fetch_at - datetime.now(timezone.utc)).total_seconds()
+        self.assertTrue(55 < wait <= 60)
+
+    def test_http_errors_dont_count_against_host(self):
+        """
+        Test that a host answering with an HTTP error is recorded as up.
+        """
+        feed = Feed.objects.create(url=self.server.url('/missing'))
+        for _ in range(3):
+            self.assertFalse(refresh_feed(feed))
+        health = HostHealth.objects.get(host=host_of(feed.url))
+        self.assertEqual((health.state, health.failures), (HostHealth.STATE_CLOSED, 0))
+        self.assertIsNotNone(health.last_latency)
+        feed.refresh_from_db()
+        self.assertIsNotNone(feed.last_latency)
+
+    def test_probe_after_cooldown_closes_circuit(self):
+        """
+        Test that the first fetch after the cooldown goes ahead and closes
+        the circuit when it reaches the host.
+        """
+        feed = Feed.objects.create(url=self.server.url('/rss'))
+        self.open_host(feed.url)
+        self.assertFalse(refresh_feed(feed))
+        self.assertEqual(self.server.requests, [])
+
+        HostHealth.objects.update(opened_at=datetime.now(timezone.utc) - timedelta(seconds=61))
+        self.assertTrue(refresh_feed(feed))
+        health = HostHealth.objects.get(host=host_of(feed.url))
+        self.assertEqual((health.state, health.failures, health.opened_at), (HostHealth.STATE_CLOSED, 0, None))
+
+    def test_half_open_allows_one_probe(self):
+        """
+        Test that a half open circuit lets one fetch through and reopens if
+        it fails.
+        """
+        url = DEAD_HOST + '/rss'
+        self.open_host(url, datetime.now(timezone.utc) - timedelta(seconds=61))
+        breaker, other = HostBreaker.for_urls([url]), HostBreaker.for_urls([url])
+        breaker.allow(url)
+        self.assertEqual(breaker.get('127.0.0.1:1').state, HostHealth.STATE_HALF_OPEN)
+        with self.assertRaises(CircuitOpen) as cm:
+            breaker.allow(url)
+        self.assertEqual(cm.exception.retry_after, 60)
+        # Loaded before the probe was claimed, and still doesn't get one.
+        with self.assertRaises(CircuitOpen) as cm:
+            other.allow(url)
+        self.assertEqual(cm.exception.retry_after, 60)
+
+        breaker.record(url, 0.1, HostError('refused'))
+        breaker.save()
+        health = HostHealth.objects.get(host='127.0.0.1:1')
+        self.assertEqual((health.state, health.failures), (HostHealth.STATE_OPEN, 3))
+        self.assertGreater(health.opened_at, datetime.now(timezone.utc) - timedelta(seconds=5))
+
+    def test_concurrent_failures_all_count(self):
+        """
+        Test that failures recorded by concurrent refreshes all count and
+        open the circuit once.
+        """
+        feeds = [Feed.objects.create(url='%s/rss/%d' % (DEAD_HOST, i)) for i in range(8)]
+        barrier = threading.Barrier(len(feeds))
+
+        def fail(*args, **kwargs):
+            # Every refresh has loaded the closed circuit before any fails.
+            barrier.wait()
+            raise HostError('refused')
+
+        def refresh(feed):
+            try:
+                return refresh_feed(feed)
+            finally:
+                close_old_connections()
+
+        with mock.patch('api.refresh.fetch_feed', side_effect=fail), ThreadPoolExecutor(len(feeds)) as executor:
+            self.assertEqual(list(executor.map(refresh, feeds)), [False] * len(feeds))
+        health = HostHealth.objects.get(host='127.0.0.1:1')
+        self.assertEqual((health.state, health.failures), (HostHealth.STATE_OPEN, len(feeds)))
+
+    def test_feed_circuit_skips_on_demand_refresh(self):
+        """
+        Test that a feed failing repeatedly isn't fetched on demand before its
+        next scheduled fetch.
+        """
+        feed = Feed.objects.create(
+            url=self.server.url('/rss'), status=Feed.STATUS_ERROR, error_count=3,
+            next_fetch_at=datetime.now(timezone.utc) + timedelta(hours=1),
+        )
+        with override_settings(FEED_CIRCUIT_FAILURES=3):
+            self.assertFalse(refresh_feed(feed))
+            self.assertEqual(self.server.requests, [])
+            feed.next_fetch_at = datetime.now(timezone.utc)
+            self.assertTrue(refresh_feed(feed))
+
+    def test_feed_add_refused_while_host_down(self):
+        """
+        Test that subscribing to a url on a host whose circuit is open is
+        refused with a 503 and Retry-After.
+        """
+        user = User.objects.create_user('test', password='myTe$tPw#')
+        token = Token.objects.create(user=user)
+        self.open_host(DEAD_HOST)
+        resp = Client().post(
+            reverse('feeds_add'), {'url': DEAD_HOST + '/rss'}, HTTP_AUTHORIZATION='Token ' + token.key,
+        )
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp['Retry-After'], '60')
+        self.assertFalse(Feed.objects.exists())
+
+    def test_bulk_refresh_fails_fast_on_dead_host(self):
+        """
+        Test that the bulk refresher stops fetching from a host once its
+        circuit opens and saves the host's health.
+        """
+        for i in range(5):
+            Feed.objects.create(url='%s/rss/%d' % (DEAD_HOST, i))
+        Feed.objects.create(url=self.server.url('/rss'))
+        stats = BulkRefresher(concurrency=1, batch_size=2).run(Feed.objects.order_by('id'))
+        self.assertEqual((stats.ok, stats.failed, stats.deferred), (1, 2, 3))
+        self.assertEqual(Feed.objects.filter(status=Feed.STATUS_ERROR).count(), 2)
+        self.assertEqual(Feed.objects.filter(status=Feed.STATUS_PENDING, next_fetch_at__isnull=False).count(), 3)
+        self.assertEqual(HostHealth.objects.get(host='127.0.0.1:1').state, HostHealth.STATE_OPEN)
+        self.assertEqual(HostHealth.objects.get(host=host_of(self.server.url('/'))).state, HostHealth.STATE_CLOSED)
+
+
+def make_entries(count, start=0):
+    """
+    Parsed-entry stand-ins shaped like feedparser's output.
+    """
+    return [
+        {
+            'id': 'urn:entry:%d' % i,
+            'link': 'https://example.com/posts/%d' % i,
+            'title': 'Post %d' % i,
+            'summary': 'Summary %d' % i,
+            'published_parsed': (2020, 10, 6, 10, 0, i % 60, 1, 280, 0),
+        }
+        for i in range(start, start + count)
+    ]
+
+
+class SingleFlightTest(TransactionTestCase):
+    """
+    Tests for sharing concurrent fetches of the same feed.
+    """
+    def setUp(self):
+        self.server = FeedServer().__enter__()
+        self.server.documents['/rss'] = SAMPLE_RSS
+        self.feed = Feed.objects.create(url=self.server.url('/rss'))
+
+    def tearDown(self):
+        self.server.__exit__()
+
+    def test_single_flight(self):
+        """
+        Test that concurrent calls for a key share one call and its result or
+        exception, and later calls run again.
+        """
+        flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return len(calls)
+
+        joins = mock.patch.object(flight, '_join', wraps=flight._join)
+        with ThreadPoolExecutor(3) as executor, joins as join:
+            leader = executor.submit(flight.do, 'key', work)
+            started.wait(5)
+            followers = [executor.submit(flight.do, 'key', work) for _ in range(2)]
+            while join.call_count < 3:
+                threading.Event().wait(0.01)
+            release.set()
+            self.assertEqual(leader.result(), (1, False))
+            self.assertEqual([f.result() for f in followers], [(1, True), (1, True)])
+        self.assertFalse(flight.in_flight('key'))
+        self.assertEqual(flight.do('key', work), (2, False))
+
+        def fail():
+            raise ValueError('boom')
+        with self.assertRaises(ValueError):
+            flight.do('key', fail)
+        self.assertFalse(flight.in_flight('key'))
+
+    def test_concurrent_refreshes_fetch_once(self):
+        """
+        Test that refreshes of a feed while it's being fetched wait for that
+        fetch and get the feed it stored.
+        """
+        self.server.gate = threading.Event()
+        feeds = [Feed.objects.get(pk=self.feed.pk) for _ in range(3)]
+
+        def run(feed):
+            try:
+                return refresh_feed(feed)
+            finally:
+                close_old_connections()
+
+        flight = refresh.in_flight
+        joins = mock.patch.object(flight, '_join', wraps=flight._join)
+        with ThreadPoolExecutor(3) as executor, joins as join:
+            leader = executor.submit(run, feeds[0])
+            while not self.server.requests:
+                threading.Event().wait(0.01)
+            followers = [executor.submit(run, feed) for feed in feeds[1:]]
+            while join.call_count < 3:
+                threading.Event().wait(0.01)
+            self.server.gate.set()
+            self.assertTrue(all(f.result() for f in [leader] + followers))
+        self.assertEqual(self.server.requests, ['/rss'])
+        self.assertEqual([feed.title for feed in feeds], ['Sample Feed'] * 3)
+        self.assertEqual(self.feed.articles.count(), 2)
+
+    async def test_concurrent_async_refreshes_fetch_once(self):
+        """
+        Test that concurrent async refreshes share one fetch.
+        """
+        feeds = [await Feed.objects.aget(pk=self.feed.pk) for _ in range(2)]
+        try:
+            results = await asyncio.gather(*(refresh_feed_async(feed) for feed in feeds))
+        finally:
+            await close_shared_session()
+        self.assertEqual(results, [True, True])
+        self.assertEqual(self.server.requests, ['/rss'])
+        self.assertEqual([feed.status for feed in feeds], [Feed.STATUS_OK] * 2)
+
+    def test_recent_result_reused(self):
+        """
+        Test that with max_age a feed fetched moments ago isn't fetched again.
+        """
+        self.feed.url = self.server.url('/missing')
+        self.feed.save()
+        refresh_feed(self.feed)
+        self.assertEqual(self.feed.status, Feed.STATUS_ERROR)
+        self.assertFalse(refresh_feed(self.feed, max_age=60))
+        self.assertEqual(len(self.server.requests), 1)
+        Feed.objects.filter(pk=self.feed.pk).update(fetched_at=self.feed.fetched_at - timedelta(seconds=61))
+        self.feed.refresh_from_db()
+        self.assertFalse(refresh_feed(self.feed, max_age=60))
+        self.assertEqual(len(self.server.requests), 2)
+
+
+class StreamingParseTest(TransactionTestCase):
+    """
+    Tests for the size/time limits on fetches and incremental parsing.
+    """
+    def setUp(self):
+        self.server = FeedServer().__enter__()
+        self.server.documents['/rss'] = SAMPLE_RSS
+
+    def tearDown(self):
+        self.server.__exit__()
+
+    def big_feed(self, count):
+        items = ''.join(
+            '<item><title>Post %d</title><link>https://example.com/posts/%d</link></item>' % (i, i)
+            for i in range(count)
+        )
+        return SAMPLE_RSS.replace('<item>', items + '<item>', 1)
+
+    def test_header_stops_at_first_item(self):
+        """
+        Test that reading the feed metadata doesn't read past the first item.
+        """
+        body = self.big_feed(1000).encode('utf8')
+        chunks = [body[i:i + 1024] for i in range(0, len(body), 1024)]
+        consumed = []
+
+        def stream():
+            for chunk in chunks:
+                consumed.append(chunk)
+                yield chunk
+
+        info = parse_header(stream())
+        self.assertEqual(info['title'], 'Sample Feed')
+        self.assertEqual(info['link'], 'https://example.com/')
+        self.assertEqual(info['subtitle'], 'A feed for testing')
+        self.assertEqual(len(consumed), 1)
+        self.assertGreater(len(chunks), 50)
+
+    def test_entries_are_generated_incrementally(self):
+        """
+        Test that entries come out a batch at a time as the document is read.
+        """
+        body = self.big_feed(10).encode('utf8')
+        consumed = []
+
+        def stream():
+            for i in range(0, len(body), 100):
+                consumed.append(i)
+                yield body[i:i + 100]
+
+        with mock.patch('api.streamparse.ENTRY_BATCH_SIZE', 4):
+            entries = iter_entries(stream())
+            first = next(entries)
+        self.assertLess(len(consumed) * 100, len(body) / 2)
+        self.assertEqual(first['title'], 'Post 0')
+        rest = list(entries)
+        self.assertEqual(len(rest), 11)
+        self.assertEqual(rest[-1]['link'], 'https://example.com/posts/2')
+        self.assertEqual(rest[-1]['published_parsed'][:3], (2020, 10, 6))
+
+    def test_malformed_document_falls_back(self):
+        """
+        Test that a document that isn't well-formed XML is still parsed.
+        """
+        body = SAMPLE_RSS.replace('The second post.', 'Second&nbsp;post <br>').encode('utf8')
+        parsed = parse_body(body)
+        self.assertEqual(parsed['feed']['title'], 'Sample Feed')
+        self.assertEqual([e['title'] for e in parsed['entries']], ['First Post', 'Second Post'])
+        with self.assertRaises(FetchError):
+            parse_body(b'<html><body>Not a feed')
+
+    def test_broken_after_entries_falls_back(self):
+        """
+        Test that a document found to be broken after entries were parsed
+        hands the rest of them to feedparser, each entry once.
+        """
+        body = self.big_feed(2000).replace('The second post.', 'Second&nbsp;post <br>').encode('utf8')
+        self.assertGreater(len(body), 2 * 64 * 1024)
+        parsed = parse_body(body)
+        self.assertEqual(parsed['feed']['title'], 'Sample Feed')
+        titles = [entry['title'] for entry in parsed['entries']]
+        self.assertEqual(titles, ['Post %d' % i for i in range(2000)] + ['First Post', 'Second Post'])
+
+    def test_entries_parsed_outside_transaction(self):
+        """
+        Test that a refresh parses the entries before taking the write lock.
+        """
+        feed = Feed.objects.create(url=self.server.url('/rss'))
+        in_transaction = []
+
+        def entries():
+            in_transaction.append(connection.in_atomic_block)
+            yield from make_entries(2)
+
+        result = FetchResult(feed.url, 200, {}, b'', {'feed': {'title': 'Feed'}, 'entries': entries()})
+        apply_result(feed, result)
+        self.assertEqual(in_transaction, [False])
+        self.assertEqual(feed.articles.count(), 2)
+
+    @override_settings(FEED_FETCH_MAX_BYTES=1024)
+    def test_oversized_feed_fails(self):
+        """
+        Test that a feed bigger than FEED_FETCH_MAX_BYTES fails the fetch.
+        """
+        self.server.documents['/big'] = self.big_feed(100)
+        feed = Feed.objects.create(url=self.server.url('/big'))
+        with self.assertRaisesRegex(FetchError, 'larger than 1024 bytes'):
+            fetch_feed(feed.url)
+        self.assertFalse(refresh_feed(feed))
+        self.assertEqual(feed.status, Feed.STATUS_ERROR)
+        stats = BulkRefresher().run([feed])
+        self.assertEqual(stats.failed, 1)
+
+    def test_body_limits_without_content_length(self):
+        """
+        Test that the size cap and the deadline hold while reading the body.
+        """
+        class Response:
+            headers = {}
+
+            def read1(self, size):
+                return b'x' * 100
+
+        with self.assertRaisesRegex(FetchError, 'larger than 1000 bytes'):
+            list(iter_body('http://slow/', Response(), deadline=float('inf'), max_bytes=1000))
+        with self.assertRaisesRegex(FetchError, 'Timed out'):
+            list(iter_body('http://slow/', Response(), deadline=0))
+
+    def test_relative_links_keep_their_base(self):
+        """
+        Test that entries parsed apart from the document still resolve
+        relative links against the xml:base around them, or the feed's url.
+        """
+        atom = (
+            '<feed xmlns="http://www.w3.org/2005/Atom" xml:base="https://a.com/">'
+            '<title>A</title><link href="/"/>'
+            '<entry><id>1</id><title>One</title><link href="/e1"/></entry>'
+            '<entry xml:base="blog/"><id>2</id><title>Two</title><link href="e2"/></entry>'
+            '</feed>'
+        ).encode('utf8')
+        parsed = parse_body(atom, url='https://b.com/feed')
+        self.assertEqual(parsed['feed']['link'], 'https://a.com/')
+        self.assertEqual([e['link'] for e in parsed['entries']], ['https://a.com/e1', 'https://a.com/blog/e2'])
+
+        rss = SAMPLE_RSS.replace('https://example.com/posts/1', '/posts/1').encode('utf8')
+        with mock.patch('api.streamparse.ENTRY_BATCH_SIZE', 1):
+            entries = list(parse_body(rss, url='https://b.com/feed')['entries'])
+        self.assertEqual(entries[0]['link'], 'https://b.com/posts/1')
+
+
+class ArticleIngestTest(TestCase):
+    """
+    Tests for bulk, deduplicated article ingestion.
+    """
+    def setUp(self):
+        self.feed = Feed.objects.create(url='https://example.com/rss', status=Feed.STATUS_OK)
+
+    def test_large_feed_takes_a_few_queries(self):
+        """
+        Test that 500 new entries go in with chunked inserts, not 500 INSERTs.
+        """
+        # One key lookup, five chunked body lookups, body and article inserts
+        # and id lookups, the article count update and the search index insert.
+        with self.assertNumQueries(24):
+            articles = ingest_entries(self.feed, make_entries(500), chunk_size=100)
+        self.assertEqual(len(articles), 500)
+        self.assertEqual(self.feed.articles.count(), 500)
+        self.feed.refresh_from_db()
+        self.assertEqual(self.feed.article_count, 500)
+        self.assertEqual(self.feed.last_article_id, self.feed.articles.latest('id').id)
+
+    def test_existing_entries_are_skipped(self):
+        """
+        Test that re-ingesting known entries only costs the key lookup.
+        """
+        ingest_entries(self.feed, make_entries(10))
+        with self.assertNumQueries(1):
+            self.assertEqual(ingest_entries(self.feed, make_entries(10)), [])
+        articles = ingest_entries(self.feed, make_entries(15))
+        self.assertEqual(len(articles), 5)
+        self.assertEqual(self.feed.articles.count(), 15)
+
+    def test_dedupes_by_guid_and_url(self):
+        """
+        Test that entries matching an existing guid or url are skipped, as
+        are duplicates within the same document and entries without a link.
+        """
+        ingest_entries(self.feed, make_entries(1))
+        entries = make_entries(1)
+        entries[0]['id'] = 'urn:entry:new-guid-same-url'
+        entries += [
+            {'id': 'urn:entry:0', 'link': 'https://example.com/other'},
+            {'id': 'urn:entry:dup', 'link': 'https://example.com/dup'},
+            {'id': 'urn:entry:dup', 'link': 'https://example.com/dup'},
+            {'id': 'urn:entry:no-link', 'title': 'No link'},
+        ]
+        articles = ingest_entries(self.feed, entries)
+        self.assertEqual([a.url for a in articles], ['https://example.com/dup'])
+
+    def test_conflicts_are_not_published(self):
+        """
+        Test that entries whose url another feed already owns aren't
+        returned, counted or published.
+        """
+        other = Feed.objects.create(url='https://example.com/other', status=Feed.STATUS_OK)
+        ingest_entries(other, make_entries(2))
+        with mock.patch('api.ingest.new_articles') as published:
+            self.assertEqual(ingest_entries(self.feed, make_entries(2)), [])
+            published.assert_not_called()
+            articles = ingest_entries(self.feed, make_entries(3))
+            published.assert_called_once_with(self.feed)
+        self.assertEqual([a.guid for a in articles], ['urn:entry:2'])
+        self.assertEqual(articles[0].id, self.feed.articles.get().id)
+        self.feed.refresh_from_db()
+        self.assertEqual(self.feed.article_count, 1)
+
+    def test_entry_fields(self):
+        """
+        Test that entry fields map onto the article.
+        """
+        entries = make_entries(1)
+        entries[0]['content'] = [{'value': '<p>Full text</p>'}]
+        ingest_entries(self.feed, entries)
+        article = Article.objects.get()
+        self.assertEqual(article.guid, 'urn:entry:0')
+        self.assertEqual(article.title, 'Post 0')
+        self.assertEqual(article.summary, 'Summary 0')
+        self.assertEqual(article.content, '<p>Full text</p>')
+        self.assertEqual(article.published_at.isoformat(), '2020-10-06T10:00:00+00:00')
+        self.assertIsNotNone(article.loaded_at)
+
+
+class ArticleBodyTest(TestCase):
+    """
+    Tests for deduplicated, compressed article body storage.
+    """
+    client = Client()
+
+    def setUp(self):
+        self.user = User.objects.create_user('test', password='myTe$tPw#')
+        token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': 'Token ' + token.key}
+        self.feed = Feed.objects.create(url='https://example.com/rss', status=Feed.STATUS_OK)
+        self.feed.users.add(self.user)
+        self.mirror = Feed.objects.create(url='https://mirror.example.com/rss', status=Feed.STATUS_OK)
+        self.body = '<p>%s</p>' % ('Syndicated paragraph. ' * 200)
+        for feed in (self.feed, self.mirror):
+            entries = make_entries(2)
+            for entry in entries:
+                entry['link'] = entry['link'].replace('example.com', feed.url.split('/')[2])
+                entry['content'] = [{'value': self.body}]
+            ingest_entries(feed, entries)
+
+    def test_identical_bodies_stored_once(self):
+        """
+        Test that bodies shared by articles are stored once, compressed.
+        """
+        self.assertEqual(Article.objects.count(), 4)
+        # Summary 0, Summary 1 and the shared content.
+        self.assertEqual(ArticleBody.objects.count(), 3)
+        body = ArticleBody.objects.get(size=len(self.body))
+        self.assertLess(len(body.data), len(self.body) / 10)
+        self.assertEqual(Article.objects.filter(content_body=body).count(), 4)
+        self.assertEqual(Article.objects.get(url='https://example.com/posts/1').content, self.body)
+
+    def test_stored_bodies_not_compressed(self):
+        """
+        Test that only bodies that aren't stored yet get compressed.
+        """
+        feed = Feed.objects.create(url='https://copy.example.com/rss', status=Feed.STATUS_OK)
+        entries = make_entries(3)
+        for entry in entries:
+            entry['link'] = entry['link'].replace('example.com', 'copy.example.com')
+            entry['content'] = [{'value': self.body}]
+        with mock.patch('api.bodies.compress', wraps=compress) as compressed:
+            ingest_entries(feed, entries)
+        compressed.assert_called_once_with('Summary 2')
+        self.assertEqual(ArticleBody.objects.count(), 4)
+
+    def test_timeline_leaves_content_alone(self):
+        """
+        Test that listing articles only loads their summaries.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(reverse('timeline'), **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([a['summary'] for a in json.loads(resp.content)['results']], ['Summary 1', 'Summary 0'])
+        self.assertFalse(any('content_body' in query['sql'] for query in queries))
+
+    def test_article_detail(self):
+        """
+        Test that an article's content is returned by its detail endpoint,
+        for subscribers only.
+        """
+        article = Article.objects.get(url='https://example.com/posts/0')
+        resp = self.client.get(reverse('article_detail', args=[article.id]), **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        content = json.loads(resp.content)
+        self.assertEqual(content['content'], self.body)
+        self.assertEqual(content['summary'], 'Summary 0')
+        other = Article.objects.get(url='https://mirror.example.com/posts/0')
+        resp = self.client.get(reverse('article_detail', args=[other.id]), **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_orphans_deleted(self):
+        """
+        Test that only bodies no article uses any more are deleted.
+        """
+        self.assertEqual(delete_orphan_bodies(), 0)
+        self.mirror.delete()
+        self.assertEqual(delete_orphan_bodies(), 0)
+        self.feed.articles.filter(guid='urn:entry:0').delete()
+        self.assertEqual(delete_orphan_bodies(), 1)
+        self.assertEqual(ArticleBody.objects.count(), 2)
+
+
+class IdBitmapTest(TestCase):
+    """
+    Tests for the compressed id bitmap.
+    """
+    def test_round_trip(self):
+        bitmap = IdBitmap([1000005, 1000001, 1000900])
+        data = bitmap.to_bytes()
+        restored = IdBitmap.from_bytes(data)
+        self.assertEqual(list(restored), [1000001, 1000005, 1000900])
+        self.assertEqual(len(restored), 3)
+        self.assertIn(1000005, restored)
+        self.assertNotIn(1000002, restored)
+        self.assertNotIn(5, restored)
+        self.assertEqual(restored.count_above(1000001), 2)
+        self.assertEqual(restored.count_above(1), 3)
+        self.assertLess(len(data), 40)
+
+    def test_sparse_ids(self):
+        """
+        Test that iterating ids millions apart only visits the ids.
+        """
+        ids = [1000, 401000, 4001000, 4001001]
+        bitmap = IdBitmap.from_bytes(IdBitmap(ids).to_bytes())
+        started = time.monotonic()
+        self.assertEqual(list(bitmap), ids)
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    def test_discard_and_empty(self):
+        bitmap = IdBitmap([7])
+        bitmap.discard(7)
+        bitmap.discard(8)
+        self.assertEqual(len(bitmap), 0)
+        self.assertEqual(bitmap.to_bytes(), b'')
+        self.assertEqual(len(IdBitmap.from_bytes(b'')), 0)
+
+
+class ReadStateTest(TestCase):
+    """
+    Tests for the articles/<id>/read and feeds/<id>/read endpoints.
+    """
+    client = Client()
+
+    def setUp(self):
+        self.user = User.objects.create_user('test', password='myTe$tPw#')
+        token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': 'Token ' + token.key}
+        self.feed = Feed.objects.create(url='https://example.com/rss', status=Feed.STATUS_OK)
+        self.feed.users.add(self.user)
+        ingest_entries(self.feed, make_entries(5))
+        self.articles = list(self.feed.articles.order_by('id'))
+
+    def mark(self, article, read=True):
+        endpoint = reverse('article_read', args=[article.id])
+        if read:
+            return self.client.post(endpoint, **self.auth)
+        return self.client.delete(endpoint, **self.auth)
+
+    def state(self):
+        return ReadState.objects.filter(user=self.user, feed=self.feed).first()
+
+    def test_mark_read_and_unread(self):
+        """
+        Test that marking articles read/unread updates the unread count.
+        """
+        resp = self.mark(self.articles[1])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertJSONEqual(str(resp.content, encoding='utf8'), {'unread_count': 4})
+        # Marking it again is a no-op.
+        self.assertEqual(json.loads(self.mark(self.articles[1]).content), {'unread_count': 4})
+        self.assertTrue(is_read(self.state(), self.articles[1].id))
+        self.assertFalse(is_read(self.state(), self.articles[0].id))
+
+        resp = self.mark(self.articles[1], read=False)
+        self.assertEqual(json.loads(resp.content), {'unread_count': 5})
+        self.assertFalse(is_read(self.state(), self.articles[1].id))
+
+    def test_mark_all_read_then_unread_one(self):
+        """
+        Test marking a feed read and then one of its articles unread again.
+        """
+        resp = self.client.post(reverse('feed_read', args=[self.feed.id]), **self.auth)
+        self.assertEqual(json.loads(resp.content), {'unread_count': 0})
+        state = self.state()
+        self.assertEqual(state.read_up_to, self.articles[-1].id)
+        self.assertEqual(bytes(state.exceptions), b'')
+
+        self.assertEqual(json.loads(self.mark(self.articles[2], read=False).content), {'unread_count': 1})
+        self.assertFalse(is_read(self.state(), self.articles[2].id))
+        self.assertTrue(is_read(self.state(), self.articles[3].id))
+
+        # New articles arrive unread.
+        ingest_entries(self.feed, make_entries(2, start=5))
+        self.assertEqual(unread_counts(self.user), {self.feed.id: 3})
+
+    def test_must_be_subscribed(self):
+        """
+        Test that users can only mark articles of feeds they subscribe to.
+        """
+        other = Feed.objects.create(url='https://example.com/other', status=Feed.STATUS_OK)
+        ingest_entries(other, [{'id': 'x', 'link': 'https://example.com/x'}])
+        resp = self.mark(other.articles.get())
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.client.post(reverse('feed_read', args=[other.id]), **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class RetentionTest(TestCase):
+    """
+    Tests for pruning old articles (api/retention.py, prune_articles).
+    """
+    def setUp(self):
+        self.user = User.objects.create_user('test', password='myTe$tPw#')
+        self.feed = Feed.objects.create(url='https://example.com/rss', status=Feed.STATUS_OK)
+        self.feed.users.add(self.user)
+        # Published a second apart, oldest first, all long ago.
+        ingest_entries(self.feed, make_entries(10))
+        self.articles = list(self.feed.articles.order_by('id'))
+
+    def remaining(self):
+        return [article.title for article in self.feed.articles.order_by('id')]
+
+    def search_rows(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM %s' % SEARCH_TABLE)
+            return cursor.fetchone()[0]
+
+    def test_prunes_read_articles_past_newest_count(self):
+        """
+        Test that read articles older than the newest N are deleted, with the
+        counts, search rows and bodies that go with them.
+        """
+        mark_all_read(self.user, self.feed)
+        bodies = ArticleBody.objects.count()
+        stats = Pruner(count=3, days=None).run(Feed.objects.all())
+        self.assertEqual((stats.feeds, stats.articles, stats.kept_unread), (1, 7, 0))
+        self.assertEqual(self.remaining(), ['Post 7', 'Post 8', 'Post 9'])
+        self.feed.refresh_from_db()
+        state = ReadState.objects.get(user=self.user, feed=self.feed)
+        self.assertEqual((self.feed.article_count, state.read_count), (3, 3))
+        self.assertEqual(unread_counts(self.user), {self.feed.id: 0})
+        self.assertEqual(self.search_rows(), 3)
+        self.assertEqual(ArticleBody.objects.count(), bodies - 7)
+
+    def test_unread_articles_are_kept(self):
+        """
+        Test that an article a subscriber hasn't read is never pruned, and
+        that a subscriber who read nothing keeps the whole feed.
+        """
+        stats = Pruner(count=1, days=None).run(Feed.objects.all())
+        self.assertEqual((stats.articles, stats.feeds), (0, 0))
+        self.assertEqual(len(self.remaining()), 10)
+
+        mark_all_read(self.user, self.feed)
+        set_read(self.user, self.articles[2], read=False)
+        stats = Pruner(count=1, days=None).run(Feed.objects.all())
+        self.assertEqual((stats.articles, stats.kept_unread), (8, 1))
+        self.assertEqual(self.remaining(), ['Post 2', 'Post 9'])
+        self.feed.refresh_from_db()
+        self.assertEqual(unread_counts(self.user), {self.feed.id: 1})
+
+    def test_read_states_of_former_subscribers(self):
+        """
+        Test that read states of users no longer subscribed don't protect
+        articles but have their counts and exceptions kept right.
+        """
+        other = User.objects.create_user('other', password='myTe$tPw#')
+        for user in (self.user, other):
+            mark_all_read(user, self.feed)
+        set_read(other, self.articles[0], read=False)
+        set_read(other, self.articles[1], read=False)
+        Feed.users.through.objects.filter(user=other).delete()
+
+        Pruner(count=5, days=None).run(Feed.objects.all())
+        state = ReadState.objects.get(user=other, feed=self.feed)
+        self.assertEqual(state.read_count, 5)
+        self.assertEqual(state.exceptions, b'')
+
+    def test_policies(self):
+        """
+        Test that articles are kept by count or by age, and feeds' own
+        policies override the defaults.
+        """
+        mark_all_read(self.user, self.feed)
+        # Everything is years old, but the default count keeps all ten.
+        self.assertEqual(Pruner(days=30).run(Feed.objects.all()).articles, 0)
+        with override_settings(ARTICLE_RETENTION_COUNT=None, ARTICLE_RETENTION_DAYS=None):
+            self.assertEqual(Pruner().run(Feed.objects.all()).articles, 0)
+        Feed.objects.filter(pk=self.feed.pk).update(retention_count=6)
+        self.assertEqual(Pruner(count=2, days=None).run(Feed.objects.all()).articles, 4)
+        Feed.objects.filter(pk=self.feed.pk).update(retention_count=None, retention_days=36500)
+        self.assertEqual(Pruner(count=0, days=None).run(Feed.objects.all()).articles, 0)
+        Feed.objects.filter(pk=self.feed.pk).update(retention_days=30)
+        self.assertEqual(Pruner(count=0, days=None).run(Feed.objects.all()).articles, 5)
+        self.assertEqual(self.remaining(), ['Post 9'])
+
+    def test_dry_run_deletes_nothing(self):
+        """
+        Test that a dry run only reports what it would prune.
+        """
+        mark_all_read(self.user, self.feed)
+        stats = Pruner(count=3, days=None, dry_run=True).run(Feed.objects.all())
+        self.assertEqual(stats.articles, 7)
+        self.assertEqual(len(self.remaining()), 10)
+
+    def test_command_prunes_in_batches_and_archives(self):
+        """
+        Test that the command deletes in batches, archives what it deletes and
+        reports rows/sec.
+        """
+        mark_all_read(self.user, self.feed)
+        out = StringIO()
+        with tempfile.TemporaryDirectory() as directory:
+            with CaptureQueriesContext(connection) as queries:
+                call_command('prune_articles', '--keep', '2', '--days', '0', '--batch-size', '3',
+                             '--archive', directory, stdout=out)
+            deletes = [query for query in queries if query['sql'].startswith('DELETE FROM "api_article"')]
+            self.assertEqual(len(deletes), 3)
+            [name] = os.listdir(directory)
+            with gzip.open(os.path.join(directory, name), 'rt') as f:
+                records = [json.loads(line) for line in f]
+        self.assertIn('Pruned 8 articles from 1 feeds', out.getvalue())
+        self.assertIn('rows/sec', out.getvalue())
+        self.assertEqual([record['title'] for record in records], ['Post %d' % i for i in range(8)])
+        self.assertEqual(records[0]['summary'], 'Summary 0')
+        self.assertEqual(records[0]['published_at'], '2020-10-06T10:00:00Z')
+
+
+class FeedListTest(TestCase):
+    """
+    Tests for feeds endpoint.
+    """
+    client = Client()
+    endpoint = reverse('feeds_list')
+
+    def setUp(self):
+        self.user = User.objects.create_user('test', password='myTe$tPw#')
+        token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': 'Token ' + token.key}
+        # Duplicate titles so the cursor has to break ties on id.
+        for i in range(7):
+            feed = Feed.objects.create(url='https://example.com/%d' % i, title='Feed %d' % (i // 2),
+                                       status=Feed.STATUS_OK)
+            feed.users.add(self.user)
+        Feed.objects.create(url='https://example.com/not-mine', title='Not Mine')
+
+    def get(self, url, **params):
+        resp = self.client.get(url, params, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return json.loads(resp.content)
+
+    def test_feed_list_pages_through_all_feeds(self):
+        """
+        Test that following the next links walks every subscribed feed once, in order.
+        """
+        page = self.get(self.endpoint, limit=3)
+        seen = [feed['url'] for feed in page['results']]
+        pages = 1
+        while page['next']:
+            page = self.get(page['next'])
+            seen += [feed['url'] for feed in page['results']]
+            pages += 1
+        self.assertEqual(pages, 3)
+        self.assertEqual(seen, ['https://example.com/%d' % i for i in range(7)])
+
+    def test_feed_list_single_page(self):
+        """
+        Test that a list that fits on one page has no next link.
+        """
+        page = self.get(self.endpoint)
+        self.assertIsNone(page['next'])
+        self.assertEqual(len(page['results']), 7)
+        self.assertEqual(set(page['results'][0]), {'id', 'title', 'url', 'status'})
+
+    def test_feed_list_fields_projection(self):
+        """
+        Test that ?fields= limits the fields returned.
+        """
+        page = self.get(self.endpoint, fields='id,title,bogus')
+        self.assertEqual(set(page['results'][0]), {'id', 'title'})
+        # With no known fields the projection is ignored.
+        page = self.get(self.endpoint, fields='bogus')
+        self.assertEqual(set(page['results'][0]), {'id', 'title', 'url', 'status'})
+
+    def test_values_data_matches_serializer(self):
+        """
+        Test that the values_list() path serializes feeds as FeedSerializer does.
+        """
+        queryset = Feed.objects.filter(users=self.user.id).order_by('title', 'id')
+        for fields in (list(FeedSerializer.Meta.fields), ['status', 'url']):
+            data = FeedSerializer.values_data(FeedSerializer.values_queryset(queryset, fields), fields)
+            expected = [{name: feed[name] for name in fields} for feed in FeedSerializer(queryset, many=True).data]
+            self.assertEqual(data, expected)
+            self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(expected))
+
+    @skipUnless(msgpack, 'msgpack is not installed')
+    def test_feed_list_msgpack(self):
+        """
+        Test that the list comes as MessagePack to clients that ask for it.
+        """
+        resp = self.client.get(self.endpoint, {'limit': 3}, HTTP_ACCEPT='application/msgpack', **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp['Content-Type'], 'application/msgpack')
+        self.assertIn('Accept', resp['Vary'])
+        self.assertEqual(msgpack.unpackb(resp.content), self.get(self.endpoint, limit=3))
+
+    def test_feed_list_invalid_cursor(self):
+        """
+        Test to ensure a garbage cursor is a 404 rather than a server error.
+        """
+        resp = self.client.get(self.endpoint, {'cursor': 'not-a-cursor'}, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_feed_list_requires_auth(self):
+        """
+        Test to ensure anonymous users can't list feeds.
+        """
+        resp = self.client.get(self.endpoint)
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class TimelineTest(TestCase):
+    """
+    Tests for the timeline endpoint.
+    """
+    client = Client()
+    endpoint = reverse('timeline')
+
+    def setUp(self):
+        self.user = User.objects.create_user('test', password='myTe$tPw#')
+        token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': 'Token ' + token.key}
+        self.feeds = []
+        for f in range(4):
+            feed = Feed.objects.create(url='https://example.com/%d/rss' % f, status=Feed.STATUS_OK)
+            # Feeds 0 and 2 share timestamps so the merge has to break ties on id.
+            ingest_entries(feed, [
+                {
+                    'id': 'urn:%d:%d' % (f, i),
+                    'link': 'https://example.com/%d/%d' % (f, i),
+                    'title': 'Feed %d post %d' % (f, i),
+                    'published_parsed': (2020, 10, 6, 10, i, f % 2, 1, 280, 0),
+                }
+                for i in range(5)
+            ])
+            self.feeds.append(feed)
+        for feed in self.feeds[:3]:
+            feed.users.add(self.user)
+
+    def expected(self):
+        return list(
+            Article.objects.filter(feed__in=self.feeds[:3]).order_by('-published_at', '-id').values_list('id', flat=True)
+        )
+
+    def walk(self, **params):
+        resp = self.client.get(self.endpoint, params, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        page = json.loads(resp.content)
+        seen = [article['id'] for article in page['results']]
+        while page['next']:
+            page = json.loads(self.client.get(page['next'], **self.auth).content)
+            seen += [article['id'] for article in page['results']]
+        return seen
+
+    def test_timeline_merges_subscribed_feeds(self):
+        """
+        Test that paging through the timeline yields every subscribed feed's
+        articles once, newest first.
+        """
+        self.assertEqual(self.walk(limit=4), self.expected())
+        # Same again with the feeds spread over several merged queries.
+        with mock.patch('api.timeline.MAX_FEEDS_PER_QUERY', 2):
+            self.assertEqual(self.walk(limit=4), self.expected())
+        resp = self.client.get(self.endpoint, **self.auth)
+        article = json.loads(resp.content)['results'][0]
+        self.assertEqual(set(article), {'id', 'feed', 'title', 'url', 'summary', 'published_at'})
+
+    def test_timeline_unread_only(self):
+        """
+        Test that ?unread=1 leaves out read articles.
+        """
+        mark_all_read(self.user, self.feeds[0])
+        first = self.feeds[0].articles.order_by('id').first()
+        set_read(self.user, first, read=False)
+        read = self.feeds[1].articles.order_by('id').last()
+        set_read(self.user, read)
+
+        read_ids = set(self.feeds[0].articles.values_list('id', flat=True)) - {first.id} | {read.id}
+        expected = [id for id in self.expected() if id not in read_ids]
+        self.assertEqual(len(expected), 10)
+        self.assertEqual(self.walk(unread=1, limit=3), expected)
+        # Same again with the read states filtered in Python.
+        with mock.patch('api.timeline.MAX_FILTER_IDS', 0):
+            self.assertEqual(self.walk(unread=1, limit=3), expected)
+            self.assertEqual(self.walk(unread=1, limit=1), expected)
+
+    def test_timeline_page_cost_is_constant(self):
+        """
+        Test that a deep page takes as many queries as the first.
+        """
+        page = json.loads(self.client.get(self.endpoint, {'limit': 2}, **self.auth).content)
+        for _ in range(5):
+            page = json.loads(self.client.get(page['next'], **self.auth).content)
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(self.endpoint, {'limit': 2}, **self.auth)
+        with CaptureQueriesContext(connection) as deep:
+            self.client.get(page['next'], **self.auth)
+        self.assertEqual(len(first), len(deep))
+
+    def test_undated_articles_use_load_time(self):
+        """
+        Test that an entry without a date shows up as the newest article.
+        """
+        ingest_entries(self.feeds[1], [{'id': 'undated', 'link': 'https://example.com/undated'}])
+        page = json.loads(self.client.get(self.endpoint, **self.auth).content)
+        self.assertEqual(page['results'][0]['url'], 'https://example.com/undated')
+
+    def test_timeline_invalid_cursor(self):
+        """
+        Test to ensure a garbage cursor is a 404 rather than a server error.
+        """
+        resp = self.client.get(self.endpoint, {'cursor': encode_cursor('not a date', 1)}, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_timeline_requires_auth(self):
+        """
+        Test to ensure anonymous users can't read the timeline.
+        """
+        resp = self.client.get(self.endpoint)
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class FakeClock:
+    """
+    Stand-in for time.monotonic (or timezone.now, given a datetime) that only
+    moves when told to.
+    """
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        if isinstance(self.now, datetime):
+            self.now += timedelta(seconds=seconds)
+        else:
+            self.now += seconds
+
+
+class SearchTest(TestCase):
+    """
+    Tests for the search endpoint and the full-text article index.
+    """
+    client = Client()
+    endpoint = reverse('search')
+
+    def setUp(self):
+        self.user = User.objects.create_user('test', password='myTe$tPw#')
+        token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': 'Token ' + token.key}
+        self.feed = Feed.objects.create(url='https://example.com/rss', title='Gardening Weekly', status=Feed.STATUS_OK)
+        self.feed.users.add(self.user)
+        self.other = Feed.objects.create(url='https://other.example.com/rss', title='Other', status=Feed.STATUS_OK)
+        entries = make_entries(3)
+        entries[0].update(title='Tomatoes', summary='<p class="note">Growing them is easy.</p>')
+        entries[1].update(title='Growing beans', summary='Beans need support.')
+        entries[2].update(title='Compost', summary='Nothing about that here.')
+        ingest_entries(self.feed, entries)
+        other = make_entries(1, start=10)
+        other[0].update(title='Growing elsewhere')
+        ingest_entries(self.other, other)
+
+    def search(self, q, **params):
+        return self.client.get(self.endpoint, {'q': q, **params}, **self.auth)
+
+    def article_titles(self, q):
+        resp = self.search(q)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        return [article['title'] for article in json.loads(resp.content)['articles']]
+
+    def test_ranked_and_scoped(self):
+        """
+        Test that matches are stemmed, title matches rank first and only the
+        user's feeds are searched.
+        """
+        self.assertEqual(self.article_titles('grows'), ['Growing beans', 'Tomatoes'])
+        self.assertEqual(self.article_titles('growing beans'), ['Growing beans'])
+        self.assertEqual(self.article_titles('elsewhere'), [])
+
+    def test_common_terms(self):
+        """
+        Test that queries too common to rank return the newest matches, title
+        matches first.
+        """
+        with mock.patch('api.search.MAX_RANKED_MATCHES', 2):
+            self.assertEqual(self.article_titles('growing'), ['Growing beans', 'Tomatoes'])
+
+    def test_markup_and_syntax_ignored(self):
+        """
+        Test that html tags aren't indexed and query punctuation isn't
+        treated as search syntax.
+        """
+        self.assertEqual(self.article_titles('note'), [])
+        self.assertEqual(self.article_titles('"beans" (*'), ['Growing beans'])
+        self.assertEqual(self.article_titles('-- ""'), [])
+
+    def test_deleted_articles_leave_the_index(self):
+        """
+        Test that index rows go with their article.
+        """
+        self.feed.articles.filter(title='Tomatoes').delete()
+        self.assertEqual(self.article_titles('growing'), ['Growing beans'])
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM %s' % SEARCH_TABLE)
+            self.assertEqual(cursor.fetchone()[0], 3)
+        self.other.delete()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT count(*) FROM %s' % SEARCH_TABLE)
+            self.assertEqual(cursor.fetchone()[0], 2)
+
+    def test_feeds_and_limit(self):
+        """
+        Test that the user's feeds are matched on title and results limited.
+        """
+        content = json.loads(self.search('gardening').content)
+        self.assertEqual([feed['title'] for feed in content['feeds']], ['Gardening Weekly'])
+        self.assertEqual(json.loads(self.search('other').content)['feeds'], [])
+        content = json.loads(self.search('growing', limit='1').content)
+        self.assertEqual(len(content['articles']), 1)
+
+    def test_errors(self):
+        """
+        Test that a query is required and the endpoint needs authentication.
+        """
+        resp = self.search('')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(resp.content), {'q': ['This field is required.']})
+        resp = self.client.get(self.endpoint, {'q': 'beans'})
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class LRUCacheTest(TestCase):
+    """
+    Tests for the in-process LRU cache.
+    """
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_entries_expire(self):
+        clock = FakeClock()
+        cache = LRUCache(ttl=10, clock=clock)
+        cache.set('a', 1)
+        clock.advance(9)
+        self.assertEqual(cache.get('a'), 1)
+        clock.advance(1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+
+class CachedTokenAuthenticationTest(TestCase):
+    """
+    Tests for the cached token authentication.
+    """
+    client = Client()
+    endpoint = reverse('test')
+
+    def setUp(self):
+        get_local_cache().clear()
+        self.user = User.objects.create_user('test', password='myTe$tPw#')
+        self.token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': 'Token ' + self.token.key}
+
+    def test_token_lookup_is_cached(self):
+        """
+        Test that only the first request looks the token up.
+        """
+        with self.assertNumQueries(1):
+            resp = self.client.get(self.endpoint, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            resp = self.client.get(self.endpoint, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_deleted_token_is_rejected(self):
+        """
+        Test that deleting a token invalidates its cache entry.
+        """
+        self.client.get(self.endpoint, **self.auth)
+        self.token.delete()
+        resp = self.client.get(self.endpoint, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivated_user_is_rejected(self):
+        """
+        Test that changes to the user invalidate the cache entry.
+        """
+        self.client.get(self.endpoint, **self.auth)
+        self.user.is_active = False
+        self.user.save()
+        resp = self.client.get(self.endpoint, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_shared_cache_backend(self):
+        """
+        Test that a shared cache warms the in-process cache.
+        """
+        with self.settings(TOKEN_AUTH_SHARED_CACHE='default'):
+            self.client.get(self.endpoint, **self.auth)
+            # Another process would start with an empty in-process cache.
+            get_local_cache().clear()
+            with self.assertNumQueries(0):
+                resp = self.client.get(self.endpoint, **self.auth)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+            self.token.delete()
+            get_local_cache().clear()
+            resp = self.client.get(self.endpoint, **self.auth)
+            self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class ConcurrentSubscribeTest(TransactionTestCase):
+    """
+    Tests for parallel subscribes to the same url.
+    """
+    def test_parallel_adds_of_same_url(self):
+        """
+        Test that racing subscribes all succeed and share one feed row.
+        """
+        users = [User.objects.create_user('test%d' % i, password='myTe$tPw#') for i in range(8)]
+        url = 'https://example.com/popular'
+        barrier = threading.Barrier(len(users))
+
+        def add(user):
+            barrier.wait()
+            try:
+                return subscribe(user.id, url).id
+            finally:
+                close_old_connections()
+
+        with ThreadPoolExecutor(len(users)) as executor:
+            feed_ids = list(executor.map(add, users))
+
+        self.assertEqual(Feed.objects.count(), 1)
+        self.assertEqual(set(feed_ids), {Feed.objects.get().id})
+        self.assertEqual(Feed.objects.get().users.count(), len(users))
+
+
+class FeedListCacheTest(TestCase):
+    """
+    Tests for the feed list response cache and ETags.
+    """
+    client = Client()
+    endpoint = reverse('feeds_list')
+
+    def setUp(self):
+        get_cache().clear()
+        self.server = FeedServer().__enter__()
+        self.server.documents['/rss'] = SAMPLE_RSS
+        self.user = User.objects.create_user('test', password='myTe$tPw#')
+        token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': 'Token ' + token.key}
+        self.feed = subscribe(self.user.id, self.server.url('/rss'))
+
+    def tearDown(self):
+        self.server.__exit__()
+
+    def get(self, **extra):
+        return self.client.get(self.endpoint, **self.auth, **extra)
+
+    def titles(self):
+        return [feed['title'] for feed in json.loads(self.get().content)['results']]
+
+    def test_etag_per_format(self):
+        """
+        Test that JSON and MessagePack responses of the same list have different ETags.
+        """
+        etag = self.get()['ETag']
+        resp = self.get(HTTP_ACCEPT='application/msgpack', HTTP_IF_NONE_MATCH=etag)
+        if msgpack is None:
+            self.assertEqual(resp.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+        else:
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertNotEqual(resp['ETag'], etag)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_repeat_list_is_cached(self):
+        """
+        Test that an unchanged list is served for the cost of the version check.
+        """
+        first = self.get()
+        with CaptureQueriesContext(connection) as queries:
+            second = self.get()
+        self.assertEqual(len(queries), 1)
+        self.assertIn('api_subscriptionversion', queries[0]['sql'])
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_matching_etag_is_not_modified(self):
+        """
+        Test that If-None-Match with the current ETag gets an empty 304.
+        """
+        etag = self.get()['ETag']
+        with self.assertNumQueries(1):
+            resp = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.content, b'')
+        # Other query strings are different responses.
+        resp = self.client.get(self.endpoint, {'fields': 'id'}, HTTP_IF_NONE_MATCH=etag, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_subscribe_and_unsubscribe_invalidate(self):
+        """
+        Test that adding and removing feeds shows up straight away.
+        """
+        etag = self.get()['ETag']
+        resp = self.client.post(reverse('feeds_add'), {'url': 'https://example.com/other'}, **self.auth)
+        other = json.loads(resp.content)['id']
+        resp = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.content)['results']), 2)
+
+        resp = self.client.delete(reverse('feed_detail', args=[other]), **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(len(json.loads(self.get().content)['results']), 1)
+        self.assertTrue(Feed.objects.filter(pk=other).exists())
+        resp = self.client.delete(reverse('feed_detail', args=[other]), **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_feed_changes_invalidate_subscribers(self):
+        """
+        Test that a refresh changing a feed's title or status invalidates its
+        subscribers' lists, and one that doesn't leaves them cached.
+        """
+        self.assertEqual(self.titles(), [''])
+        refresh_feed(self.feed)
+        self.assertEqual(self.titles(), ['Sample Feed'])
+
+        version = get_version(self.user.id)
+        refresh_feed(self.feed)
+        self.assertEqual(get_version(self.user.id), version)
+
+        self.server.documents.pop('/rss')
+        refresh_feed(self.feed)
+        self.assertEqual(json.loads(self.get().content)['results'][0]['status'], Feed.STATUS_ERROR)
+
+
+class FeedImportTest(TransactionTestCase):
+    """
+    Tests for feeds/import endpoint.
+    """
+    endpoint = reverse('feeds_import')
+
+    def setUp(self):
+        self.server = FeedServer().__enter__()
+        self.server.documents['/a'] = SAMPLE_RSS
+        self.server.documents['/b'] = SAMPLE_RSS.replace('Sample Feed', 'Feed B')
+        self.user = User.objects.create_user('test', password='myTe$tPw#')
+        token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': 'Token ' + token.key}
+
+    def tearDown(self):
+        self.server.__exit__()
+
+    def read_lines(self, resp):
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        content = b''.join(resp.streaming_content).decode('utf8')
+        return {line.get('url'): line for line in map(json.loads, content.splitlines())}
+
+    def test_import_json_urls(self):
+        """
+        Test importing a JSON list of urls reports a line per url.
+        """
+        known = Feed.objects.create(url='https://example.com/known', title='Known', status=Feed.STATUS_OK)
+        urls = [self.server.url('/a'), self.server.url('/b'), self.server.url('/missing'),
+                self.server.url('/a'), known.url, 'not a url']
+        resp = self.client.post(self.endpoint, json.dumps({'urls': urls}), content_type='application/json',
+                                **self.auth)
+        lines = self.read_lines(resp)
+
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[self.server.url('/a')]['title'], 'Sample Feed')
+        self.assertEqual(lines[self.server.url('/b')]['title'], 'Feed B')
+        self.assertEqual(lines[self.server.url('/missing')]['status'], Feed.STATUS_ERROR)
+        self.assertIn('404', lines[self.server.url('/missing')]['error'])
+        self.assertEqual(lines[known.url]['title'], 'Known')
+        self.assertEqual(lines['not a url']['error'], 'Invalid URL.')
+        self.assertEqual(self.user.feed_set.count(), 4)
+        # The known feed was not fetched.
+        self.assertEqual(sorted(self.server.requests), ['/a', '/b', '/missing'])
+
+    def test_import_refuses_hosts_that_are_down(self):
+        """
+        Test that urls on a host whose circuit is open are reported and not
+        subscribed to.
+        """
+        HostHealth.objects.create(host=host_of(DEAD_HOST), state=HostHealth.STATE_OPEN,
+                                  opened_at=datetime.now(timezone.utc))
+        urls = [self.server.url('/a'), DEAD_HOST + '/rss']
+        resp = self.client.post(self.endpoint, json.dumps(urls), content_type='application/json', **self.auth)
+        lines = self.read_lines(resp)
+        self.assertEqual(lines[self.server.url('/a')]['title'], 'Sample Feed')
+        self.assertIn('not responding', lines[DEAD_HOST + '/rss']['error'])
+        self.assertEqual(lines[DEAD_HOST + '/rss']['retry_after'], 60 * 5)
+        self.assertEqual(list(self.user.feed_set.values_list('url', flat=True)), [self.server.url('/a')])
+        self.assertFalse(Feed.objects.filter(url=DEAD_HOST + '/rss').exists())
+
+    def test_import_opml(self):
+        """
+        Test importing an OPML document, as the body and as a file upload.
+        """
+        opml = '''<?xml version="1.0"?>
+<opml version="1.0">
+  <head><title>Subscriptions</title></head>
+  <body>
+    <outline text="News">
+      <outline type="rss" text="A" xmlUrl="%s"/>
+    </outline>
+    <outline type="rss" text="B" xmlUrl="%s"/>
+  </body>
+</opml>''' % (self.server.url('/a'), self.server.url('/b'))
+        resp = self.client.post(self.endpoint, opml, content_type='text/x-opml', **self.auth)
+        self.assertEqual(set(self.read_lines(resp)), {self.server.url('/a'), self.server.url('/b')})
+
+        upload = SimpleUploadedFile('feeds.opml', opml.encode('utf8'))
+        resp = self.client.post(self.endpoint, {'file': upload}, **self.auth)
+        self.assertEqual(set(self.read_lines(resp)), {self.server.url('/a'), self.server.url('/b')})
+        self.assertEqual(self.user.feed_set.count(), 2)
+
+    def test_import_invalid_body(self):
+        """
+        Test to ensure bad request for bodies that aren't a list of urls or OPML.
+        """
+        resp = self.client.post(self.endpoint, json.dumps({'feeds': []}), content_type='application/json',
+                                **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.client.post(self.endpoint, '<html></html>', content_type='text/x-opml', **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_subscribe_many_query_count(self):
+        """
+        Test that subscribing to many urls takes a handful of queries, not
+        a few per url (SQLite's variable limit splits the bulk inserts).
+        """
+        Feed.objects.create(url='https://example.com/0')
+        SubscriptionVersion.objects.create(user=self.user)
+        urls = ['https://example.com/%d' % i for i in range(200)]
+        with CaptureQueriesContext(connection) as queries:
+            feeds = subscribe_many(self.user.id, urls + urls[:10])
+        # Plus one to bump the feed list version.
+        self.assertLess(len(queries), 13)
+        self.assertEqual([feed.url for feed in feeds], urls)
+        self.assertEqual(self.user.feed_set.count(), 200)
+
+
+class ScheduleTest(TestCase):
+    """
+    Tests for the adaptive refresh intervals.
+    """
+    def setUp(self):
+        self.now = datetime(2020, 10, 6, 12, 0, tzinfo=timezone.utc)
+        self.feed = Feed(url='https://example.com/rss', fetch_interval=3600)
+
+    def test_interval_follows_observed_changes(self):
+        """
+        Test that a feed changing every 10 hours drifts towards a 10 hour interval.
+        """
+        self.feed.changed_at = self.now
+        for i in range(1, 30):
+            schedule_changed(self.feed, self.now + timedelta(hours=10 * i))
+        self.assertAlmostEqual(self.feed.fetch_interval, 10 * 3600, delta=60)
+        self.assertEqual(self.feed.next_fetch_at, self.feed.changed_at + timedelta(seconds=self.feed.fetch_interval))
+
+    def test_unchanged_stretches_interval_up_to_max(self):
+        schedule_unchanged(self.feed, self.now)
+        self.assertEqual(self.feed.fetch_interval, 4500)
+        for i in range(100):
+            schedule_unchanged(self.feed, self.now)
+        self.assertEqual(self.feed.fetch_interval, 24 * 60 * 60)
+
+    def test_errors_back_off(self):
+        delays = []
+        for i in range(8):
+            schedule_error(self.feed, self.now)
+            delays.append((self.feed.next_fetch_at - self.now).total_seconds())
+        self.assertEqual(delays[:4], [3600, 7200, 14400, 28800])
+        self.assertEqual(delays[-1], 24 * 60 * 60)
+        schedule_unchanged(self.feed, self.now)
+        self.assertEqual(self.feed.error_count, 0)
+
+
+class FeedSchedulerTest(TestCase):
+    """
+    Tests for the priority queue scheduler, driven by a fake clock.
+    """
+    def setUp(self):
+        self.clock = FakeClock(datetime(2020, 10, 6, 12, 0, tzinfo=timezone.utc))
+        self.refreshed = []
+        self.scheduler = FeedScheduler(refresh=self.refresh, clock=self.clock, window=timedelta(hours=2),
+                                       reload_every=timedelta(hours=1))
+
+    def refresh(self, feeds):
+        # Stand-in for a real refresh: every feed comes back unchanged.
+        for feed in feeds:
+            self.refreshed.append(feed.url)
+            schedule_unchanged(feed, self.clock())
+            feed.save()
+
+    def make_feed(self, name, due_in=None):
+        next_fetch_at = self.clock() + timedelta(seconds=due_in) if due_in is not None else None
+        return Feed.objects.create(url='https://example.com/' + name, next_fetch_at=next_fetch_at,
+                                   fetch_interval=3600)
+
+    def test_only_due_feeds_are_refreshed(self):
+        self.make_feed('new')
+        self.make_feed('overdue', due_in=-60)
+        self.make_feed('soon', due_in=600)
+        self.make_feed('later', due_in=6 * 3600)
+
+        self.scheduler.tick()
+        self.assertEqual(sorted(self.refreshed), ['https://example.com/new', 'https://example.com/overdue'])
+        self.assertEqual(self.scheduler.seconds_until_next(), 600)
+
+        self.refreshed.clear()
+        self.clock.advance(600)
+        # Just loading the one due feed and the stand-in refresh's save.
+        with self.assertNumQueries(2):
+            self.scheduler.tick()
+        self.assertEqual(self.refreshed, ['https://example.com/soon'])
+
+        self.refreshed.clear()
+        self.clock.advance(60)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.scheduler.tick(), [])
+
+    def test_rescheduled_feeds_come_back_around(self):
+        self.make_feed('feed')
+        self.scheduler.tick()
+        # Unchanged, so the next fetch is 4500s out.
+        self.clock.advance(4499)
+        self.scheduler.tick()
+        self.assertEqual(len(self.refreshed), 1)
+        self.clock.advance(1)
+        self.scheduler.tick()
+        self.assertEqual(len(self.refreshed), 2)
+
+    def test_failed_tick_is_retried(self):
+        """
+        Test that a refresh that raises doesn't stop run(), the feeds are
+        refreshed again once the retry delay is up.
+        """
+        self.make_feed('feed')
+        self.scheduler.retry_delay = timedelta(seconds=30)
+        calls, sleeps = [], []
+
+        def refresh(feeds):
+            calls.append([feed.url for feed in feeds])
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            self.refresh(feeds)
+
+        class Stop(Exception):
+            pass
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            if len(sleeps) == 2:
+                raise Stop
+            self.clock.advance(seconds)
+
+        self.scheduler.refresh = refresh
+        with self.assertLogs('api.scheduler', 'ERROR'), self.assertRaises(Stop):
+            self.scheduler.run(sleep=sleep)
+        self.assertEqual(calls, [['https://example.com/feed']] * 2)
+        self.assertEqual(self.refreshed, ['https://example.com/feed'])
+        self.assertEqual(sleeps[0], 30)
+
+    def test_skips_feeds_refreshed_elsewhere(self):
+        feed = self.make_feed('feed', due_in=60)
+        self.scheduler.tick()
+        Feed.objects.filter(pk=feed.pk).update(next_fetch_at=self.clock() + timedelta(hours=1))
+        self.clock.advance(60)
+        self.scheduler.tick()
+        self.assertEqual(self.refreshed, [])
+
+
+class EventStreamTest(TransactionTestCase):
+    """
+    Tests for the events endpoint (api/events.py).
+    """
+    factory = AsyncRequestFactory()
+
+    def setUp(self):
+        get_local_cache().clear()
+        self.user = User.objects.create_user('test', password='myTe$tPw#')
+        token = Token.objects.create(user=self.user)
+        self.auth = {'headers': {'Authorization': 'Token ' + token.key}}
+        self.feed = Feed.objects.create(url='https://example.com/rss')
+        self.feed.users.add(self.user)
+
+    async def open_stream(self):
+        resp = await async_views.events(self.factory.get('/events', **self.auth))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp['Content-Type'], 'text/event-stream')
+        # The generator behind the response, which closing the response
+        # doesn't close (a disconnect cancels it under ASGI).
+        stream = async_views.event_stream(self.user.id)
+        self.assertEqual(await anext(stream), 'retry: 5000\n\n')
+        return stream
+
+    async def next_event(self, stream, action):
+        """
+        Run the sync action and return the next chunk the stream sends.
+        """
+        chunk = asyncio.ensure_future(anext(stream))
+        await sync_to_async(action)()
+        return await asyncio.wait_for(chunk, 5)
+
+    def articles_event(self, feed):
+        feed.refresh_from_db()
+        return 'event: articles\ndata: {"feed": %d, "article_count": %d, "last_article_id": %d}\n\n' % (
+            feed.id, feed.article_count, feed.last_article_id,
+        )
+
+    async def test_new_articles_pushed(self):
+        """
+        Test that a stream is sent an event when a feed the user follows
+        gets new articles.
+        """
+        stream = await self.open_stream()
+        try:
+            chunk = await self.next_event(stream, lambda: ingest_entries(self.feed, make_entries(2)))
+            self.assertEqual(chunk, await sync_to_async(self.articles_event)(self.feed))
+        finally:
+            await stream.aclose()
+        self.assertEqual(get_broker()._channels, {})
+
+    async def test_stream_follows_subscriptions(self):
+        """
+        Test that a stream picks up feeds the user subscribes to after it
+        opened and drops ones they unsubscribe from.
+        """
+        stream = await self.open_stream()
+        try:
+            chunk = await self.next_event(stream, lambda: subscribe(self.user.id, 'https://example.com/other'))
+            self.assertEqual(chunk, 'event: subscriptions\ndata: {}\n\n')
+            other = await Feed.objects.aget(url='https://example.com/other')
+            chunk = await self.next_event(stream, lambda: ingest_entries(other, make_entries(1)))
+            self.assertEqual(chunk, await sync_to_async(self.articles_event)(other))
+
+            chunk = await self.next_event(stream, lambda: unsubscribe(self.user.id, self.feed.id))
+            self.assertEqual(chunk, 'event: subscriptions\ndata: {}\n\n')
+            self.assertNotIn('feed:%d' % self.feed.id, get_broker()._channels)
+            self.assertIn('feed:%d' % other.id, get_broker()._channels)
+        finally:
+            await stream.aclose()
+
+    async def test_keepalive_and_end(self):
+        """
+        Test that an idle stream sends keepalives and ends after
+        EVENTS_STREAM_SECONDS.
+        """
+        with self.settings(EVENTS_HEARTBEAT_SECONDS=0.05, EVENTS_STREAM_SECONDS=0.3):
+            stream = await self.open_stream()
+            chunks = [chunk async for chunk in stream]
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(set(chunks), {': keepalive\n\n'})
+        self.assertEqual(get_broker()._channels, {})
+
+    async def test_events_requires_auth(self):
+        """
+        Test that the events endpoint needs a token.
+        """
+        resp = await async_views.events(self.factory.get('/events'))
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_slow_stream_keeps_newest_events(self):
+        """
+        Test that a stream's queue drops its oldest events when full.
+        """
+        async def run():
+            subscription = Subscription()
+            broker = InProcessBroker()
+            broker.add(subscription, ['feed:1'])
+            for n in range(3):
+                await sync_to_async(broker.publish)('feed:1', n)
+            return [await subscription.get(1) for _ in range(2)], await subscription.get(0.01)
+
+        with self.settings(EVENTS_QUEUE_SIZE=2):
+            self.assertEqual(asyncio.run(run()), ([1, 2], None))
+
+class AsyncFeedViewsTest(TestCase):
+    """
+    Tests for the async versions of the feeds/add and feeds endpoints.
+    """
+    factory = AsyncRequestFactory()
+
+    def setUp(self):
+        get_local_cache().clear()
+        self.server = FeedServer().__enter__()
+        self.server.documents['/rss'] = SAMPLE_RSS
+        self.user = User.objects.create_user('test', password='myTe$tPw#')
+        token = Token.objects.create(user=self.user)
+        self.auth = {'headers': {'Authorization': 'Token ' + token.key}}
+
+    def tearDown(self):
+        self.server.__exit__()
+
+    async def add(self, data, **extra):
+        request = self.factory.post('/feeds/add', json.dumps(data), content_type='application/json', **extra)
+        try:
+            return await async_views.feed_create(request)
+        finally:
+            # Let the fetch it started finish.
+            await asyncio.gather(*refresh.background_refreshes)
+            await close_shared_session()
+
+    async def test_async_feed_add_queues_fetch(self):
+        """
+        Test that the async feeds/add returns the feed pending and fetches it
+        in the background, like FeedCreate.
+        """
+        resp = await self.add({'url': self.server.url('/rss')}, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        content = json.loads(resp.content)
+        self.assertEqual(content['status'], Feed.STATUS_PENDING)
+        feed = await Feed.objects.aget(url=self.server.url('/rss'))
+        self.assertEqual((feed.title, feed.status), ('Sample Feed', Feed.STATUS_OK))
+        self.assertEqual(await feed.articles.acount(), 2)
+        self.assertTrue(await feed.users.filter(pk=self.user.pk).aexists())
+
+    async def test_async_feed_add_errors(self):
+        """
+        Test the async feeds/add error responses.
+        """
+        resp = await self.add({'url': self.server.url('/rss')})
+        self.assertEqual(resp.status_code, status.HTTP_401_UNAUTHORIZED)
+        resp = await self.add({}, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(json.loads(resp.content), {'url': ['This field is required.']})
+        resp = await async_views.feed_create(self.factory.get('/feeds/add', **self.auth))
+        self.assertEqual(resp.status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+        resp = await self.add({'url': self.server.url('/missing')}, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        feed = await Feed.objects.aget(url=self.server.url('/missing'))
+        self.assertEqual(feed.status, Feed.STATUS_ERROR)
+
+    async def test_async_feed_add_refused_while_host_down(self):
+        """
+        Test that the async feeds/add refuses a host whose circuit is open.
+        """
+        await HostHealth.objects.acreate(
+            host=host_of(DEAD_HOST), state=HostHealth.STATE_OPEN, opened_at=datetime.now(timezone.utc),
+        )
+        resp = await self.add({'url': DEAD_HOST + '/rss'}, **self.auth)
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertTrue(int(resp['Retry-After']) > 0)
+        self.assertFalse(await Feed.objects.aexists())
+
+    async def test_lifespan_shutdown(self):
+        """
+        Test that the ASGI application cancels the background fetches and
+        closes the shared aiohttp session on lifespan shutdown.
+        """
+        with mock.patch.dict(os.environ):
+            from rssreader import asgi
+        messages = asyncio.Queue()
+        for type in ('lifespan.startup', 'lifespan.shutdown'):
+            messages.put_nowait({'type': type})
+        sent = []
+
+        async def send(message):
+            sent.append(message['type'])
+
+        self.server.gate = threading.Event()
+        request = self.factory.post(
+            '/feeds/add', json.dumps({'url': self.server.url('/rss')}), content_type='application/json', **self.auth,
+        )
+        self.assertEqual((await async_views.feed_create(request)).status_code, status.HTTP_202_ACCEPTED)
+        [task] = refresh.background_refreshes
+        # Wait for the fetch to be in flight.
+        while not self.server.requests:
+            await asyncio.sleep(0.01)
+        session = get_shared_session()
+        try:
+            await asgi.application({'type': 'lifespan'}, messages.get, send)
+        finally:
+            self.server.gate.set()
+        self.assertTrue(task.cancelled())
+        self.assertTrue(session.closed)
+        self.assertEqual((await Feed.objects.aget(url=self.server.url('/rss'))).status, Feed.STATUS_PENDING)
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+
+    async def test_async_feed_list(self):
+        """
+        Test that the async feeds endpoint pages like the DRF one.
+        """
+        for i in range(3):
+            feed = await Feed.objects.acreate(url='https://example.com/%d' % i, title='Feed %d' % i)
+            await feed.users.aadd(self.user)
+        resp = await async_views.feed_list(self.factory.get('/feeds', {'limit': 2, 'fields': 'title'}, **self.auth))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        content = json.loads(resp.content)
+        self.assertEqual(content['results'], [{'title': 'Feed 0'}, {'title': 'Feed 1'}])
+        self.assertIn('cursor=', content['next'])
+
+        cursor = parse_qs(urlsplit(content['next']).query)['cursor'][0]
+        resp = await async_views.feed_list(self.factory.get('/feeds', {'cursor': cursor, 'limit': 2}, **self.auth))
+        content = json.loads(resp.content)
+        self.assertEqual([feed['title'] for feed in content['results']], ['Feed 2'])
+        self.assertIsNone(content['next'])
+
+    @skipUnless(msgpack, 'msgpack is not installed')
+    async def test_async_feed_list_msgpack(self):
+        """
+        Test that the async feeds endpoint negotiates MessagePack.
+        """
+        await asubscribe(self.user.id, 'https://example.com/rss')
+        headers = dict(self.auth['headers'], Accept='application/msgpack')
+        resp = await async_views.feed_list(self.factory.get('/feeds', {'fields': 'url'}, headers=headers))
+        self.assertEqual(resp['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(resp.content), {'next': None, 'results': [{'url': 'https://example.com/rss'}]})
+        resp = await async_views.feed_list(self.factory.get('/feeds', **self.auth))
+        self.assertEqual(resp['Content-Type'], 'application/json')
+
+    async def test_async_feed_list_etag(self):
+        """
+        Test that the async feeds endpoint answers a matching ETag with a 304.
+        """
+        get_cache().clear()
+        await asubscribe(self.user.id, 'https://example.com/rss')
+        resp = await async_views.feed_list(self.factory.get('/feeds', **self.auth))
+        etag = resp['ETag']
+        headers = dict(self.auth['headers'], **{'If-None-Match': etag})
+        resp = await async_views.feed_list(self.factory.get('/feeds', headers=headers))
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        await asubscribe(self.user.id, 'https://example.com/other')
+        resp = await async_views.feed_list(self.factory.get('/feeds', headers=headers))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.content)['results']), 2)
+
+
+class DatabaseSettingsTest(TransactionTestCase):
+    """
+    Tests for the database tuning and its benchmark command.
+    """
+    def test_sqlite_pragmas(self):
+        """
+        Test that SQLite connections run in WAL mode with synchronous=NORMAL.
+        """
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+    def test_benchmark_db(self):
+        """
+        Test that the benchmark reports both workloads and cleans up after itself.
+        """
+        out = StringIO()
+        call_command('benchmark_db', '--seconds', '0.2', '--feeds', '5', '--readers', '2', '--writers', '1',
+                     stdout=out)
+        self.assertIn('reads: ', out.getvalue())
+        self.assertIn('writes: ', out.getvalue())
+        self.assertFalse(Feed.objects.exists())
+        self.assertFalse(Article.objects.exists())
+
+
+class BenchmarkTest(TransactionTestCase):
+    """
+    Tests for the API benchmark command.
+    """
+    def test_benchmark_api(self):
+        """
+        Test that every endpoint is driven without errors, the results are
+        saved and compared, and the seeded data is removed.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'results.json')
+            args = ['--users', '3', '--feeds', '5', '--subscriptions', '6', '--requests', '4', '--concurrency', '2']
+            call_command('benchmark_api', *args, '--output', output, stdout=StringIO())
+            with open(output) as f:
+                results = json.load(f)
+            self.assertEqual(list(results['endpoints']), ['users/register', 'users/login', 'feeds/add', 'feeds'])
+            for stats in results['endpoints'].values():
+                self.assertEqual(stats['requests'], 4)
+                self.assertEqual(stats['errors'], 0)
+                self.assertGreater(stats['queries']['mean'], 0)
+
+            out = StringIO()
+            call_command('benchmark_api', *args, '--endpoint', 'feeds', '--compare', output, stdout=out)
+            self.assertIn('Compared with', out.getvalue())
+            self.assertIn('feeds: ', out.getvalue())
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(Feed.objects.exists())
+
+
+@override_settings(METRICS_ENABLED=True)
+class MetricsTest(TestCase):
+    """
+    Tests for the request/fetch metrics middleware and endpoint.
+    """
+    def setUp(self):
+        metrics.clear()
+        # A new client, the middleware stack is built per client.
+        self.client = Client()
+        self.user = User.objects.create_user('test', password='myTe$tPw#')
+        token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': 'Token ' + token.key}
+
+    def scrape(self):
+        resp = self.client.get(reverse('metrics'))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp['Content-Type'], metrics.CONTENT_TYPE)
+        return resp.content.decode('utf8').splitlines()
+
+    def test_request_metrics(self):
+        """
+        Test that requests are counted and timed per url name, with their
+        query counts.
+        """
+        metrics.instrument(connection)
+        with metrics.track_queries() as queries:
+            self.client.get(reverse('feeds_list'), **self.auth)
+        self.assertGreater(queries.queries, 0)
+        self.client.get(reverse('feeds_list'))
+        lines = self.scrape()
+        self.assertIn('rssreader_requests_total{view="feeds_list",method="GET",status="200"} 1', lines)
+        self.assertIn('rssreader_requests_total{view="feeds_list",method="GET",status="401"} 1', lines)
+        self.assertIn('rssreader_request_duration_seconds_count{view="feeds_list",method="GET"} 2', lines)
+        self.assertIn('rssreader_request_duration_seconds_bucket{view="feeds_list",method="GET",le="+Inf"} 2', lines)
+        self.assertIn('rssreader_request_db_queries_sum{view="feeds_list",method="GET"} %s' % float(queries.queries), lines)
+
+    async def test_async_request_queries(self):
+        """
+        Test that queries made through sync_to_async are counted against the
+        async request that made them.
+        """
+        async def view(request):
+            await User.objects.acount()
+            await User.objects.acount()
+            return HttpResponse()
+
+        # The test database connection was opened before metrics were on.
+        await sync_to_async(metrics.instrument)(connection)
+        middleware = metrics.MetricsMiddleware(view)
+        await middleware(AsyncRequestFactory().get('/'))
+        lines = metrics.render().splitlines()
+        self.assertIn('rssreader_request_db_queries_sum{view="unresolved",method="GET"} 2.0', lines)
+
+    def test_fetch_metrics(self):
+        """
+        Test that outbound fetches are timed by outcome.
+        """
+        with FeedServer() as server:
+            server.documents['/rss'] = SAMPLE_RSS
+            server.etags['/rss'] = '"v1"'
+            fetch_feed(server.url('/rss'))
+            fetch_feed(server.url('/rss'), etag='"v1"')
+            with self.assertRaises(FetchError):
+                fetch_feed(server.url('/missing'))
+        lines = self.scrape()
+        for outcome in ('ok', 'not_modified', 'error'):
+            self.assertIn('rssreader_feed_fetch_duration_seconds_count{outcome="%s"} 1' % outcome, lines)
+
+    def test_histogram_render(self):
+        """
+        Test that histogram buckets are cumulative and labels escaped.
+        """
+        histogram = metrics.Histogram('test_seconds', 'Test.', ('name',), buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value, 'a"b')
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{name="a\\"b",le="1"} 2',
+            'test_seconds_bucket{name="a\\"b",le="5"} 3',
+            'test_seconds_bucket{name="a\\"b",le="+Inf"} 4',
+            'test_seconds_sum{name="a\\"b"} 14.5',
+            'test_seconds_count{name="a\\"b"} 4',
+        ])
+
+    @override_settings(METRICS_ENABLED=False, METRICS_SLOW_REQUEST_QUERIES=0)
+    def test_slow_request_logging(self):
+        """
+        Test that requests over a threshold are logged, even with metrics off.
+        """
+        with self.assertLogs('api.metrics', 'WARNING') as logs:
+            self.client.get(reverse('feeds_list'), **self.auth)
+        self.assertIn('Slow request GET /feeds (feeds_list)', logs.output[0])
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_404_NOT_FOUND)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled(self):
+        """
+        Test that with metrics off the middleware drops out and nothing is
+        recorded.
+        """
+        self.client.get(reverse('feeds_list'), **self.auth)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, status.HTTP_404_NOT_FOUND)
+        with self.settings(METRICS_ENABLED=True):
+            self.assertNotIn('rssreader_requests_total{', metrics.render())
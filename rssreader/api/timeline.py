@@ -0,0 +1,174 @@
+"""
+The per-user timeline: the newest articles across every feed a user follows.
+
+Joining articles to Feed.users and sorting gets slower with every
+subscription, the database has to collect the articles of every feed before
+it can sort them. Instead each feed is read newest first off the (feed,
+published_at, id) index, at most a page per feed, and those per-feed streams
+are merged. The position in the timeline is the (published_at, id) of the
+last article seen, so page N costs the same as page 1.
+
+Unread articles are filtered in SQL from the feed's read state, unless its
+exceptions are too many to pass as parameters. Those feeds are read a page at
+a time and filtered in Python instead.
+"""
+import heapq
+import itertools
+from datetime import datetime
+
+from django.db import connection
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+
+from api.bitmap import IdBitmap
+from api.bodies import load_bodies
+from api.models import Article, Feed, ReadState
+from api.pagination import TitleCursorPagination, decode_cursor, encode_cursor
+
+TIMELINE_FIELDS = ['id', 'feed', 'title', 'url', 'summary_body', 'published_at']
+# Per-feed queries are UNION ALLed into one statement, in batches that stay
+# under SQLite's compound select and bound parameter limits.
+MAX_FEEDS_PER_QUERY = 100
+MAX_PARAMS_PER_QUERY = 900
+# Read states with more exceptions than this are applied in Python.
+MAX_FILTER_IDS = 500
+
+
+def sort_key(article):
+    return (article.published_at, article.id)
+
+
+def unread_filter(state):
+    """
+    Q matching the articles that are unread under state (see ReadState),
+    None if it has too many exceptions to put in a query.
+    """
+    if state is None:
+        return Q()
+    exceptions = IdBitmap.from_bytes(state.exceptions)
+    if len(exceptions) > MAX_FILTER_IDS:
+        return None
+    q = Q(id__gt=state.read_up_to)
+    read = [id for id in exceptions if id > state.read_up_to]
+    if read:
+        q &= ~Q(id__in=read)
+    unread = [id for id in exceptions if id <= state.read_up_to]
+    if unread:
+        q |= Q(id__in=unread)
+    return q
+
+
+def feed_query(feed_id, limit, before=None, filter=None):
+    """
+    The newest limit articles of one feed older than the before position.
+    """
+    queryset = Article.objects.filter(feed_id=feed_id, published_at__isnull=False)
+    if filter is not None:
+        queryset = queryset.filter(filter)
+    if before is not None:
+        published_at, id = before
+        queryset = queryset.filter(Q(published_at__lt=published_at) | Q(published_at=published_at, id__lt=id))
+    return queryset.order_by('-published_at', '-id').only(*TIMELINE_FIELDS)[:limit]
+
+
+def unread_stream(feed_id, limit, before, state):
+    """
+    The articles of one feed older than the before position that are unread
+    under state, newest first, read limit at a time and checked in Python.
+    """
+    exceptions = IdBitmap.from_bytes(state.exceptions)
+    while True:
+        page = list(feed_query(feed_id, limit, before))
+        for article in page:
+            if (article.id <= state.read_up_to) == (article.id in exceptions):
+                yield article
+        if len(page) < limit:
+            return
+        before = sort_key(page[-1])
+
+
+def batches(queries):
+    batch, params = [], 0
+    for sql, query_params in queries:
+        if batch and (len(batch) >= MAX_FEEDS_PER_QUERY or params + len(query_params) > MAX_PARAMS_PER_QUERY):
+            yield batch
+            batch, params = [], 0
+        batch.append((sql, query_params))
+        params += len(query_params)
+    if batch:
+        yield batch
+
+
+def merged_query(batch, limit):
+    """
+    One statement for the newest limit articles across a batch of per-feed
+    queries. Each is wrapped as a subquery so it keeps its own LIMIT and
+    index scan.
+    """
+    parts, params = [], []
+    for i, (sql, query_params) in enumerate(batch):
+        parts.append('SELECT * FROM (%s) AS feed_%d' % (sql, i))
+        params.extend(query_params)
+    qn = connection.ops.quote_name
+    sql = '%s ORDER BY %s DESC, %s DESC LIMIT %d' % (
+        ' UNION ALL '.join(parts), qn('published_at'), qn('id'), limit,
+    )
+    return Article.objects.raw(sql, params)
+
+
+def get_timeline(user, limit, before=None, unread=False):
+    """
+    The newest limit articles (only the unread ones if unread) across the
+    user's feeds that come after the before position, newest first.
+    """
+    states = {}
+    if unread:
+        states = {state.feed_id: state for state in ReadState.objects.filter(user=user)}
+
+    queries = []
+    streams = []
+    for feed_id, article_count in Feed.objects.filter(users=user).values_list('id', 'article_count'):
+        filter = None
+        if unread:
+            state = states.get(feed_id)
+            article_count -= state.read_count if state else 0
+            filter = unread_filter(state)
+        # Skip feeds that can't contribute anything.
+        if article_count <= 0:
+            continue
+        if unread and filter is None:
+            streams.append(unread_stream(feed_id, limit, before, state))
+        else:
+            queries.append(feed_query(feed_id, limit, before, filter).query.sql_with_params())
+
+    streams += [merged_query(batch, limit) for batch in batches(queries)]
+    articles = list(itertools.islice(heapq.merge(*streams, key=sort_key, reverse=True), limit))
+    load_bodies(articles, 'summary_body')
+    return articles
+
+
+class TimelineCursorPagination(TitleCursorPagination):
+    """
+    Keyset pagination for the timeline, the cursor is the (published_at, id)
+    of the last article on the page.
+    """
+    page_size_setting = ('TIMELINE_PAGE_SIZE', 50)
+    max_page_size_setting = ('TIMELINE_MAX_PAGE_SIZE', 200)
+
+    def get_position(self, request):
+        cursor = request.GET.get(self.cursor_query_param)
+        if not cursor:
+            return None
+        published_at, id = decode_cursor(cursor)
+        try:
+            return datetime.fromisoformat(published_at), id
+        except ValueError:
+            raise NotFound('Invalid cursor')
+
+    def paginate_timeline(self, user, request, unread=False):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        return self.set_page(get_timeline(user, self.page_size + 1, self.get_position(request), unread))
+
+    def cursor_for(self, row):
+        return encode_cursor(row.published_at.isoformat(), row.id)
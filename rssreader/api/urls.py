@@ -1,11 +1,32 @@
+from django.conf import settings
 from django.urls import path
 from rest_framework.authtoken.views import obtain_auth_token
-from api import views
+from api import async_views, views
+
+if settings.ASYNC_FEED_VIEWS:
+    feed_create = async_views.feed_create
+    feed_list = async_views.feed_list
+else:
+    feed_create = views.FeedCreate.as_view()
+    feed_list = views.FeedList.as_view()
 
 urlpatterns = [
     path('users/register', views.UserCreate.as_view(), name='user_register'),
     path('users/login', views.UserLogin.as_view(), name='user_login'),
     path('test', views.TestView.as_view(), name='test'),
-    path('feeds/add', views.FeedCreate.as_view(), name='feeds_add'),
-    path('feeds', views.FeedList.as_view(), name='feeds_list'),
+    path('feeds/add', feed_create, name='feeds_add'),
+    path('feeds/import', views.FeedImport.as_view(), name='feeds_import'),
+    path('feeds', feed_list, name='feeds_list'),
+    path('feeds/<int:pk>', views.FeedDetail.as_view(), name='feed_detail'),
+    path('feeds/<int:pk>/read', views.FeedRead.as_view(), name='feed_read'),
+    path('articles/<int:pk>', views.ArticleDetail.as_view(), name='article_detail'),
+    path('articles/<int:pk>/read', views.ArticleRead.as_view(), name='article_read'),
+    path('timeline', views.Timeline.as_view(), name='timeline'),
+    path('search', views.Search.as_view(), name='search'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
+
+# The event stream needs ASGI, under WSGI each open stream would hold a
+# worker thread.
+if settings.ASYNC_FEED_VIEWS:
+    urlpatterns.append(path('events', async_views.events, name='events'))
@@ -1,14 +1,32 @@
-import feedparser
+import json
 
+from django.conf import settings
 from django.contrib.auth.models import User
-from django.shortcuts import render
+from django.db import transaction
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render
+from django.utils.cache import patch_vary_headers
 from rest_framework import generics, status
 from rest_framework.authtoken.models import Token
 from rest_framework.authtoken.views import ObtainAuthToken
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.parsers import JSONParser, MultiPartParser
 from rest_framework.permissions import AllowAny, IsAuthenticated
 
-from api.models import Feed
-from api.serializers import UserSerializer, FeedSerializer
+from api import metrics
+from api.feedcache import cache_key, get_cache, get_cache_timeout, get_version, is_not_modified, make_etag
+from api.health import CircuitOpen, HostUnavailable, check_host, host_of, open_hosts
+from api.models import Article, Feed
+from api.opml import OPMLError, parse_opml
+from api.pagination import TitleCursorPagination
+from api.parsers import OPMLParser, TextXMLOPMLParser, XMLOPMLParser
+from api.readstate import mark_all_read, set_read, unread_count
+from api.refresh import get_reuse_seconds
+from api.search import get_page_size, search_articles, search_feeds
+from api.serializers import ArticleDetailSerializer, ArticleSerializer, UserSerializer, FeedSerializer
+from api.subscriptions import subscribe_many, unsubscribe
+from api.timeline import TimelineCursorPagination
+from api.workers import get_pool, refresh_concurrently
 
 from rest_framework.views import APIView
 from rest_framework.response import Response
@@ -57,25 +75,231 @@ class FeedCreate(generics.CreateAPIView):
     permission_classes = (IsAuthenticated,)
 
     def create(self, request, *args, **kwargs):
-        # TODO Need error handling (what if bad url or other error)
-        url = request.data['url']
-        d = feedparser.parse(url)
+        """
+        Subscribe the user to the feed and hand the fetch off to the worker
+        pool, the feed's title and metadata are filled in asynchronously.
+        Refused with a 503 if the feed's host is known to be down.
+        """
         user = self.get_serializer_context()['request'].user
 
         context = {
             'user_id': user.id,
-            'feed_title': d['feed']['title'],
         }
 
-        serializer = self.get_serializer(data=request.data, context=context, partial=True)
+        serializer = self.get_serializer(data=request.data, context=context)
         serializer.is_valid(raise_exception=True)
+        try:
+            check_host(serializer.validated_data['url'])
+        except CircuitOpen as e:
+            raise HostUnavailable(e)
         self.perform_create(serializer)
-        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+        feed = serializer.instance
+        if feed.status != Feed.STATUS_OK:
+            # Only queue once the feed row is visible to the worker threads.
+            transaction.on_commit(lambda: get_pool().submit(feed.id))
+
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+class FeedImport(APIView):
+    """
+    Subscribe to many feeds at once, from an OPML export (as the request body
+    or a multipart 'file') or JSON (a list of urls or {"urls": [...]}).
+
+    The response streams one JSON object per line per url as its fetch
+    finishes, feeds we already have are reported straight away. Urls on a
+    host whose circuit is open aren't subscribed to, as in FeedCreate, their
+    lines say so with the retry_after seconds.
+    """
+    permission_classes = (IsAuthenticated,)
+    parser_classes = (JSONParser, OPMLParser, XMLOPMLParser, TextXMLOPMLParser, MultiPartParser)
+
+    def get_urls(self, request):
+        data = request.data
+        if 'file' in request.FILES:
+            try:
+                urls = parse_opml(request.FILES['file'].read())
+            except OPMLError as e:
+                raise ValidationError({'file': [str(e)]})
+        elif isinstance(data, dict) and 'urls' in data:
+            urls = data['urls']
+        else:
+            urls = data
+
+        if not isinstance(urls, list) or not all(isinstance(url, str) for url in urls):
+            raise ValidationError({'urls': ['Expected a list of urls.']})
+        max_urls = getattr(settings, 'FEED_IMPORT_MAX_URLS', 5000)
+        if len(urls) > max_urls:
+            raise ValidationError({'urls': ['Ensure this list has no more than %d urls.' % max_urls]})
+        return [url.strip() for url in urls]
+
+    def post(self, request):
+        urls = self.get_urls(request)
+        max_length = Feed._meta.get_field('url').max_length
+        valid = [url for url in urls if url.startswith(('http://', 'https://')) and len(url) <= max_length]
+        invalid = sorted(set(urls) - set(valid))
+        # Refused like feeds/add refuses them.
+        down = open_hosts(valid)
+        unavailable = {url: HostUnavailable(down[host_of(url)]) for url in valid if host_of(url) in down}
+
+        feeds = subscribe_many(request.user.id, [url for url in valid if url not in unavailable])
+        return StreamingHttpResponse(self.stream(feeds, invalid, unavailable), content_type='application/x-ndjson')
+
+    def stream(self, feeds, invalid, unavailable):
+        for url in invalid:
+            yield self.line({'url': url, 'error': 'Invalid URL.'})
+        for url, error in unavailable.items():
+            yield self.line({'url': url, 'error': error.detail, 'retry_after': error.wait})
+        pending = []
+        for feed in feeds:
+            if feed.status == Feed.STATUS_OK:
+                yield self.line(FeedSerializer(feed).data)
+            else:
+                pending.append(feed)
+        for feed in refresh_concurrently(pending, max_age=get_reuse_seconds()):
+            data = FeedSerializer(feed).data
+            if feed.status == Feed.STATUS_ERROR:
+                data['error'] = feed.last_error
+            yield self.line(data)
+
+    def line(self, data):
+        return json.dumps(data) + '\n'
 
 class FeedList(generics.ListAPIView):
     serializer_class = FeedSerializer
     permission_classes = (IsAuthenticated,)
+    pagination_class = TitleCursorPagination
 
     def get_queryset(self):
-        user = self.get_serializer_context()['request'].user
-        return Feed.objects.filter(users=user.id)
+        return Feed.objects.filter(users=self.request.user.id)
+
+    def list_data(self, request):
+        """
+        A page of the list, read straight from the database rows: only the
+        columns the ?fields= projection needs (plus the pagination keys),
+        as tuples rather than model instances.
+        """
+        fields = FeedSerializer.output_fields(request)
+        page = self.paginate_queryset(FeedSerializer.values_queryset(self.get_queryset(), fields))
+        return {'next': self.paginator.get_next_link(), 'results': FeedSerializer.values_data(page, fields)}
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        # JSON or MessagePack (see api/renderers.py).
+        patch_vary_headers(response, ['Accept'])
+        return response
+
+    def list(self, request, *args, **kwargs):
+        """
+        Serve the list from the cache under the user's version (see
+        api/feedcache.py), or a 304 if the client already has it.
+        """
+        version = get_version(request.user.id)
+        if version is None:
+            return Response(self.list_data(request))
+
+        key = cache_key(request, request.user.id, version)
+        etag = make_etag(key, request.accepted_renderer.media_type)
+        if is_not_modified(request, etag):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        cache = get_cache()
+        data = cache.get(key) if cache else None
+        if data is None:
+            data = self.list_data(request)
+            if cache:
+                cache.set(key, data, get_cache_timeout())
+        return Response(data, headers={'ETag': etag})
+
+class FeedDetail(APIView):
+    """
+    Unsubscribe from a feed (DELETE).
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def delete(self, request, pk):
+        if not unsubscribe(request.user.id, pk):
+            raise NotFound()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+class ArticleDetail(APIView):
+    """
+    An article with its full content.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request, pk):
+        queryset = Article.objects.select_related('summary_body', 'content_body').filter(feed__users=request.user)
+        return Response(ArticleDetailSerializer(get_object_or_404(queryset, pk=pk)).data)
+
+class ArticleRead(APIView):
+    """
+    Mark an article read (POST) or unread (DELETE).
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get_article(self, request, pk):
+        queryset = Article.objects.select_related('feed').filter(feed__users=request.user)
+        return get_object_or_404(queryset, pk=pk)
+
+    def post(self, request, pk):
+        article = self.get_article(request, pk)
+        state = set_read(request.user, article, read=True)
+        return Response({'unread_count': unread_count(state, article.feed)})
+
+    def delete(self, request, pk):
+        article = self.get_article(request, pk)
+        state = set_read(request.user, article, read=False)
+        return Response({'unread_count': unread_count(state, article.feed)})
+
+class FeedRead(APIView):
+    """
+    Mark every article in a feed read.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, pk):
+        feed = get_object_or_404(Feed.objects.filter(users=request.user), pk=pk)
+        state = mark_all_read(request.user, feed)
+        return Response({'unread_count': unread_count(state, feed)})
+
+class Timeline(APIView):
+    """
+    Newest articles across all the user's feeds, ?unread=1 for just the
+    unread ones.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        paginator = TimelineCursorPagination()
+        unread = request.query_params.get('unread') in ('1', 'true')
+        page = paginator.paginate_timeline(request.user, request, unread=unread)
+        return paginator.get_paginated_response(ArticleSerializer(page, many=True).data)
+
+class Search(APIView):
+    """
+    Search the user's feeds (title/url) and articles (full text) with ?q=,
+    best article matches first.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': ['This field is required.']})
+        limit = get_page_size(request)
+        feeds = search_feeds(request.user, query, limit)
+        articles = search_articles(request.user, query, limit)
+        return Response({
+            'feeds': FeedSerializer(feeds, many=True, context={'request': request}).data,
+            'articles': ArticleSerializer(articles, many=True).data,
+        })
+
+def metrics_view(request):
+    """
+    Request and fetch metrics in the Prometheus text format, a 404 unless
+    METRICS_ENABLED.
+    """
+    if not metrics.is_enabled():
+        raise Http404()
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
@@ -0,0 +1,139 @@
+"""
+Background fetch worker pool.
+
+Feed fetches are slow and unpredictable, so rather than holding a request
+worker for the whole remote round-trip the views queue a job here and return
+straight away. A fixed number of threads pull feed ids off a bounded queue and
+refresh them.
+"""
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from api.refresh import refresh_feed, refresh_feed_by_id
+
+logger = logging.getLogger(__name__)
+
+
+class FetchWorkerPool:
+    """
+    Bounded job queue serviced by a fixed number of worker threads.
+
+    With workers set to 0 jobs are run inline when submitted, which is handy
+    for scripts and single process setups.
+    """
+    def __init__(self, workers=4, queue_size=1000, job=refresh_feed_by_id):
+        self.workers = workers
+        self.job = job
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, feed_id):
+        """
+        Queue a fetch for feed_id. Returns False if the queue is full, in
+        which case the feed is left pending for the next refresh to pick up.
+        """
+        if self.workers == 0:
+            self._run_job(feed_id)
+            return True
+
+        self._start()
+        try:
+            self._queue.put_nowait(feed_id)
+        except queue.Full:
+            logger.warning('Fetch queue full, feed %s left pending', feed_id)
+            return False
+        return True
+
+    def join(self):
+        """
+        Block until every queued job has been processed.
+        """
+        self._queue.join()
+
+    def shutdown(self):
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._worker, name='feed-fetch-%d' % i, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            feed_id = self._queue.get()
+            try:
+                if feed_id is None:
+                    return
+                self._run_job(feed_id)
+            finally:
+                # Worker threads hold their own connections, don't leak them.
+                close_old_connections()
+                self._queue.task_done()
+
+    def _run_job(self, feed_id):
+        try:
+            self.job(feed_id)
+        except Exception:
+            logger.exception('Fetch job failed for feed %s', feed_id)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the process wide worker pool, created from settings on first use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = FetchWorkerPool(
+                workers=getattr(settings, 'FEED_FETCH_WORKERS', 4),
+                queue_size=getattr(settings, 'FEED_FETCH_QUEUE_SIZE', 1000),
+            )
+        return _pool
+
+
+def _refresh_in_thread(feed, max_age=None):
+    try:
+        refresh_feed(feed, max_age)
+    except Exception:
+        logger.exception('Fetch failed for feed %s', feed.id)
+    finally:
+        close_old_connections()
+    return feed
+
+
+def refresh_concurrently(feeds, workers=None, max_age=None):
+    """
+    Refresh the feeds on a bounded thread pool of its own, yielding each feed
+    as soon as its fetch finishes. For callers that want to wait on (and
+    report) the results rather than hand them off to the background pool.
+    max_age is passed on to refresh_feed.
+    """
+    workers = workers or getattr(settings, 'FEED_IMPORT_WORKERS', 8)
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(_refresh_in_thread, feed, max_age) for feed in feeds]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            # Stop early if the consumer goes away (e.g. client disconnect).
+            for future in futures:
+                future.cancel()
@@ -3,6 +3,19 @@ ASGI config for rssreader project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Under ASGI the feed endpoints are served by the async views in
+api/async_views.py and the /events stream is enabled, set
+RSSREADER_ASYNC_VIEWS=0 to use the DRF views (and no /events) instead.
+Run it with an ASGI server, e.g.:
+
+    uvicorn rssreader.asgi:application --workers 4
+
+Django doesn't handle the ASGI lifespan protocol, so application answers it
+itself: on shutdown the fetches feeds/add started are cancelled (their feeds
+stay pending for the scheduler) and the shared aiohttp session they used
+(see api/aiofetch.py) is closed, rather than leaving its connections for the
+interpreter to drop.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/3.1/howto/deployment/asgi/
 """
@@ -12,5 +25,29 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'rssreader.settings')
+os.environ.setdefault('RSSREADER_ASYNC_VIEWS', '1')
+
+django_application = get_asgi_application()
+
+# App imports once the settings are configured and the apps loaded.
+from api.aiofetch import close_shared_session  # noqa: E402
+from api.refresh import cancel_background_refreshes  # noqa: E402
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await cancel_background_refreshes()
+            await close_shared_session()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
 
-application = get_asgi_application()
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.1/ref/settings/
 """
 
+import importlib.util
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -43,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -76,12 +79,61 @@ WSGI_APPLICATION = 'rssreader.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/3.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# Configured from the environment, SQLite unless RSSREADER_DB_ENGINE is
+# postgresql (see the Production Database section of the README).
+DB_ENGINE = os.environ.get('RSSREADER_DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('RSSREADER_DB_NAME', 'rssreader'),
+            'USER': os.environ.get('RSSREADER_DB_USER', ''),
+            'PASSWORD': os.environ.get('RSSREADER_DB_PASSWORD', ''),
+            'HOST': os.environ.get('RSSREADER_DB_HOST', ''),
+            'PORT': os.environ.get('RSSREADER_DB_PORT', ''),
+            # Keep connections open between requests instead of reconnecting
+            # for every one, checking they're still alive before reuse.
+            'CONN_MAX_AGE': int(os.environ.get('RSSREADER_DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
+    }
+    if os.environ.get('RSSREADER_DB_POOL') == '1':
+        # psycopg 3's connection pool (Django 5.1+) instead, it can't be
+        # combined with persistent connections.
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.environ.get('RSSREADER_DB_POOL_MIN', 2)),
+            'max_size': int(os.environ.get('RSSREADER_DB_POOL_MAX', 20)),
+        }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('RSSREADER_DB_NAME', BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # WAL lets readers carry on while a refresh is writing, and
+                # with WAL synchronous=NORMAL can only lose the last commits
+                # on power loss, never corrupt the database.
+                'init_command': 'PRAGMA journal_mode=%s; PRAGMA synchronous=%s' % (
+                    os.environ.get('RSSREADER_SQLITE_JOURNAL_MODE', 'WAL'),
+                    os.environ.get('RSSREADER_SQLITE_SYNCHRONOUS', 'NORMAL'),
+                ),
+                # Seconds to wait for the write lock before "database is locked".
+                'timeout': float(os.environ.get('RSSREADER_SQLITE_BUSY_TIMEOUT', 20)),
+                # Take the write lock at BEGIN, a transaction that reads first
+                # can't then fail to upgrade its lock (which the busy timeout
+                # doesn't help with).
+                'transaction_mode': 'IMMEDIATE',
+            },
+            # Use a file for the test database too, the in-memory one fails
+            # concurrent writers with "table is locked" instead of waiting.
+            'TEST': {
+                'NAME': BASE_DIR / 'test_db.sqlite3',
+            },
+        }
     }
-}
 
 
 # Password validation
@@ -103,6 +155,39 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# Password hashing (see api/passwords.py). RSSREADER_PASSWORD_HASHER picks
+# the hasher new passwords get: pbkdf2, argon2 (needs argon2-cffi) or bcrypt
+# (needs bcrypt). Hashes made by the others still verify and are rehashed
+# with it on the next login, as are hashes made with other parameters.
+PASSWORD_HASHER = os.environ.get('RSSREADER_PASSWORD_HASHER', 'pbkdf2')
+PASSWORD_HASHER_CLASSES = {
+    'pbkdf2': 'api.passwords.PBKDF2PasswordHasher',
+    'argon2': 'api.passwords.Argon2PasswordHasher',
+    'bcrypt': 'api.passwords.BCryptSHA256PasswordHasher',
+}
+PASSWORD_HASHERS = [PASSWORD_HASHER_CLASSES[PASSWORD_HASHER]] + [
+    path for name, path in PASSWORD_HASHER_CLASSES.items() if name != PASSWORD_HASHER
+] + [
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+# argon2id cost: passes, memory in KiB and lanes. The defaults are OWASP's
+# minimum (19 MiB, 2 passes, 1 lane), Django's 100 MiB over 8 lanes costs
+# more memory per concurrent login than it buys.
+PASSWORD_ARGON2_TIME_COST = int(os.environ.get('RSSREADER_ARGON2_TIME_COST', 2))
+PASSWORD_ARGON2_MEMORY_COST = int(os.environ.get('RSSREADER_ARGON2_MEMORY_COST', 19 * 1024))
+PASSWORD_ARGON2_PARALLELISM = int(os.environ.get('RSSREADER_ARGON2_PARALLELISM', 1))
+# bcrypt cost (log2 of the rounds).
+PASSWORD_BCRYPT_ROUNDS = int(os.environ.get('RSSREADER_BCRYPT_ROUNDS', 12))
+# PBKDF2-SHA256 iterations, None for Django's default.
+PASSWORD_PBKDF2_ITERATIONS = None
+# Processes hashing passwords, 0 to hash in the request thread. One per core
+# that can be spared for logins.
+PASSWORD_HASH_WORKERS = int(os.environ.get('RSSREADER_PASSWORD_HASH_WORKERS', 0))
+
+AUTHENTICATION_BACKENDS = ['api.passwords.PasswordBackend']
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.1/topics/i18n/
 
@@ -124,6 +209,109 @@ STATIC_URL = '/static/'
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
-    ]
+        'api.authentication.CachedTokenAuthentication',
+    ],
+    # orjson rather than json.dumps (see api/renderers.py).
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.ORJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
+# MessagePack for clients that ask for it, if it's installed.
+if importlib.util.find_spec('msgpack') is not None:
+    REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'].insert(1, 'api.renderers.MessagePackRenderer')
+
+# Token auth cache (see api/authentication.py).
+# Max tokens held in each process and seconds an entry lives.
+TOKEN_AUTH_CACHE_SIZE = 10000
+TOKEN_AUTH_CACHE_TTL = 60
+# Name of one of CACHES to share entries between processes, None to disable.
+TOKEN_AUTH_SHARED_CACHE = None
+
+# Background feed fetching (see api/workers.py).
+# Number of fetch worker threads, 0 runs fetches inline.
+FEED_FETCH_WORKERS = 4
+# Max number of queued fetch jobs before new feeds are left pending.
+FEED_FETCH_QUEUE_SIZE = 1000
+# Seconds before a remote feed fetch is abandoned, body download included.
+FEED_FETCH_TIMEOUT = 30
+# Max size in bytes of a feed document, bigger ones fail the fetch.
+FEED_FETCH_MAX_BYTES = 10 * 1024 * 1024
+# A feed fetched less than this many seconds ago isn't fetched again for new
+# subscribers (feeds/add, feeds/import), they get what it stored.
+FEED_RESULT_REUSE_SECONDS = 60
+
+# Bulk refresh (manage.py refresh_feeds, see api/bulk_refresh.py).
+# Max fetches in flight overall and against any single host.
+FEED_REFRESH_CONCURRENCY = 100
+FEED_REFRESH_PER_HOST = 4
+# Number of feeds written back to the database per batch.
+FEED_REFRESH_BATCH_SIZE = 100
+
+# Max number of new articles per bulk INSERT when ingesting feed entries.
+ARTICLE_INGEST_CHUNK_SIZE = 200
+
+# Article retention (manage.py prune_articles, see api/retention.py): an
+# article is pruned once it's neither among its feed's newest COUNT nor
+# published in the last DAYS (None to not keep by that rule, both None to
+# keep everything), unless someone hasn't read it. Feeds can override both.
+# Articles deleted per transaction.
+ARTICLE_RETENTION_COUNT = 1000
+ARTICLE_RETENTION_DAYS = 90
+ARTICLE_PRUNE_BATCH_SIZE = 1000
+
+# Feed list (GET /feeds) page size, clients can ask for up to the max with ?limit=
+FEED_LIST_PAGE_SIZE = 100
+FEED_LIST_MAX_PAGE_SIZE = 1000
+# Feed list response cache (see api/feedcache.py): one of CACHES, or None to
+# only use ETags, and seconds an unused entry is kept.
+FEED_LIST_CACHE = 'default'
+FEED_LIST_CACHE_TIMEOUT = 300
+# Timeline (GET /timeline) page size, clients can ask for up to the max with ?limit=
+TIMELINE_PAGE_SIZE = 50
+TIMELINE_MAX_PAGE_SIZE = 200
+# Search (GET /search, see api/search.py) results per kind, clients can ask
+# for up to the max with ?limit=, and the PostgreSQL text search config.
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 100
+SEARCH_CONFIG = 'english'
+
+# Bulk import (feeds/import): max urls per request and concurrent fetches.
+FEED_IMPORT_MAX_URLS = 5000
+FEED_IMPORT_WORKERS = 8
+
+# Circuit breakers (see api/health.py): consecutive failures to reach a host
+# before its fetches fail fast, and seconds before it's probed again. Feeds
+# that failed this many times in a row aren't fetched on demand until their
+# backoff runs out.
+HOST_CIRCUIT_FAILURES = 5
+HOST_CIRCUIT_COOLDOWN = 5 * 60
+FEED_CIRCUIT_FAILURES = 3
+
+# Adaptive refresh scheduling (see api/schedule.py), all in seconds.
+FEED_SCHEDULE_MIN_INTERVAL = 15 * 60
+FEED_SCHEDULE_MAX_INTERVAL = 24 * 60 * 60
+FEED_SCHEDULE_MAX_BACKOFF = 24 * 60 * 60
+
+# Route feeds/add and feeds to the async views (api/async_views.py), on by
+# default when served through rssreader/asgi.py.
+ASYNC_FEED_VIEWS = os.environ.get('RSSREADER_ASYNC_VIEWS') == '1'
+
+# Server-sent events (GET /events, async views only, see api/events.py): the
+# broker class, seconds between keepalives, how long a stream lasts before
+# the client has to reconnect, how soon it should, and events held per
+# stream.
+EVENTS_BACKEND = 'api.events.InProcessBroker'
+EVENTS_HEARTBEAT_SECONDS = 25
+EVENTS_STREAM_SECONDS = 300
+EVENTS_RETRY_SECONDS = 5
+EVENTS_QUEUE_SIZE = 100
+
+# Request and feed fetch metrics (see api/metrics.py), served at /metrics in
+# the Prometheus text format. Off by default, keep /metrics off the public
+# internet when on.
+METRICS_ENABLED = os.environ.get('RSSREADER_METRICS') == '1'
+# Log a warning for requests taking longer than this many seconds or making
+# more than this many queries, None to not log. Works with metrics off too.
+METRICS_SLOW_REQUEST_SECONDS = None
+METRICS_SLOW_REQUEST_QUERIES = None